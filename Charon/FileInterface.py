@@ -1,6 +1,6 @@
 # Copyright (c) 2018 Ultimaker B.V.
 # libCharon is released under the terms of the LGPLv3 or higher.
-from typing import Any, Dict, List, IO, Optional, Callable
+from typing import Any, Dict, Iterator, List, IO, Optional, Callable, Union
 
 from Charon.OpenMode import OpenMode
 
@@ -63,6 +63,23 @@ class FileInterface:
     def getData(self, virtual_path: str) -> Dict[str, Any]:
         raise NotImplementedError("The getData() function of " + self.__class__.__qualname__ + " is not implemented.")
 
+    ##  Gets the data of a resource a chunk at a time.
+    #
+    #   Unlike ``getData``, this never holds all of the resource in memory.
+    #   The resource is read while iterating, so only get the next chunk while
+    #   the file is still open.
+    #   \param virtual_path The path inside the file of the resource.
+    #   \param chunk_size The maximum number of bytes in every chunk.
+    #   \param offset The number of bytes to skip at the beginning of the
+    #   resource.
+    #   \param count The maximum number of bytes to get. If not specified, the
+    #   entire resource is returned except the initial offset.
+    #   \return The consecutive chunks of the resource, or none if there is no
+    #   resource at the specified virtual path. File types that can give the
+    #   data without copying it may give memoryviews instead of bytes.
+    def iterData(self, virtual_path: str, chunk_size: int = 1024 * 1024, offset: int = 0, count: int = -1) -> Iterator[Union[bytes, memoryview]]:
+        raise NotImplementedError("The iterData() function of " + self.__class__.__qualname__ + " is not implemented.")
+
     ##  Sets the data of several virtual paths at once.
     #
     #   The ``data`` parameter provides a dictionary mapping virtual paths to
@@ -145,4 +162,34 @@ class FileInterface:
     #   file will be returned except the initial offset.
     #   \return bytes A bytes array representing the file or a part of it.
     def toByteArray(self, offset: int = 0, count: int = -1) -> bytes:
-        raise NotImplementedError("The toByteArray() function of " + self.__class__.__qualname__ + " is not implemented.")
\ No newline at end of file
+        raise NotImplementedError("The toByteArray() function of " + self.__class__.__qualname__ + " is not implemented.")
+
+    ##  Reads a stream of a resource a chunk at a time, and closes it at the
+    #   end.
+    #   \param stream The stream of the resource, at the start.
+    #   \param chunk_size The maximum number of bytes in every chunk.
+    #   \param offset The number of bytes to skip at the beginning.
+    #   \param count The maximum number of bytes to read, or -1 to read up to
+    #   the end.
+    #   \return The consecutive chunks of the resource.
+    @staticmethod
+    def _readChunks(stream: IO[bytes], chunk_size: int, offset: int, count: int) -> Iterator[bytes]:
+        try:
+            if offset > 0:
+                if stream.seekable():
+                    stream.seek(offset)
+                else:
+                    while offset > 0:
+                        skipped = len(stream.read(min(chunk_size, offset)))
+                        if skipped == 0:
+                            return
+                        offset -= skipped
+            while count != 0:
+                chunk = stream.read(chunk_size if count < 0 else min(chunk_size, count))
+                if not chunk:
+                    return
+                if count > 0:
+                    count -= len(chunk)
+                yield chunk
+        finally:
+            stream.close()
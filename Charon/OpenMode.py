@@ -15,4 +15,9 @@ class OpenMode(enum.Enum):
     ReadOnly = "r"
 
     ##  The file can only be written to.
-    WriteOnly = "w"
\ No newline at end of file
+    WriteOnly = "w"
+
+    ##  The file can be read from and changed. Changes are written after the
+    #   existing contents of the file where possible, instead of writing the
+    #   whole file anew.
+    ReadWrite = "r+"
@@ -0,0 +1,78 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+from typing import Any, Optional
+
+from Charon.filetypes.LRUCache import LRUCache  # To drop the entries that were used least recently.
+
+
+##  A cache of data that is shared by packages, by the content that it was
+#   made from.
+#
+#   Many packages can contain the same resources, for instance when they only
+#   differ in their metadata. Whatever is made from a resource, such as its
+#   decompressed data, its compressed data or its parsed header, is cached by
+#   the kind of thing it is, and the CRC-32 and size of the uncompressed
+#   resource. Those are known from the central directory of an archive,
+#   without reading the resource. If a SHA-256 digest of the resource is known
+#   as well, it's stored with the entry, and entries of which the digest
+#   differs are not used, in case two resources have the same CRC-32 and size.
+#
+#   The cache holds on to at most a number of bytes. When it's full, the
+#   entries that were used least recently are dropped.
+class BlobCache:
+    ##  The default number of bytes that the cache can hold.
+    DefaultSizeLimit = 256 * 1024 * 1024
+
+    ##  Creates an empty cache.
+    #   \param size_limit The number of bytes that the cache can hold.
+    def __init__(self, size_limit: int = DefaultSizeLimit) -> None:
+        self._cache = LRUCache(max_size = size_limit)  # For each kind, CRC-32 and size, the cached value and the digest of the resource.
+
+    ##  The number of bytes that the cache can hold.
+    @property
+    def size_limit(self) -> int:
+        return self._cache.maxSize()
+
+    ##  How many bytes the cache currently holds.
+    @property
+    def size(self) -> int:
+        return self._cache.size()
+
+    ##  Gets something that was made from a resource.
+    #   \param kind What was made from the resource.
+    #   \param crc The CRC-32 of the resource.
+    #   \param file_size The size of the resource.
+    #   \param sha256 A SHA-256 digest of the resource, if known. For every
+    #   kind, it must be taken from the same form of the resource as when the
+    #   entry was stored.
+    #   \return The cached value, or ``None`` if it's not in the cache.
+    def get(self, kind: str, crc: int, file_size: int, sha256: Optional[bytes] = None) -> Any:
+        entry = self._cache.get((kind, crc, file_size))
+        if entry is None:
+            return None
+        value, stored_sha256 = entry
+        if sha256 is not None and stored_sha256 is not None and stored_sha256 != sha256:  # A different resource that happens to have the same CRC and size.
+            return None
+        return value
+
+    ##  Stores something that was made from a resource.
+    #
+    #   Entries that were used least recently are dropped to make room for it.
+    #   If it's bigger than the cache can hold, it's not stored.
+    #   \param kind What was made from the resource.
+    #   \param crc The CRC-32 of the resource.
+    #   \param file_size The size of the resource.
+    #   \param value What was made from the resource.
+    #   \param size How many bytes the value takes. If ``None``, the value must
+    #   be bytes, and its length is used.
+    #   \param sha256 A SHA-256 digest of the resource, if known.
+    def put(self, kind: str, crc: int, file_size: int, value: Any, size: Optional[int] = None, sha256: Optional[bytes] = None) -> None:
+        self._cache.put((kind, crc, file_size), (value, sha256), size = size if size is not None else len(value))
+
+    ##  Removes all entries from the cache.
+    def clear(self) -> None:
+        self._cache.clear()
+
+    ##  Gets the number of entries in the cache.
+    def __len__(self) -> int:
+        return len(self._cache)
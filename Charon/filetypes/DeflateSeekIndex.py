@@ -0,0 +1,222 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+import bisect  # To find the nearest checkpoint.
+import io
+import struct  # To store the index in a binary format.
+import threading  # To allow multiple streams on different threads to share an index.
+from typing import Any, Callable, List, Optional, Tuple
+import zipfile  # To report bad CRCs the same way as the zipfile module.
+import zlib  # To decompress the resources.
+
+
+##  An index of points in a deflate stream where decompression can start, so
+#   that a compressed resource can be read from the middle without inflating
+#   everything before it.
+#
+#   This works like zran from the zlib examples. Every checkpoint is at an
+#   offset in the uncompressed data that is a multiple of the interval, and
+#   holds what is needed to continue decompressing from there. That's either
+#   the 32kB of uncompressed data before the checkpoint, if the compressed
+#   data starts at a byte boundary there, or a copy of the state of a
+#   decompressor. Only the former can be stored in a file.
+class DeflateSeekIndex:
+    ##  The default distance between checkpoints, in uncompressed bytes.
+    DefaultInterval = 4 * 1024 * 1024
+
+    ##  The first bytes of a stored index.
+    Magic = b"CSIX"
+
+    ##  The layout of the header of a stored index: Magic, version, interval,
+    #   CRC and size of the resource, number of checkpoints.
+    _header = struct.Struct("<4sHQLQL")
+
+    ##  The layout of a checkpoint in a stored index: Uncompressed offset,
+    #   compressed offset, length of the window.
+    _checkpoint_header = struct.Struct("<QQL")
+
+    ##  Creates an index with only the start of the resource in it.
+    #   \param crc The CRC of the uncompressed resource, to check whether the
+    #   index belongs to the resource.
+    #   \param file_size The uncompressed size of the resource.
+    #   \param interval The distance between checkpoints, or ``None`` to use
+    #   the default interval.
+    def __init__(self, crc: int, file_size: int, interval: Optional[int] = None) -> None:
+        self.crc = crc
+        self.file_size = file_size
+        self.interval = interval if interval is not None else self.DefaultInterval
+        # For each checkpoint, the uncompressed offset, the compressed offset and either the window (bytes) or the state of a decompressor.
+        self._checkpoints = [(0, 0, b"")]  # type: List[Tuple[int, int, Any]]
+        self._offsets = [0]  # type: List[int] # Just the uncompressed offsets of the checkpoints, to search in.
+        self._lock = threading.Lock()
+
+    ##  Adds a checkpoint to the index, unless there already is one at that
+    #   offset.
+    #   \param offset The offset in the uncompressed data.
+    #   \param compressed_offset The offset in the compressed data from where to
+    #   continue decompressing.
+    #   \param state The 32kB of uncompressed data before the checkpoint, if the
+    #   compressed data starts at a byte boundary there, or a decompressor that
+    #   was stopped at the checkpoint and has consumed everything before the
+    #   compressed offset.
+    def add(self, offset: int, compressed_offset: int, state: Any) -> None:
+        with self._lock:
+            position = bisect.bisect_left(self._offsets, offset)
+            if position < len(self._offsets) and self._offsets[position] == offset:
+                return
+            self._offsets.insert(position, offset)
+            self._checkpoints.insert(position, (offset, compressed_offset, state))
+
+    ##  Finds the last checkpoint at or before an offset.
+    #   \param offset The offset in the uncompressed data.
+    #   \return The uncompressed offset and compressed offset of the checkpoint,
+    #   and a decompressor to continue decompressing with from there.
+    def nearest(self, offset: int) -> Tuple[int, int, Any]:
+        with self._lock:
+            offset, compressed_offset, state = self._checkpoints[bisect.bisect_right(self._offsets, offset) - 1]
+        if isinstance(state, bytes):
+            if state:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict = state)
+            else:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            decompressor = state.copy()  # Don't change the stored one.
+        return offset, compressed_offset, decompressor
+
+    ##  Gets the number of checkpoints in the index, including the start.
+    def __len__(self) -> int:
+        return len(self._checkpoints)
+
+    ##  Stores the index in a binary format.
+    #
+    #   Only the checkpoints that have a window are stored.
+    #   \return The stored index.
+    def serialize(self) -> bytes:
+        checkpoints = [checkpoint for checkpoint in self._checkpoints[1:] if isinstance(checkpoint[2], bytes)]
+        result = [self._header.pack(self.Magic, 1, self.interval, self.crc, self.file_size, len(checkpoints))]
+        for offset, compressed_offset, window in checkpoints:
+            result.append(self._checkpoint_header.pack(offset, compressed_offset, len(window)))
+            result.append(window)
+        return b"".join(result)
+
+    ##  Reads an index that was stored with ``serialize``.
+    #   \param data The stored index.
+    #   \return The index.
+    @classmethod
+    def parse(cls, data: bytes) -> "DeflateSeekIndex":
+        try:
+            magic, version, interval, crc, file_size, count = cls._header.unpack_from(data, 0)
+        except struct.error:
+            raise ValueError("The seek index is truncated.")
+        if magic != cls.Magic or version != 1:
+            raise ValueError("This is not a seek index of a known version.")
+        result = cls(crc, file_size, interval)
+        position = cls._header.size
+        for _ in range(count):
+            try:
+                offset, compressed_offset, window_length = cls._checkpoint_header.unpack_from(data, position)
+            except struct.error:
+                raise ValueError("The seek index is truncated.")
+            position += cls._checkpoint_header.size
+            result.add(offset, compressed_offset, bytes(data[position:position + window_length]))
+            position += window_length
+        return result
+
+
+##  A stream that reads a deflated resource from an archive, which can seek to
+#   any position quickly with the help of a ``DeflateSeekIndex``.
+#
+#   While reading, a checkpoint is added to the index at every interval that is
+#   passed, so the index gets built on the go. Seeking starts decompressing
+#   from the nearest checkpoint before the new position.
+class SeekableDeflateStream(io.RawIOBase):
+    ##  How much compressed data to read from the archive at a time.
+    ChunkSize = 64 * 1024
+
+    ##  Creates the stream.
+    #   \param read_range A function that reads a range of bytes from the
+    #   archive, given the offset and number of bytes.
+    #   \param data_offset The position in the archive where the compressed data
+    #   of the resource starts.
+    #   \param zip_info The resource to read.
+    #   \param index The index of the resource, which is shared by all streams
+    #   of the resource.
+    def __init__(self, read_range: Callable[[int, int], bytes], data_offset: int, zip_info: zipfile.ZipInfo, index: DeflateSeekIndex) -> None:
+        super().__init__()
+        self._read_range = read_range
+        self._data_offset = data_offset
+        self._zip_info = zip_info
+        self._index = index
+        self._position = 0
+        self._compressed_position = 0  # How much compressed data has been fed to the decompressor.
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._crc = 0  # type: Optional[int] # The CRC of what was read so far, as long as it was read from the start without seeking.
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._zip_info.file_size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence ({whence}).".format(whence = whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {offset}.".format(offset = offset))
+        offset = min(offset, self._zip_info.file_size)
+
+        if offset != self._position:
+            self._crc = None  # Won't be reading everything in order any more.
+        checkpoint = self._index.nearest(offset)
+        if offset < self._position or checkpoint[0] > self._position:  # Faster to start from the checkpoint than to continue from here.
+            self._position, self._compressed_position, self._decompressor = checkpoint
+        while self._position < offset:  # Skip the rest.
+            if not self._inflate(offset - self._position):
+                break
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        data = self._inflate(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readall(self) -> bytes:
+        result = []  # type: List[bytes]
+        while True:
+            data = self._inflate(self._zip_info.file_size - self._position + 1)
+            if not data:
+                return b"".join(result)
+            result.append(data)
+
+    ##  Decompresses the next part of the resource.
+    #
+    #   This stops at every checkpoint interval to add a checkpoint to the
+    #   index, so it may return less than requested.
+    #   \param size The maximum number of bytes to return.
+    #   \return The next bytes of the resource. Only empty at the end.
+    def _inflate(self, size: int) -> bytes:
+        while not self._decompressor.eof and size > 0:
+            boundary = (self._position // self._index.interval + 1) * self._index.interval
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._read_range(self._data_offset + self._compressed_position, min(self.ChunkSize, self._zip_info.compress_size - self._compressed_position))
+                self._compressed_position += len(data)
+            output = self._decompressor.decompress(data, min(size, boundary - self._position))
+            self._position += len(output)
+            if self._position == boundary:
+                self._index.add(boundary, self._compressed_position, self._decompressor.copy())
+            if self._crc is not None:
+                self._crc = zlib.crc32(output, self._crc)
+            if output:
+                return output
+            if not data:
+                raise zipfile.BadZipFile("The data of {file_name} is truncated.".format(file_name = self._zip_info.filename))
+        if self._crc is not None and self._position >= self._zip_info.file_size and self._crc != self._zip_info.CRC:
+            raise zipfile.BadZipFile("Bad CRC-32 for file {file_name}.".format(file_name = self._zip_info.filename))
+        return b""
@@ -0,0 +1,474 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+import io
+import math
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+try:
+    import numpy  # To analyse the moves of a block of G-code at once.
+except ImportError:
+    numpy = None
+
+##  The fields of the moves that an analysis collects: The position at the end
+#   of the move, the filament that it extrudes (negative when retracting) in
+#   mm, its feedrate in mm/min, the number of the layer it's in (-1 before the
+#   first layer marker), its type and its extruder.
+MoveFields = [("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("e", "<f4"), ("f", "<f4"), ("layer", "<i4"), ("type", "u1"), ("extruder", "u1")]
+
+##  The type of the NumPy record arrays of moves, if NumPy is installed.
+MoveDtype = numpy.dtype(MoveFields) if numpy is not None else None
+
+
+##  Computes statistics of a G-code toolpath from the moves in it: The
+#   bounding box of what is printed, the length of filament per extruder, the
+#   number of layers and an estimate of the print time.
+#
+#   Like a ``GCodeLayerIndex``, it's built in a single pass by feeding it the
+#   file in chunks of any size, so the memory it needs doesn't depend on the
+#   size of the file. The G0 to G3 moves of every chunk are tokenised and
+#   accumulated as NumPy arrays. Arcs are counted as straight lines. The few
+#   commands that change the state of the printer, like G92 or tool changes,
+#   are handled one by one, and split the moves around them into runs that
+#   are processed at once.
+#
+#   The time estimate assumes that every move accelerates from standing still
+#   up to its feedrate and decelerates to standing still at its end, with a
+#   fixed acceleration. Dwells are added to it.
+#
+#   The moves themselves can be collected too, as NumPy record arrays of the
+#   type ``MoveDtype``, with one array per chunk that was fed.
+class GCodeAnalyzer:
+    ##  The default acceleration for the time estimate, in mm/s².
+    DefaultAcceleration = 3000.0
+
+    ##  The axes of which the values of moves are read, in order.
+    Axes = b"XYZEF"
+
+    ##  The types of moves.
+    Travel = 0  # Moves without extruding.
+    Extrusion = 1  # Moves that extrude while moving.
+    Retraction = 2  # Moves that pull back filament.
+    Unretraction = 3  # Moves that only push filament, usually back after a retraction.
+
+    _layer_marker = b";LAYER:"
+
+    ##  Creates an empty analysis.
+    #   \param acceleration The acceleration for the time estimate, in mm/s².
+    #   \param collect_moves Whether to collect the moves, to get them with
+    #   ``takeMoves``.
+    #   \raises ImportError NumPy is not installed.
+    def __init__(self, acceleration: float = DefaultAcceleration, collect_moves: bool = False) -> None:
+        if numpy is None:
+            raise ImportError("Analysing G-code requires NumPy.")
+        self.acceleration = acceleration
+        self._axis_of = numpy.full(256, -1, dtype = numpy.int64)  # For every character, the index of its axis, or -1 if it's not an axis.
+        for index, axis in enumerate(self.Axes):
+            self._axis_of[axis] = index
+            self._axis_of[axis + 32] = index  # Lowercase.
+        self._is_axis = self._axis_of >= 0
+        self._upper_case = numpy.arange(256, dtype = numpy.uint8)  # For every character, the character in uppercase.
+        self._upper_case[97:123] -= 32
+        self._is_blank = numpy.zeros(256, dtype = bool)  # For every character, whether it's whitespace within a line.
+        self._is_blank[[9, 32]] = True
+        self._number_kind = numpy.zeros(256, dtype = numpy.int32)  # For every character, 1 for digits, 1 << 10 for the point and 1 << 20 for signs.
+        self._number_kind[48:58] = 1
+        self._number_kind[46] = 1 << 10
+        self._number_kind[[43, 45]] = 1 << 20
+        self.move_count = 0  # The number of moves.
+        self.time = 0.0  # The estimated print time, in seconds.
+        self.filament = {}  # type: Dict[int, float] # For each extruder, the length of filament it extruded, in mm.
+        self.layer_marker_count = 0  # The number of layer markers.
+        self.minimum = [math.inf, math.inf, math.inf]  # The minimum X, Y and Z of the extruding moves.
+        self.maximum = [-math.inf, -math.inf, -math.inf]  # The maximum X, Y and Z of the extruding moves.
+        self._layer_heights = set()  # type: Set[float] # The heights at which was extruded, to count layers when there are no markers.
+        self._position = [0.0, 0.0, 0.0, 0.0]  # The current X, Y, Z and E.
+        self._feedrate = 0.0  # The current feedrate, in mm/min.
+        self._absolute = True  # Whether X, Y and Z are absolute coordinates.
+        self._absolute_extrusion = True  # Whether E is an absolute coordinate.
+        self._extruder = 0  # The current extruder.
+        self._remainder = b""  # The last line that was fed, if it's not complete yet.
+        self._layer = -1  # The number of the current layer.
+        self._moves = [] if collect_moves else None  # type: Optional[List[Any]] # The record arrays of the moves that were collected and not taken yet.
+
+    ##  Analyses a file.
+    #   \param stream The file to analyse. It is read from the current position
+    #   up to the end.
+    #   \param chunk_size How many bytes to read at a time.
+    #   \param acceleration The acceleration for the time estimate, in mm/s².
+    #   \return The analysis of the file.
+    @classmethod
+    def build(cls, stream: IO[bytes], chunk_size: int = 4 * 1024 * 1024, acceleration: float = DefaultAcceleration) -> "GCodeAnalyzer":
+        result = cls(acceleration)
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            result.feed(chunk)
+        result.finish()
+        return result
+
+    ##  Reads the moves of a file, a chunk at a time.
+    #
+    #   Only one chunk of the file and its moves are in memory at a time.
+    #   \param stream The file to read. It is read from the current position up
+    #   to the end.
+    #   \param chunk_size How many bytes to read at a time.
+    #   \return For every chunk with moves, a record array of type ``MoveDtype``
+    #   with the moves in it.
+    @classmethod
+    def iterMoves(cls, stream: IO[bytes], chunk_size: int = 4 * 1024 * 1024) -> Iterator[Any]:
+        return cls.iterChunkMoves(iter(lambda: stream.read(chunk_size), b""))
+
+    ##  Reads the moves of a file that is given in chunks.
+    #   \param chunks The consecutive chunks of the file.
+    #   \return For every chunk with moves, a record array of type ``MoveDtype``
+    #   with the moves in it.
+    @classmethod
+    def iterChunkMoves(cls, chunks: Iterable[Union[bytes, memoryview]]) -> Iterator[Any]:
+        analyzer = cls(collect_moves = True)
+        for chunk in chunks:
+            analyzer.feed(chunk)
+            moves = analyzer.takeMoves()
+            if len(moves) > 0:
+                yield moves
+        analyzer.finish()
+        moves = analyzer.takeMoves()
+        if len(moves) > 0:
+            yield moves
+
+    ##  Adds the next part of the file to the analysis.
+    #   \param data The bytes that follow the bytes that were fed before.
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        if not data:
+            return
+        buffer = self._remainder + data if self._remainder else bytes(data)
+        cut = buffer.rfind(b"\n") + 1  # Only look at complete lines. The rest waits for more data.
+        self._remainder = buffer[cut:]
+        if cut > 0:
+            self._analyseLines(buffer[:cut])
+
+    ##  Analyses the last line of the file, if it didn't end with a newline.
+    #
+    #   Call this after all of the file has been fed.
+    def finish(self) -> None:
+        if self._remainder:
+            self._analyseLines(self._remainder + b"\n")
+            self._remainder = b""
+
+    ##  Gets the moves that were collected since the last time.
+    #   \return A record array of type ``MoveDtype`` with the moves, in order.
+    def takeMoves(self) -> Any:
+        assert self._moves is not None, "The analysis doesn't collect moves."
+        if len(self._moves) == 1:
+            result = self._moves[0]
+        else:
+            result = numpy.concatenate(self._moves) if self._moves else numpy.empty(0, dtype = MoveDtype)
+        self._moves.clear()
+        return result
+
+    ##  Gets the number of layers.
+    #
+    #   These are counted by their markers, or if there are none, by the
+    #   different heights at which was extruded.
+    def layerCount(self) -> int:
+        return self.layer_marker_count if self.layer_marker_count > 0 else len(self._layer_heights)
+
+    ##  Gets the results of the analysis, as metadata.
+    #   \param prefix A prefix to put before every key of the metadata.
+    #   \return The metadata, by key.
+    def toMetadata(self, prefix: str = "") -> Dict[str, Any]:
+        result = {
+            prefix + "layer_count": self.layerCount(),
+            prefix + "move_count": self.move_count,
+            prefix + "time": self.time
+        }  # type: Dict[str, Any]
+        if self.minimum[0] <= self.maximum[0]:  # Something was extruded.
+            for index, axis in enumerate("xyz"):
+                result[prefix + "bounding_box/min/" + axis] = self.minimum[index]
+                result[prefix + "bounding_box/max/" + axis] = self.maximum[index]
+        for extruder, length in sorted(self.filament.items()):
+            result[prefix + "filament/" + str(extruder)] = length
+        return result
+
+    ##  Analyses a number of complete lines.
+    #   \param data The lines, ending with a newline.
+    def _analyseLines(self, data: bytes) -> None:
+        self.layer_marker_count += data.count(b"\n" + self._layer_marker) + (1 if data.startswith(self._layer_marker) else 0)
+
+        size = len(data)
+        characters = numpy.frombuffer(data + b"\n\n\n", dtype = numpy.uint8)  # Some padding, to look ahead at the start of every line.
+        newlines = numpy.flatnonzero(characters[:size] == 10)
+        starts = numpy.empty(len(newlines), dtype = numpy.int64)
+        starts[0] = 0
+        starts[1:] = newlines[:-1] + 1
+        first = starts.copy()  # Where the command of every line starts, after any whitespace.
+        blank = self._is_blank[characters[first]]
+        while blank.any():  # Lines end with a newline, so this stops there at the latest.
+            first[blank] += 1
+            blank[blank] = self._is_blank[characters[first[blank]]]
+        command = self._upper_case[characters[first]]  # Like GCodeFile, commands are case-insensitive.
+        number = characters[first + 1]
+        after_number = characters[first + 2]
+        single_digit = ((after_number < 48) | (after_number > 57)) & (after_number != 46)  # Like G1, not G10 or G1.5.
+        is_move = (command == 71) & (number >= 48) & (number <= 51) & single_digit  # G0 to G3.
+        special_lines = numpy.flatnonzero(((command == 71) & ~is_move) | ((command == 77) & (number == 56)) | (command == 84))  # Other G commands, M8x and T.
+
+        move_lines = numpy.flatnonzero(is_move)
+        if len(move_lines) > 0:
+            values = self._parseMoves(characters, size, starts, newlines, is_move, move_lines)
+        else:
+            values = numpy.empty((0, len(self.Axes)))
+        layers = self._moveLayers(data, starts, move_lines) if self._moves is not None else None
+
+        # Process the runs of moves between the lines that change the state.
+        run_start = 0
+        for line in special_lines:
+            run_end = int(numpy.searchsorted(move_lines, line))
+            self._analyseMoves(values[run_start:run_end], layers[run_start:run_end] if layers is not None else None)
+            run_start = run_end
+            self._analyseCommand(data[starts[line]:newlines[line]])
+        self._analyseMoves(values[run_start:], layers[run_start:] if layers is not None else None)
+
+    ##  Finds the layer that every move in a number of lines is in.
+    #   \param data The lines.
+    #   \param starts The position where every line starts.
+    #   \param move_lines The indices of the lines that are moves.
+    #   \return For every move, the number of its layer.
+    def _moveLayers(self, data: bytes, starts: Any, move_lines: Any) -> Any:
+        marker_lines = []  # type: List[int]
+        numbers = []  # type: List[int]
+        found = data.find(self._layer_marker)
+        while found >= 0:
+            if found == 0 or data[found - 1] == 0x0A:  # Only at the start of a line.
+                try:
+                    numbers.append(int(data[found + len(self._layer_marker):data.find(b"\n", found)].strip()))
+                    marker_lines.append(int(numpy.searchsorted(starts, found)))
+                except ValueError:  # Not a layer number. Some other comment.
+                    pass
+            found = data.find(self._layer_marker, found + 1)
+        if not marker_lines:
+            return numpy.full(len(move_lines), self._layer, dtype = numpy.int32)
+
+        previous_marker = numpy.searchsorted(numpy.array(marker_lines), move_lines) - 1
+        result = numpy.where(previous_marker >= 0, numpy.array(numbers, dtype = numpy.int32)[numpy.maximum(previous_marker, 0)], self._layer)
+        self._layer = numbers[-1]
+        return result
+
+    ##  Reads the values of the axes of the moves in a number of lines.
+    #   \param characters The lines, with some padding after them.
+    #   \param size The length of the lines without the padding.
+    #   \param starts The position where every line starts.
+    #   \param newlines The position where every line ends.
+    #   \param is_move For every line, whether it's a move.
+    #   \param move_lines The indices of the lines that are moves.
+    #   \return For every move, the value of every axis, or NaN if the move
+    #   doesn't have one.
+    def _parseMoves(self, characters: Any, size: int, starts: Any, newlines: Any, is_move: Any, move_lines: Any) -> Any:
+        text = characters[:size]
+
+        # The letters of the axes in moves, except in comments.
+        letters = numpy.flatnonzero(self._is_axis[text])
+        lines = numpy.searchsorted(newlines, letters)
+        comment_starts = newlines.copy()  # Where the comment of every line starts, or its end if it has none.
+        semicolons = numpy.flatnonzero(text == 59)
+        if len(semicolons) > 0:
+            semicolon_lines = numpy.searchsorted(newlines, semicolons)
+            first = numpy.flatnonzero(numpy.diff(semicolon_lines, prepend = -1))  # The first semicolon of every line.
+            comment_starts[semicolon_lines[first]] = semicolons[first]
+        in_words = is_move[lines] & (letters < comment_starts[lines])
+        letters = letters[in_words]
+        lines = lines[in_words]
+
+        # Every word of an axis has a number, up to the next character that can't be in a number.
+        not_number = numpy.flatnonzero(self._number_kind[characters] == 0)
+        ends = not_number[numpy.searchsorted(not_number, letters + 1)]
+        not_empty = ends > letters + 1
+        letters = letters[not_empty]
+        lines = lines[not_empty]
+        ends = ends[not_empty]
+
+        numbers = self._parseNumbers(characters, size, letters, ends)
+        if numbers is None:  # Some are not well-formed. Leave those out and try again.
+            valid = self._wellFormed(characters, letters, ends)
+            letters = letters[valid]
+            lines = lines[valid]
+            ends = ends[valid]
+            numbers = self._parseNumbers(characters, size, letters, ends)
+            assert numbers is not None
+
+        result = numpy.full((len(move_lines), len(self.Axes)), numpy.nan)
+        result[numpy.searchsorted(move_lines, lines), self._axis_of[text[letters]]] = numbers
+        return result
+
+    ##  Parses the numbers after the letters of the axes.
+    #   \param characters The lines, with some padding after them.
+    #   \param size The length of the lines without the padding.
+    #   \param letters The positions of the letters.
+    #   \param ends For every letter, the position right after its number.
+    #   \return The numbers, or ``None`` if some of them are not well-formed.
+    def _parseNumbers(self, characters: Any, size: int, letters: Any, ends: Any) -> Optional[Any]:
+        # Keep only the numbers, with a space after each, and let NumPy convert them all at once.
+        in_number = numpy.zeros(size + 1, dtype = numpy.int8)
+        in_number[letters + 1] = 1
+        in_number[ends] -= 1
+        in_number = numpy.cumsum(in_number, dtype = numpy.int8)
+        in_number[ends] = 1
+        text = characters[:size + 1].copy()
+        text[ends] = 32
+        words = text[in_number > 0].tobytes().split()
+        if len(words) != len(letters):
+            return None
+        try:
+            return numpy.array(words, dtype = numpy.float64)
+        except ValueError:
+            return None
+
+    ##  Checks which numbers after the letters of the axes are well-formed: At
+    #   least one digit, at most one point and only a sign at the start.
+    #   \param characters The lines, with some padding after them.
+    #   \param letters The positions of the letters.
+    #   \param ends For every letter, the position right after its number.
+    #   \return For every letter, whether its number is well-formed.
+    def _wellFormed(self, characters: Any, letters: Any, ends: Any) -> Any:
+        kinds = self._number_kind[characters]
+        counts = numpy.concatenate(([0], numpy.cumsum(kinds, dtype = numpy.int32)))  # Digits, points and signs, each in their own bits. Differences are right even if this wraps around.
+        counts = counts[ends] - counts[letters + 1] - numpy.where((kinds[letters + 1] >> 20) > 0, 1 << 20, 0).astype(numpy.int32)
+        return (counts & 0x3FF > 0) & ((counts >> 10) & 0x3FF <= 1) & (counts >> 20 == 0) & (ends - letters < 0x3FF)
+
+    ##  Accumulates the statistics of a run of moves, without other commands
+    #   in between.
+    #   \param values For every move, the value of every axis, or NaN if the
+    #   move doesn't have one.
+    #   \param layers For every move, the number of its layer, if the moves are
+    #   collected.
+    def _analyseMoves(self, values: Any, layers: Optional[Any] = None) -> None:
+        count = len(values)
+        if count == 0:
+            return
+        self.move_count += count
+
+        positions = numpy.empty((count + 1, 4))  # The position before the run, and after every move.
+        positions[0] = self._position
+        for axis in range(4):
+            column = values[:, axis]
+            present = ~numpy.isnan(column)
+            absolute = self._absolute if axis < 3 else self._absolute_extrusion
+            if absolute:  # Missing values stay the same as the last one.
+                last = numpy.maximum.accumulate(numpy.where(present, numpy.arange(count), -1))
+                positions[1:, axis] = numpy.where(last >= 0, column[numpy.maximum(last, 0)], self._position[axis])
+            else:
+                positions[1:, axis] = self._position[axis] + numpy.cumsum(numpy.where(present, column, 0.0))
+        feedrates = values[:, 4]
+        last = numpy.maximum.accumulate(numpy.where(~numpy.isnan(feedrates), numpy.arange(count), -1))
+        feedrates = numpy.where(last >= 0, feedrates[numpy.maximum(last, 0)], self._feedrate)
+
+        deltas = numpy.diff(positions, axis = 0)
+        self.filament[self._extruder] = self.filament.get(self._extruder, 0.0) + float(deltas[:, 3].sum())
+        extruding = deltas[:, 3] > 0
+        if extruding.any():
+            ends = positions[1:][extruding, :3]
+            starts = positions[:-1][extruding, :3]
+            self.minimum = [min(self.minimum[axis], float(ends[:, axis].min()), float(starts[:, axis].min())) for axis in range(3)]
+            self.maximum = [max(self.maximum[axis], float(ends[:, axis].max()), float(starts[:, axis].max())) for axis in range(3)]
+            self._layer_heights.update(numpy.unique(numpy.round(ends[:, 2], 4)).tolist())
+
+        distances = numpy.sqrt((deltas[:, :3] ** 2).sum(axis = 1))
+        distances = numpy.where(distances > 0, distances, numpy.abs(deltas[:, 3]))  # Moves of only the extruder.
+        speeds = feedrates / 60
+        moving = (distances > 0) & (speeds > 0)
+        distances = distances[moving]
+        speeds = speeds[moving]
+        reaches_speed = distances >= speeds * speeds / self.acceleration
+        durations = numpy.where(reaches_speed, distances / speeds + speeds / self.acceleration, 2 * numpy.sqrt(distances / self.acceleration))
+        self.time += float(durations.sum())
+
+        if self._moves is not None:
+            moves = numpy.empty(count, dtype = MoveDtype)
+            for axis, name in enumerate("xyz"):
+                moves[name] = positions[1:, axis]
+            moves["e"] = deltas[:, 3]
+            moves["f"] = feedrates
+            moves["layer"] = layers
+            moves["extruder"] = self._extruder
+            moving = (deltas[:, :3] != 0).any(axis = 1)
+            moves["type"] = numpy.where(deltas[:, 3] < 0, self.Retraction, numpy.where(deltas[:, 3] > 0, numpy.where(moving, self.Extrusion, self.Unretraction), self.Travel))
+            self._moves.append(moves)
+
+        self._position = positions[-1].tolist()
+        self._feedrate = float(feedrates[-1])
+
+    ##  Applies a command that changes the state of the printer.
+    #   \param line The line with the command.
+    def _analyseCommand(self, line: bytes) -> None:
+        words = line.split(b";", 1)[0].upper().split()
+        if not words:
+            return
+        command = words[0]
+        parameters = {}  # type: Dict[bytes, float]
+        for word in words[1:]:
+            try:
+                parameters[word[:1]] = float(word[1:]) if len(word) > 1 else 0.0
+            except ValueError:  # Not a number. Ignore it.
+                pass
+        axes = list(enumerate((b"X", b"Y", b"Z", b"E")))
+
+        if command == b"G90":
+            self._absolute = self._absolute_extrusion = True
+        elif command == b"G91":
+            self._absolute = self._absolute_extrusion = False
+        elif command == b"M82":
+            self._absolute_extrusion = True
+        elif command == b"M83":
+            self._absolute_extrusion = False
+        elif command == b"G92":  # Set the position.
+            for index, axis in axes:
+                if axis in parameters or not parameters:
+                    self._position[index] = parameters.get(axis, 0.0)
+        elif command == b"G28":  # Home the axes in the command, or all of them.
+            homed = [index for index, axis in axes[:3] if axis in parameters] or [0, 1, 2]
+            for index in homed:
+                self._position[index] = 0.0
+        elif command in (b"G4", b"G04"):  # Dwell.
+            if b"P" in parameters:
+                self.time += parameters[b"P"] / 1000
+            elif b"S" in parameters:
+                self.time += parameters[b"S"]
+        elif command.startswith(b"T") and command[1:].isdigit():
+            self._extruder = int(command[1:])
+
+
+##  A stream of the moves of a G-code file, as the bytes of records of the type
+#   ``MoveDtype``.
+#
+#   The moves are analysed a chunk of the file at a time, while the stream is
+#   read. With ``chunks``, they can be read as record arrays instead.
+class MovesStream(io.RawIOBase):
+    ##  Creates the stream.
+    #   \param moves For every chunk of the file, the record array of its moves.
+    def __init__(self, moves: Iterator[Any]) -> None:
+        super().__init__()
+        self._moves = moves
+        self._buffer = memoryview(b"")  # The bytes of moves that were analysed but not read yet.
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._moves)).cast("B")
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    ##  Reads the rest of the moves as record arrays.
+    #
+    #   Moves of which the bytes were partly read already are left out.
+    #   \return For every chunk of the file, a record array of type
+    #   ``MoveDtype`` with the moves in it.
+    def chunks(self) -> Iterator[Any]:
+        partial = len(self._buffer) % MoveDtype.itemsize
+        if len(self._buffer) > partial:
+            yield numpy.frombuffer(self._buffer[partial:], dtype = MoveDtype)
+        self._buffer = memoryview(b"")
+        yield from self._moves
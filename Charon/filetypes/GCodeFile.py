@@ -1,11 +1,20 @@
 # Copyright (c) 2018 Ultimaker B.V.
 # libCharon is released under the terms of the LGPLv3 or higher.
 import ast
+import hashlib
+import io
+from io import BytesIO
+import json
+import mmap
+import os
+import re
 
-from typing import Any, Dict, IO, List, Optional, Union
+from typing import Any, cast, Dict, IO, Iterator, List, Optional, Union
 
 from Charon.FileInterface import FileInterface
 from Charon.OpenMode import OpenMode
+from Charon.filetypes.GCodeAnalyzer import GCodeAnalyzer, MovesStream
+from Charon.filetypes.GCodeLayerIndex import GCodeLayerIndex
 
 
 def isAPositiveNumber(a: str) -> bool:
@@ -23,46 +32,99 @@ class GCodeFile(FileInterface):
 
     MaximumHeaderLength = 100
 
+    # The line that ends the header: The start of the first layer, or the end marker.
+    _header_end_markers = (b";LAYER", b";END_OF_HEADER")
+    _header_end = re.compile(rb"^;(?:LAYER|END_OF_HEADER)", re.MULTILINE)
+
+    # A line with a key and value in the header: The key, and the value after the first colon.
+    _header_line = re.compile(r"^;(?!START_OF_HEADER)([^:\n]*):([^\n]*)$", re.MULTILINE)
+    _header_version_without_value = re.compile(r"^;HEADER_VERSION[^:\n]*$", re.MULTILINE)
+
+    # Values that can be typed without evaluating them as Python literals.
+    _integer_value = re.compile(r"[+-]?(?:0|[1-9][0-9]*)\Z")
+    _float_value = re.compile(r"[+-]?(?:[0-9]+\.[0-9]*(?:[eE][+-]?[0-9]+)?|\.[0-9]+(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+)\Z")
+    _number = r"[+-]?(?:[0-9]+\.[0-9]*(?:[eE][+-]?[0-9]+)?|\.[0-9]+(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+|0|[1-9][0-9]*)"
+    _tuple_value = re.compile(r"\([ \t]*(?:" + _number + r"[ \t]*,[ \t]*)+(?:" + _number + r"[ \t]*)?\)\Z")
+    _version_value = re.compile(r"[0-9]+(?:\.[0-9]+){2,}\Z")  # Like 4.0.0, which is not a number.
+    _date_value = re.compile(r"[0-9]+(?:-[0-9]+)+\Z")  # Like 2018-11-01, which is not a number either.
+    _constants = {"True": True, "False": False, "None": None}
+    _number_start = set("0123456789+-.")
+    _literal_characters = re.compile("[,+\\-#'\"()]")  # Parentheses for set(), which is a literal since Python 3.9.
+    _ascii_value = re.compile(r"[\x00-\x7f]*\Z")  # Like str.isascii, which Python 3.6 and before don't have.
+
+    # Virtual paths of a single layer and of the index of all layers.
+    _layer_path = re.compile(r"^/toolpath(/default)?/layer/(-?\d+)$")
+    _layers_path = re.compile(r"^/toolpath(/default)?/layers$")
+
+    # Virtual path of the moves of the toolpath, as records.
+    _moves_path = re.compile(r"^/toolpath(/default)?/moves$")
+
+    # How many bytes of the toolpath to get the moves of at a time.
+    _moves_chunk_size = 4 * 1024 * 1024
+
+    # Where the results of analysing the moves are put in the metadata.
+    _analysis_prefix = "/metadata/toolpath/default/analysis/"
+
     def __init__(self) -> None:
         self.__stream = None  # type: Optional[IO[bytes]]
         self.__metadata = {}  # type: Dict[str, Any]
-
-    def openStream(self, stream: IO[bytes], mime: str, mode: OpenMode = OpenMode.ReadOnly) -> None:
+        self.__layer_index = None  # type: Optional[GCodeLayerIndex]
+        self.__analyze = False
+        self.__analyzed = False
+        self.__map = None  # type: Optional[mmap.mmap]
+        self.__layer_cache = None  # type: Optional[str]
+
+    ## Opens a G-code file.
+    # @param stream The G-code file.
+    # @param mime The MIME type of the file.
+    # @param mode Only reading is supported.
+    # @param analyze Whether to analyse the moves in the file when metadata
+    # under /metadata/toolpath/default/analysis is requested. This requires
+    # NumPy and a seekable stream. Files without a valid header can then be
+    # opened too.
+    # @param memory_map Whether to map the file into memory, if it's a file on
+    # disk. Then the toolpath and its layers are got as memoryviews of the map
+    # from getData and iterData, without copying them, and iterLines goes
+    # through the lines in the map. Processes that map the same file share its
+    # pages in memory.
+    # @param layer_cache A directory to cache the index of the layers in, if
+    # the file is on disk, so that it doesn't need to be built again the next
+    # time the file is opened. If None, the index is not cached.
+    def openStream(self, stream: IO[bytes], mime: str, mode: OpenMode = OpenMode.ReadOnly, analyze: bool = False, memory_map: bool = False, layer_cache: Optional[str] = None) -> None:
         if mode != OpenMode.ReadOnly:
             raise NotImplementedError()
 
         self.__stream = stream
         self.__metadata = {}
-        self.__metadata = self.parseHeader(self.__stream, prefix = "/metadata/toolpath/default/")
-
+        self.__layer_index = None
+        self.__analyze = analyze
+        self.__analyzed = False
+        self.__map = self.__mapFile(stream) if memory_map else None
+        self.__layer_cache = layer_cache
+        try:
+            self.__metadata = self.parseHeader(self.__stream, prefix = "/metadata/toolpath/default/")
+        except InvalidHeaderException:
+            if not analyze:
+                raise
+            self.__stream.seek(0)  # The analysis can still tell something about it.
+
+    ## Parses the header of a G-code file.
+    # @param stream The G-code file, at the start. If it's seekable, it's put
+    # back at the start afterwards.
+    # @param prefix A prefix to put before every key of the metadata.
+    # @param use_literal_eval Whether to read the lines one by one and to
+    # evaluate the values as Python literals, like older versions did. The
+    # result is the same, but slower.
+    # @return The metadata in the header, as nested dictionaries by the parts
+    # of the keys.
     @staticmethod
-    def parseHeader(stream: IO[bytes], *, prefix: str = "") -> Dict[str, Any]:
+    def parseHeader(stream: IO[bytes], *, prefix: str = "", use_literal_eval: bool = False) -> Dict[str, Any]:
         try:
-            metadata = {} # type: Dict[str, Any]
-            line_number = 0
-            for line_number, bytes_line in enumerate(stream):
-                if line_number > GCodeFile.MaximumHeaderLength:
-                    break
-                line = bytes_line.decode("utf-8")
-
-                if line.startswith(";START_OF_HEADER"):
-                    continue
-                elif line.startswith(";LAYER") or line.startswith(";END_OF_HEADER"):
-                    break
-                elif line.startswith(";HEADER_VERSION"):
-                    # Header version is a number but should not be parsed as number, so special case it.
-                    metadata["header_version"] = line.split(":")[1].strip()
-                elif line.startswith(";") and ":" in line:
-                    key, value = line[1:].split(":")
-                    key = key.strip().lower()
-                    value = value.strip()
-                    try:
-                        value = ast.literal_eval(value.strip())
-                    except:
-                        pass
-                    key_elements = key.split(".")
-                    GCodeFile.__insertKeyValuePair(metadata, key_elements, value)
-            
+            if use_literal_eval:
+                metadata = GCodeFile.__readHeaderLines(stream)
+            else:
+                metadata = GCodeFile.__scanHeader(stream)
+
             if stream.seekable():
                 stream.seek(0)
 
@@ -87,6 +149,114 @@ class GCodeFile(FileInterface):
         except Exception as e:
             raise InvalidHeaderException("Unable to parse the header. An exception occured; %s" % e)
 
+    ## Reads the key-value pairs of the header line by line, evaluating the
+    # values as Python literals.
+    # @param stream The G-code file, at the start.
+    # @return The key-value pairs, as nested dictionaries.
+    @staticmethod
+    def __readHeaderLines(stream: IO[bytes]) -> Dict[str, Any]:
+        metadata = {} # type: Dict[str, Any]
+        line_number = 0
+        for line_number, bytes_line in enumerate(stream):
+            if line_number > GCodeFile.MaximumHeaderLength:
+                break
+            line = bytes_line.decode("utf-8")
+
+            if line.startswith(";START_OF_HEADER"):
+                continue
+            elif line.startswith(";LAYER") or line.startswith(";END_OF_HEADER"):
+                break
+            elif line.startswith(";HEADER_VERSION"):
+                # Header version is a number but should not be parsed as number, so special case it.
+                metadata["header_version"] = line.split(":")[1].strip()
+            elif line.startswith(";") and ":" in line:
+                key, value = line[1:].split(":")
+                key = key.strip().lower()
+                value = value.strip()
+                try:
+                    value = ast.literal_eval(value.strip())
+                except:
+                    pass
+                key_elements = key.split(".")
+                GCodeFile.__insertKeyValuePair(metadata, key_elements, value)
+        return metadata
+
+    ## Reads the key-value pairs of the header with a single pass of a regular
+    # expression over it.
+    #
+    # The lines of the header are collected and decoded at once, rather than
+    # one by one. Values are typed without evaluating them where their type is
+    # obvious, which it is for almost all of them. Only the rest is evaluated
+    # as a Python literal.
+    # @param stream The G-code file, at the start.
+    # @return The key-value pairs, as nested dictionaries.
+    @staticmethod
+    def __scanHeader(stream: IO[bytes]) -> Dict[str, Any]:
+        lines = []  # type: List[bytes]
+        for line in stream:  # Some streams can only read lines.
+            lines.append(line)
+            if len(lines) > GCodeFile.MaximumHeaderLength or line.startswith(GCodeFile._header_end_markers):
+                break
+        data = b"".join(lines)
+        end = GCodeFile._header_end.search(data)
+        if end is not None:
+            line_end = data.find(b"\n", end.start())
+            data[end.start():line_end if line_end >= 0 else len(data)].decode("utf-8")  # The line that ends the header needs to be valid too.
+            data = data[:end.start()]
+        header = data.decode("utf-8")
+        if GCodeFile._header_version_without_value.search(header):
+            raise ValueError("The header version has no value.")
+
+        metadata = {} # type: Dict[str, Any]
+        for match in GCodeFile._header_line.finditer(header):
+            key, value = match.groups()
+            if key.startswith("HEADER_VERSION"):
+                # Header version is a number but should not be parsed as number, so special case it.
+                metadata["header_version"] = value.split(":")[0].strip()
+                continue
+            if ":" in value:
+                raise ValueError("Too many values in line: {line}".format(line = match.group()))
+            key_elements = key.strip().lower().split(".")
+            parent = metadata
+            for key_element in key_elements[:-1]:  # Find or create the dictionaries that the value goes in.
+                child = parent.setdefault(key_element, {})
+                if not isinstance(child, dict):
+                    raise TypeError("Key {key} has a value as well as subkeys.".format(key = key_element))
+                parent = child
+            parent[key_elements[-1]] = GCodeFile.__parseValue(value.strip())
+        return metadata
+
+    ## Gets the value of a key in the header, the same way as a Python literal
+    # is evaluated, or as a string if it's not a Python literal.
+    # @param value The value in the header, without surrounding whitespace.
+    # @return The typed value.
+    @staticmethod
+    def __parseValue(value: str) -> Any:
+        if not value:
+            return value
+        first = value[0]
+        try:
+            if first in GCodeFile._number_start:
+                if GCodeFile._integer_value.match(value):
+                    return int(value)
+                if GCodeFile._float_value.match(value):
+                    return float(value)
+                if GCodeFile._version_value.match(value) or GCodeFile._date_value.match(value):
+                    return value
+            elif first == "(":
+                if GCodeFile._tuple_value.match(value):
+                    return tuple(int(element) if GCodeFile._integer_value.match(element) else float(element) for element in (element.strip(" \t") for element in value[1:-1].split(",")) if element)
+            elif GCodeFile._ascii_value.match(value) and (first.isalpha() or first == "_"):
+                if value in GCodeFile._constants:
+                    return GCodeFile._constants[value]
+                if not GCodeFile._literal_characters.search(value):  # Names and keywords can't form a literal without these.
+                    return value
+        except ValueError:  # Integers that are too long to convert. Let Python decide what they are.
+            pass
+        try:
+            return ast.literal_eval(value)
+        except Exception:
+            return value
 
     ## Add a key-value pair to the metadata dictionary.
     # Splits up key each element to it's own dictionary.
@@ -115,6 +285,8 @@ class GCodeFile(FileInterface):
         assert self.__stream is not None
 
         if virtual_path.startswith("/metadata"):
+            if self.__analyze and not self.__analyzed and (virtual_path.startswith(self._analysis_prefix) or self._analysis_prefix.startswith(virtual_path)):
+                self.__analyzeMoves()
             result = {}
             for key, value in self.__metadata.items():
                 if key.startswith(virtual_path):
@@ -122,10 +294,44 @@ class GCodeFile(FileInterface):
             return result
 
         if virtual_path == "/toolpath" or virtual_path == "/toolpath/default":
-            return { virtual_path: self.__stream.read() }
+            if self.__map is not None:
+                return {virtual_path: memoryview(self.__map)}
+            return {virtual_path: self.__stream.read()}
+
+        layer_match = self._layer_path.match(virtual_path)
+        if layer_match and self.__map is not None:
+            try:
+                start, end = self.__layerIndex().range(int(layer_match.group(2)))
+            except KeyError:
+                return {}
+            return {virtual_path: memoryview(self.__map)[start:end]}
+
+        if layer_match or self._layers_path.match(virtual_path) or self._moves_path.match(virtual_path):
+            try:
+                return {virtual_path: self.getStream(virtual_path).read()}
+            except FileNotFoundError:
+                return {}
 
         return {}
 
+    ## Gets the data of a resource a chunk at a time.
+    #
+    # If the file is memory-mapped, the chunks of the toolpath are memoryviews
+    # of the map.
+    def iterData(self, virtual_path: str, chunk_size: int = 1024 * 1024, offset: int = 0, count: int = -1) -> Iterator[Union[bytes, memoryview]]:
+        assert self.__stream is not None
+
+        if virtual_path == "/toolpath" or virtual_path == "/toolpath/default":
+            return self.__readFileChunks(chunk_size, offset, count)
+
+        if self._layer_path.match(virtual_path) or self._layers_path.match(virtual_path) or self._moves_path.match(virtual_path):
+            try:
+                return self._readChunks(self.getStream(virtual_path), chunk_size, offset, count)
+            except FileNotFoundError:
+                pass
+
+        return iter(())
+
     ## Cleans a parsed GRIFFIN flavoured GCODE header.
     @staticmethod
     def __cleanGriffinHeader(metadata: Dict[str, Any]) -> None:
@@ -232,14 +438,209 @@ class GCodeFile(FileInterface):
     def getStream(self, virtual_path: str) -> IO[bytes]:
         assert self.__stream is not None
         
+        layer_match = self._layer_path.match(virtual_path)
+        if layer_match:
+            try:
+                start, end = self.__layerIndex().range(int(layer_match.group(2)))
+            except KeyError:
+                raise FileNotFoundError(virtual_path)
+            if self.__map is not None:
+                return BytesIO(self.__map[start:end])
+            original_position = self.__stream.tell()
+            self.__stream.seek(start)
+            data = self.__stream.read(end - start)
+            self.__stream.seek(original_position)  # Leave the toolpath stream as it was.
+            return BytesIO(data)
+        if self._layers_path.match(virtual_path):
+            return BytesIO(json.dumps(self.__layerIndex().toDict()).encode("UTF-8"))
+        if self._moves_path.match(virtual_path):
+            return cast(IO[bytes], MovesStream(GCodeAnalyzer.iterChunkMoves(self.__readFileChunks(self._moves_chunk_size))))
+
         if virtual_path != "/toolpath" and virtual_path != "/toolpath/default":
             raise NotImplementedError("G-code files only support /toolpath as stream")
 
         return self.__stream
 
+    ## Gets the index of the layers in the file.
+    #
+    # The index is built with a single pass over the file when it's first
+    # needed. If a directory to cache it in was given and the file is on disk,
+    # the index is stored there, so that it doesn't need to be built again the
+    # next time the file is opened.
+    # @return The index of the layers.
+    def __layerIndex(self) -> GCodeLayerIndex:
+        assert self.__stream is not None
+        if self.__layer_index is not None:
+            return self.__layer_index
+
+        cache_name = self.__layerCacheName()
+        file_mtime = None  # type: Optional[int]
+        if cache_name is not None:
+            file_mtime = os.stat(self.__stream.name).st_mtime_ns
+            try:
+                with open(cache_name) as cache_file:
+                    cached = json.load(cache_file)
+                if cached.get("file_mtime") == file_mtime and cached.get("size") == self.__uncompressedSize():  # Still the same file.
+                    self.__layer_index = GCodeLayerIndex.fromDict(cached)
+                    return self.__layer_index
+            except (OSError, ValueError, AttributeError):  # No cache, or it's corrupt.
+                pass
+
+        self.__layer_index = GCodeLayerIndex()
+        for chunk in self.__readFileChunks(1024 * 1024):
+            self.__layer_index.feed(chunk)
+        self.__layer_index.finish()
+
+        if cache_name is not None:
+            cached = self.__layer_index.toDict()
+            cached["file_mtime"] = file_mtime
+            try:
+                os.makedirs(os.path.dirname(cache_name), exist_ok = True)
+                with open(cache_name, "w") as cache_file:
+                    json.dump(cached, cache_file)
+            except OSError:  # Can't write to the cache. Then we'll have to build it again next time.
+                pass
+        return self.__layer_index
+
+    ## Gets where the index of the layers is cached.
+    #
+    # The name of the cache file is derived from the absolute path of the file,
+    # so that files with the same name in different folders don't share it.
+    # @return The path to the cache file, or None if it's not cached.
+    def __layerCacheName(self) -> Optional[str]:
+        if self.__layer_cache is None:
+            return None
+        file_name = getattr(self.__stream, "name", None)
+        if not isinstance(file_name, str) or not os.path.isfile(file_name):
+            return None
+        path_hash = hashlib.sha1(os.path.abspath(file_name).encode("UTF-8")).hexdigest()[:16]
+        return os.path.join(self.__layer_cache, "{}.{}.layers.json".format(os.path.basename(file_name), path_hash))
+
+    ## Gets the size of the G-code, after decompressing it if it's compressed.
+    #
+    # For compressed files this has to decompress the whole file, but without
+    # keeping it in memory.
+    # @return The number of bytes of G-code.
+    def __uncompressedSize(self) -> int:
+        assert self.__stream is not None
+        if self.__map is not None:
+            return len(self.__map)
+        original_position = self.__stream.tell()
+        try:
+            return self.__stream.seek(0, io.SEEK_END)
+        finally:
+            self.__stream.seek(original_position)
+
+    ## Reads the file in chunks, and puts the stream back where it was at the
+    # end.
+    #
+    # If the stream is read in between, the next chunk is still read from
+    # where the previous one ended.
+    # @param chunk_size The maximum number of bytes in every chunk.
+    # @param offset The number of bytes to skip at the beginning of the file.
+    # @param count The maximum number of bytes to read, or -1 to read up to the
+    # end.
+    # @return The consecutive chunks of the file. If the file is memory-mapped,
+    # these are memoryviews of the map.
+    def __readFileChunks(self, chunk_size: int, offset: int = 0, count: int = -1) -> Iterator[Union[bytes, memoryview]]:
+        assert self.__stream is not None
+        if self.__map is not None:
+            view = memoryview(self.__map)
+            end = len(view) if count < 0 else min(len(view), offset + count)
+            for start in range(offset, end, chunk_size):
+                yield view[start:min(start + chunk_size, end)]
+            return
+        stream = self.__stream
+        original_position = stream.tell()
+        position = offset
+        try:
+            while count != 0:
+                if stream.tell() != position:  # Only seek when needed. Seeking in compressed files is slow.
+                    stream.seek(position)
+                chunk = stream.read(chunk_size if count < 0 else min(chunk_size, count))
+                if not chunk:
+                    return
+                position += len(chunk)
+                if count > 0:
+                    count -= len(chunk)
+                yield chunk
+        finally:
+            if not stream.closed:
+                stream.seek(original_position)
+
+    ## Adds the analysis of the moves in the file to the metadata.
+    def __analyzeMoves(self) -> None:
+        assert self.__stream is not None
+        original_position = self.__stream.tell()
+        self.__stream.seek(0)
+        analyzer = GCodeAnalyzer.build(self.__stream)
+        self.__stream.seek(original_position)
+        self.__metadata.update(analyzer.toMetadata(prefix = self._analysis_prefix))
+        self.__analyzed = True
+
+    ## Goes through the lines of the toolpath.
+    #
+    # If the file is memory-mapped, the lines are read from a map of the file
+    # with mmap.readline, which finds the newlines without going through the
+    # file object. Otherwise the file is read in chunks that are split into
+    # lines. Either way, the toolpath stream is left where it was.
+    # @param offset The position in the file from where to start.
+    # @param count The maximum number of bytes to go through, or -1 to go up
+    # to the end of the file.
+    # @return The lines, including their newline.
+    def iterLines(self, offset: int = 0, count: int = -1) -> Iterator[bytes]:
+        assert self.__stream is not None
+        if self.__map is None:
+            remainder = b""
+            for chunk in self.__readFileChunks(1024 * 1024, offset, count):
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    yield line + b"\n"
+            if remainder:
+                yield remainder
+            return
+
+        lines_map = mmap.mmap(self.__stream.fileno(), 0, access = mmap.ACCESS_READ)  # A map with its own position, so that the lines can be gone through more than once at the same time.
+        try:
+            lines_map.seek(min(offset, len(lines_map)))
+            if count < 0:
+                yield from iter(lines_map.readline, b"")
+                return
+            end = min(len(lines_map), offset + count)
+            position = offset
+            while position < end:
+                line = lines_map.readline()
+                position += len(line)
+                if position > end:
+                    yield line[:len(line) - (position - end)]
+                    return
+                yield line
+        finally:
+            lines_map.close()
+
+    ## Maps a file into memory.
+    # @param stream The file.
+    # @return The memory map, or None if the stream is not a file on disk that
+    # can be mapped.
+    @staticmethod
+    def __mapFile(stream: IO[bytes]) -> Optional[mmap.mmap]:
+        if not isinstance(stream, (io.BufferedReader, io.FileIO)):  # Compressed files have a file descriptor too, of the compressed data.
+            return None
+        try:
+            return mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Not a regular file, or empty.
+            return None
+
     def close(self) -> None:
         assert self.__stream is not None
-        
+
+        if self.__map is not None:
+            try:
+                self.__map.close()
+            except BufferError:  # There are still memoryviews of it. It's closed when those are released.
+                pass
+            self.__map = None
         self.__stream.close()
 
 
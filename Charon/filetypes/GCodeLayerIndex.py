@@ -0,0 +1,120 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+from typing import Any, Dict, IO, List, Tuple, Union
+
+
+##  The positions of the layers in a G-code file.
+#
+#   Every layer starts at a line with a ``;LAYER:<number>`` marker, and lasts
+#   until the next marker or the end of the file. The index is built in a
+#   single pass by feeding it the file in chunks of any size, so it can be
+#   built while the file is being read or written.
+class GCodeLayerIndex:
+    ##  The start of the lines that mark the start of a layer.
+    Marker = b";LAYER:"
+
+    ##  Creates an empty index.
+    def __init__(self) -> None:
+        self.numbers = []  # type: List[int] # The number of each layer, in the order in which they appear in the file.
+        self.offsets = []  # type: List[int] # For each layer, the byte offset of its marker in the file.
+        self.lines = []  # type: List[int] # For each layer, the line number of its marker in the file, counting from 0.
+        self.size = 0  # The number of bytes in the file.
+        self._line_count = 0  # The number of complete lines that were fed.
+        self._remainder = b""  # The last line that was fed, if it's not complete yet.
+        self._positions = {}  # type: Dict[int, int] # For each layer number, its position in the lists.
+
+    ##  Builds the index of a file.
+    #   \param stream The file to index. It is read from the current position
+    #   up to the end.
+    #   \param chunk_size How many bytes to read at a time.
+    #   \return The index of the file.
+    @classmethod
+    def build(cls, stream: IO[bytes], chunk_size: int = 1024 * 1024) -> "GCodeLayerIndex":
+        result = cls()
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            result.feed(chunk)
+        result.finish()
+        return result
+
+    ##  Adds the next part of the file to the index.
+    #   \param data The bytes that follow the bytes that were fed before.
+    def feed(self, data: Union[bytes, memoryview]) -> None:
+        if not data:
+            return
+        buffer = self._remainder + data if self._remainder else bytes(data)
+        cut = buffer.rfind(b"\n") + 1  # Only look at complete lines. The rest waits for more data.
+        if cut == 0:
+            self._remainder = buffer
+        else:
+            self._indexLines(buffer[:cut], self.size - len(self._remainder))
+            self._remainder = buffer[cut:]
+        self.size += len(data)
+
+    ##  Indexes the last line of the file, if it didn't end with a newline.
+    #
+    #   Call this after all of the file has been fed.
+    def finish(self) -> None:
+        if self._remainder:
+            self._indexLines(self._remainder, self.size - len(self._remainder))
+            self._remainder = b""
+
+    ##  Gets the byte range of a layer in the file.
+    #   \param number The number of the layer, as it appears in its marker.
+    #   \return The offset of the start of the layer and the offset right after
+    #   its end.
+    #   \raises KeyError The file has no layer with that number.
+    def range(self, number: int) -> Tuple[int, int]:
+        position = self._positions[number]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.size
+        return self.offsets[position], end
+
+    ##  Gets the index in a form that can be stored as JSON.
+    #   \return A dictionary with the size of the file and the numbers, offsets
+    #   and line numbers of the layers.
+    def toDict(self) -> Dict[str, Any]:
+        return {"size": self.size, "numbers": self.numbers, "offsets": self.offsets, "lines": self.lines}
+
+    ##  Restores an index that was stored with ``toDict``.
+    #   \param data The stored index.
+    #   \return The index.
+    #   \raises ValueError The stored index is incomplete or inconsistent.
+    @classmethod
+    def fromDict(cls, data: Dict[str, Any]) -> "GCodeLayerIndex":
+        result = cls()
+        try:
+            result.size = int(data["size"])
+            result.numbers = [int(number) for number in data["numbers"]]
+            result.offsets = [int(offset) for offset in data["offsets"]]
+            result.lines = [int(line) for line in data["lines"]]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("The layer index is incomplete.")
+        if not len(result.numbers) == len(result.offsets) == len(result.lines):
+            raise ValueError("The layer index is inconsistent.")
+        result._positions = {number: position for position, number in enumerate(result.numbers)}
+        return result
+
+    ##  Finds the layer markers in a number of complete lines.
+    #   \param data The lines.
+    #   \param offset The position of the lines in the file.
+    def _indexLines(self, data: bytes, offset: int) -> None:
+        line_number = self._line_count  # The line number at the position up to where the lines are counted.
+        counted = 0
+        found = data.find(self.Marker)
+        while found >= 0:
+            if found == 0 or data[found - 1] == 0x0A:  # Only at the start of a line.
+                line_end = data.find(b"\n", found)
+                if line_end < 0:
+                    line_end = len(data)
+                try:
+                    number = int(data[found + len(self.Marker):line_end].strip())
+                except ValueError:  # Not a layer number. Some other comment.
+                    number = None
+                if number is not None and number not in self._positions:  # If a number is repeated, the first one counts.
+                    line_number += data.count(b"\n", counted, found)
+                    counted = found
+                    self._positions[number] = len(self.numbers)
+                    self.numbers.append(number)
+                    self.offsets.append(offset + found)
+                    self.lines.append(line_number)
+            found = data.find(self.Marker, found + 1)
+        self._line_count += data.count(b"\n")
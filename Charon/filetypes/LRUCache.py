@@ -0,0 +1,71 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+from collections import OrderedDict  # To keep track of which entries were used least recently.
+import threading  # To allow multiple threads to use the same cache.
+from typing import Any, Hashable, Optional, Tuple
+
+
+##  A thread-safe cache of values with a limit on their total size.
+#
+#   When adding an entry would exceed the limit, the entries that were used
+#   least recently are evicted until it fits.
+class LRUCache:
+    ##  Creates an empty cache.
+    #   \param max_size The maximum total size of the cached values, in bytes.
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, Tuple[Any, int]] # The value and size of every entry. Least recently used first.
+        self._lock = threading.Lock()
+
+    ##  Gets a value from the cache, and marks it as recently used.
+    #   \param key The key of the value.
+    #   \return The value, or ``None`` if it's not in the cache.
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    ##  Adds a value to the cache.
+    #
+    #   Values that are bigger than the entire cache are not stored.
+    #   \param key The key of the value.
+    #   \param value The value to store.
+    #   \param size How many bytes the value takes. If ``None``, the value must
+    #   be bytes, and its length is used.
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+        if size is None:
+            size = len(value)
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self._max_size:
+                _, (_, evicted_size) = self._entries.popitem(last = False)
+                self._size -= evicted_size
+
+    ##  Removes all values from the cache.
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    ##  The total size of the cached values, in bytes.
+    def size(self) -> int:
+        return self._size
+
+    ##  The maximum total size of the cached values, in bytes.
+    def maxSize(self) -> int:
+        return self._max_size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._entries
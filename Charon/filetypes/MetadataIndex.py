@@ -0,0 +1,64 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+import bisect  # To find the range of keys that share a prefix.
+from typing import Any, List, Optional
+
+
+##  A dictionary of metadata entries that can efficiently find all entries in a
+#   subtree of virtual paths.
+#
+#   Next to the dictionary itself, a sorted list of the keys is maintained. All
+#   keys that start with a certain prefix are adjacent in this list, so finding
+#   them takes two binary searches rather than a pass over all keys. The sorted
+#   list is only rebuilt when it is needed after a bulk change.
+class MetadataIndex(dict):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._sorted_keys = None  # type: Optional[List[str]] # All keys in sorted order, or None if it needs to be rebuilt.
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self and self._sorted_keys is not None:
+            bisect.insort(self._sorted_keys, key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._sorted_keys = None
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        super().update(*args, **kwargs)
+        self._sorted_keys = None
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args: Any) -> Any:
+        result = super().pop(*args)
+        self._sorted_keys = None
+        return result
+
+    def popitem(self) -> Any:
+        result = super().popitem()
+        self._sorted_keys = None
+        return result
+
+    def clear(self) -> None:
+        super().clear()
+        self._sorted_keys = None
+
+    ##  Gets all keys that start with the specified prefix, in sorted order.
+    #
+    #   To get the subtree of a virtual path, ask for the keys with that path
+    #   plus a slash as prefix.
+    #   \param prefix The prefix that the keys must start with.
+    #   \return A list of all keys starting with that prefix.
+    def keysWithPrefix(self, prefix: str) -> List[str]:
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.keys())
+        if not prefix:
+            return list(self._sorted_keys)
+        start = bisect.bisect_left(self._sorted_keys, prefix)
+        end = bisect.bisect_left(self._sorted_keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)  # The first string that is greater than anything with this prefix.
+        return self._sorted_keys[start:end]
@@ -0,0 +1,164 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Reading and writing the parts of an OPC archive that describe the other
+#   parts: the content types file and the relationships files.
+#
+#   These files are XML documents with a flat list of elements, of which only
+#   the attributes matter. Instead of building an element tree for them, they
+#   are read with a streaming parser that only collects the attributes of the
+#   elements into tuples, and they are written from templates. ElementTree can
+#   still be used instead, for compatibility, by passing
+#   ``use_element_tree = True``. The results are the same, except that before
+#   Python 3.8, ElementTree writes the attributes in alphabetical order.
+import re  # To find characters that need escaping.
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple
+from xml.parsers import expat  # To read the documents without building a tree.
+import xml.etree.ElementTree as ET  # To read and write the documents the compatible way.
+
+##  The namespace of content types documents.
+ContentTypesNamespace = "http://schemas.openxmlformats.org/package/2006/content-types"
+
+##  The namespace of relationships documents.
+RelationshipsNamespace = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+##  A relation from a part or the package to another part.
+#
+#   The target mode is an empty string unless the relationship has one.
+Relationship = NamedTuple("Relationship", [("target", str), ("type", str), ("id", str), ("target_mode", str)])
+
+##  A content type in the content types document. The kind is ``"Default"``
+#   for the content type of all parts with a file extension, or ``"Override"``
+#   for the content type of one part. The key is the extension or the path of
+#   the part, respectively.
+ContentType = NamedTuple("ContentType", [("kind", str), ("key", str), ("content_type", str)])
+
+_xml_header = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+_special_characters = re.compile("[&<>\"\n\r\t]")  # Characters that need to be escaped in attributes.
+_escapes = {ord("&"): "&amp;", ord("<"): "&lt;", ord(">"): "&gt;", ord("\""): "&quot;", ord("\n"): "&#10;", ord("\r"): "&#13;", ord("\t"): "&#09;"}  # The same escapes as ElementTree uses in attributes.
+
+
+##  Reads a relationships document.
+#   \param data The document.
+#   \param use_element_tree Whether to parse the document with ElementTree.
+#   \return The relationships in the document, in order. Relationships without
+#   target or type are left out.
+#   \raises ET.ParseError The document is not valid XML.
+def parseRelationships(data: bytes, use_element_tree: bool = False) -> List[Relationship]:
+    result = []  # type: List[Relationship]
+
+    def addElement(tag: str, attributes: Dict[str, str]) -> None:
+        if tag == "Relationship" and "Target" in attributes and "Type" in attributes:
+            result.append(Relationship(attributes["Target"], attributes["Type"], attributes.get("Id", ""), attributes.get("TargetMode", "")))
+    _parse(data, addElement, use_element_tree)
+    return result
+
+
+##  Reads a content types document.
+#   \param data The document.
+#   \param use_element_tree Whether to parse the document with ElementTree.
+#   \return The content types in the document, in order.
+#   \raises ET.ParseError The document is not valid XML.
+def parseContentTypes(data: bytes, use_element_tree: bool = False) -> List[ContentType]:
+    result = []  # type: List[ContentType]
+
+    def addElement(tag: str, attributes: Dict[str, str]) -> None:
+        if tag == "Default" and "Extension" in attributes:
+            result.append(ContentType(tag, attributes["Extension"], attributes.get("ContentType", "")))
+        elif tag == "Override" and "PartName" in attributes:
+            result.append(ContentType(tag, attributes["PartName"], attributes.get("ContentType", "")))
+    _parse(data, addElement, use_element_tree)
+    return result
+
+
+##  Writes a relationships document.
+#   \param relationships The relationships to put in the document.
+#   \param use_element_tree Whether to write the document with ElementTree.
+#   \return The document.
+def serializeRelationships(relationships: Sequence[Relationship], use_element_tree: bool = False) -> bytes:
+    elements = []  # type: List[Tuple[str, List[Tuple[str, str]]]]
+    for relationship in relationships:
+        attributes = [("Target", relationship.target), ("Type", relationship.type), ("Id", relationship.id)]
+        if relationship.target_mode:
+            attributes.append(("TargetMode", relationship.target_mode))
+        elements.append(("Relationship", attributes))
+    return _serialize("Relationships", RelationshipsNamespace, elements, use_element_tree)
+
+
+##  Writes a content types document.
+#   \param content_types The content types to put in the document.
+#   \param use_element_tree Whether to write the document with ElementTree.
+#   \return The document.
+def serializeContentTypes(content_types: Sequence[ContentType], use_element_tree: bool = False) -> bytes:
+    elements = []  # type: List[Tuple[str, List[Tuple[str, str]]]]
+    for content_type in content_types:
+        key_name = "Extension" if content_type.kind == "Default" else "PartName"
+        elements.append((content_type.kind, [(key_name, content_type.key), ("ContentType", content_type.content_type)]))
+    return _serialize("Types", ContentTypesNamespace, elements, use_element_tree)
+
+
+##  Parses a document with a flat list of elements.
+#   \param data The document.
+#   \param add_element A function to call for every child of the root element,
+#   with its tag without namespace and its attributes.
+#   \param use_element_tree Whether to parse the document with ElementTree.
+#   \raises ET.ParseError The document is not valid XML.
+def _parse(data: bytes, add_element: Callable[[str, Dict[str, str]], Any], use_element_tree: bool) -> None:
+    if use_element_tree:
+        for element in ET.fromstring(data):
+            if isinstance(element.tag, str):  # Not a comment or processing instruction.
+                add_element(element.tag[element.tag.rfind("}") + 1:], element.attrib)
+        return
+
+    depth = 0
+
+    def startElement(tag: str, attributes: Dict[str, str]) -> None:
+        nonlocal depth
+        depth += 1
+        if depth == 2:  # Children of the root element.
+            add_element(tag[tag.rfind("}") + 1:], attributes)
+
+    def endElement(tag: str) -> None:
+        nonlocal depth
+        depth -= 1
+
+    parser = expat.ParserCreate(namespace_separator = "}")  # Tags in a namespace get reported as "namespace}tag".
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        raise ET.ParseError(str(e))  # The same error as ElementTree gives.
+
+
+##  Writes a document with a flat list of elements.
+#
+#   The output is the same as that of ElementTree after indenting the document.
+#   \param root_tag The tag of the root element.
+#   \param namespace The namespace of the document.
+#   \param elements For every element, its tag and its attributes in order.
+#   \param use_element_tree Whether to write the document with ElementTree.
+#   \return The document.
+def _serialize(root_tag: str, namespace: str, elements: List[Tuple[str, List[Tuple[str, str]]]], use_element_tree: bool) -> bytes:
+    if use_element_tree:
+        root = ET.Element(root_tag, xmlns = namespace)
+        for tag, attributes in elements:
+            ET.SubElement(root, tag, dict(attributes)).tail = "\n  "
+        if elements:
+            root.text = "\n  "
+            root[-1].tail = "\n"
+            root.tail = "\n"
+        return _xml_header.encode("utf-8") + ET.tostring(root)
+
+    if not elements:
+        return "{header}<{root} xmlns=\"{namespace}\" />".format(header = _xml_header, root = root_tag, namespace = namespace).encode("utf-8")
+    lines = ["{header}<{root} xmlns=\"{namespace}\">\n".format(header = _xml_header, root = root_tag, namespace = namespace)]
+    for tag, attributes in elements:
+        lines.append("  <" + tag)
+        for name, value in attributes:
+            if _special_characters.search(value):
+                value = value.translate(_escapes)
+            lines.append(" " + name + "=\"" + value + "\"")
+        lines.append(" />\n")
+    lines.append("</" + root_tag + ">\n")
+    return "".join(lines).encode("utf-8")
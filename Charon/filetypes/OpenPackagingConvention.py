@@ -1,57 +1,172 @@
 # Copyright (c) 2018 Ultimaker B.V.
 # libCharon is released under the terms of the LGPLv3 or higher.
-from collections import OrderedDict  # To specify the aliases in order.
-from io import BytesIO
+from collections import deque, OrderedDict  # To specify the aliases in order.
+from concurrent.futures import Future, ThreadPoolExecutor  # To render previews in the background.
+import copy  # To give every package its own copy of a cached G-code header.
+import functools  # To cache resolved aliases.
+import hashlib  # To recognise resources in the blob cache.
+import io
+from io import BytesIO, UnsupportedOperation
 import json  # The metadata format.
+import mmap  # To read ranges of the archive without copying them.
+import os  # To read ranges of the archive without moving the file pointer.
 import re  # To find the path aliases.
-from typing import Any, Dict, List, IO, Optional
-import xml.etree.ElementTree as ET  # For writing XML manifest files.
+import shutil  # To copy spooled resources into the archive.
+import tempfile  # To spool resources that are being written.
+import threading  # To read from multiple threads at the same time.
+import time  # To set the modification time of written resources.
+import zlib  # For the default compression level.
+from typing import Any, Callable, cast, Deque, Dict, Iterable, Iterator, List, IO, Optional, Pattern, Set, Tuple
 import zipfile
 
 from Charon.FileInterface import FileInterface  # The interface we're implementing.
 from Charon.OpenMode import OpenMode  # To detect whether we want to read and/or write to the file.
 from Charon.ReadOnlyError import ReadOnlyError  # To be thrown when trying to write while in read-only mode.
 from Charon.WriteOnlyError import WriteOnlyError  # To be thrown when trying to read while in write-only mode.
+from Charon.filetypes.BlobCache import BlobCache  # To share the data of resources between packages.
+from Charon.filetypes.DeflateSeekIndex import DeflateSeekIndex, SeekableDeflateStream  # To seek quickly in big compressed resources.
 from Charon.filetypes.GCodeFile import GCodeFile  # Required for fallback G-Code header parsing.
+from Charon.filetypes.LRUCache import LRUCache  # To cache resized images.
+from Charon.filetypes.MetadataIndex import MetadataIndex  # To find the metadata in a subtree quickly.
+from Charon.filetypes.OPCParts import ContentType, Relationship, parseContentTypes, parseRelationships, serializeContentTypes, serializeRelationships  # To read and write the content types and relations.
+from Charon.filetypes.ParallelDeflateWriter import ParallelDeflateWriter  # To compress resources on multiple threads.
+from Charon.filetypes.PngImage import PngImage  # To resize images if Qt is not available.
+from Charon.filetypes.WriteOptions import WriteOptions  # How to write packages.
+from Charon.filetypes.ZipInternals import ZipInternals  # To write compressed data directly to the archive.
 
 
 ##  A container file type that contains multiple 3D-printing related files that
 #   belong together.
 class OpenPackagingConvention(FileInterface):
     # Some constants related to this format.
-    _xml_header = ET.ProcessingInstruction("xml",
-                                           "version=\"1.0\" encoding=\"UTF-8\"")  # Header element being put atop every XML file.
     _content_types_file = "/[Content_Types].xml"  # Where the content types file is.
     _global_metadata_file = "/Metadata/OPC_Global.json"  # Where the global metadata file is.
     _opc_metadata_relationship_type = "http://schemas.ultimaker.org/package/2018/relationships/opc_metadata"  # Unique identifier of the relationship type that relates OPC metadata to files.
+    _opc_preview_relationship_type = "http://schemas.ultimaker.org/package/2018/relationships/opc_preview"  # Unique identifier of the relationship type that relates images to pre-rendered copies of them in other sizes.
+    _opc_seek_index_relationship_type = "http://schemas.ultimaker.org/package/2018/relationships/opc_seek_index"  # Unique identifier of the relationship type that relates compressed files to an index of where decompression can start.
     _metadata_prefix = "/metadata"
     _aliases = OrderedDict([])  # type: Dict[str, str]  # A standard OPC file doest not have default aliases. These must be implemented in inherited classes.
+    _default_compression = OrderedDict([])  # type: Dict[str, Tuple[int, Optional[int]]] # For regexes of virtual paths, the compression type and level to write them with. Anything else gets deflated with the default level.
+
+    _copy_chunk_size = 1024 * 1024  # How many bytes of compressed data to copy at a time when copying resources from another package.
+    _fallback_spool_threshold = 1024 * 1024  # With old Python versions, which can't stream resources into the archive, how much of a resource to keep in memory before spooling it to a temporary file.
 
     mime_type = "application/x-opc"
 
+    # Resized images, shared by all packages, keyed by the identity of the archive, the virtual path and CRC of the image and the requested size.
+    resized_image_cache = LRUCache(max_size=32 * 1024 * 1024)
+
+    # Whether to read and write the content types and relations with ElementTree, instead of the faster streaming parser and templates. The result is the same.
+    use_element_tree = False
+
     ##  Initialises the fields of this class.
     def __init__(self) -> None:
         self._mode = None  # type: Optional[OpenMode]        # Whether we're in read or write mode.
         self._stream = None  # type: Optional[IO[bytes]]       # The currently open stream.
         self._zipfile = None  # type: Optional[zipfile.ZipFile] # The zip interface to the currently open stream.
-        self._metadata = {}  # type: Dict[str, Any]            # The metadata in the currently open file.
-        self._content_types_element = None  # type: Optional[ET.Element] # An XML element holding all the content types.
-        self._relations = {}  # type: Dict[str, ET.Element]     # For each virtual path, a relations XML element (which is left out of the file if empty).
-        self._open_bytes_streams = {}  # type: Dict[str, IO[bytes]] # With old Python versions, the currently open BytesIO streams that need to be flushed, by their virtual path.
+        self._metadata = MetadataIndex()  # type: MetadataIndex # The metadata in the currently open file.
+        self._content_types = None  # type: Optional[List[ContentType]] # All the content types, in the order in which they're stored.
+        self._relations = {}  # type: Dict[str, List[Relationship]] # For each virtual path, the relations from it.
+        self._relation_index = {}  # type: Dict[str, Tuple[Set[str], Set[str]]] # For each origin that relations were added to, the targets and IDs of its relations, to find duplicates and free IDs without scanning the XML.
+        self._next_relation_id = {}  # type: Dict[str, int] # For each origin, the number from which to look for a free relation ID.
+        self._content_type_index = None  # type: Optional[Tuple[Set[str], Dict[str, str], Dict[str, str]]] # The extensions of the content types, the content type per lowercase extension and per overridden path. Built when first needed.
+        self._spool_threshold = 0  # When writing multiple streams at once, how much of every stream to keep in memory before spooling it to a temporary file.
+        self._spooled_streams = deque()  # type: Deque[SpooledWriteStream] # Streams that are yet to be written to the archive, in the order in which they were opened.
+        self._blob_cache = None  # type: Optional[BlobCache] # The cache with the data of resources that this package shares with other packages.
+        self._entries = {}  # type: Dict[str, str]              # For each virtual path of a resource in the archive, the name it has in the zip file.
+        self._png_entries = set()  # type: Set[str]             # The virtual paths of the PNG resources, which can also be requested resized.
+        self._map = None  # type: Optional[mmap.mmap]          # A memory map of the archive, if it is a file on disk that could be mapped.
+        self._map_attempted = False  # Whether we've already tried to create a memory map for the current stream.
+        self._parallel_writer = None  # type: Optional[ParallelDeflateWriter] # When compressing on multiple threads, the writer that does so.
+        self._compression_rules = []  # type: List[Tuple[str, str, int, Optional[int]]] # Compression set with setCompression, newest first: Whether it's for a "path" or "content_type", the path regex or MIME type, compression type and level.
+        self._unread_parts = OrderedDict()  # type: Dict[str, Callable[[], None]] # When opened lazily, the parts of the archive that haven't been read yet, with the function to read them.
+        self._preview_sizes = []  # type: List[Tuple[int, int]] # When writing, the sizes to pre-render every PNG image in.
+        self._preview_pool = None  # type: Optional[ThreadPoolExecutor] # The threads that render the previews.
+        self._pending_previews = []  # type: List[Tuple[str, str, Future]] # Previews that are being rendered: The image, the path of the preview and the rendered PNG data.
+        self._seek_index_interval = 0  # When writing, the distance between the checkpoints of the seek indices to store, or 0 to store none.
+        self._seek_indices = {}  # type: Dict[str, DeflateSeekIndex] # When reading, the seek indices of the big compressed resources that were opened, by their virtual path.
+        self._derived_metadata = set()  # type: Set[str] # Metadata keys that were derived from the resources instead of read from metadata files. These are not stored when changing the package.
+        self._concurrent = False  # Whether streams may be read on multiple threads at the same time.
+        self._lock = threading.RLock()  # In concurrent mode, guards the state that's shared by the streams, and the stream of the archive if it can't be read from at a position.
 
         # The zipfile module may only have one write stream open at a time. So when you open a new stream, close the previous one.
-        self._last_open_path = None  # type: Optional[str]
         self._last_open_stream = None  # type: Optional[IO[bytes]]
 
+    ##  Opens a stream for reading or writing.
+    #   \param stream The stream to read from or write to.
+    #   \param mime The MIME type of the stream.
+    #   \param mode The mode with which to open the file (see OpenMode).
+    #   \param lazy In read-only mode, only read the content types, relations
+    #   and metadata of the package when they are first needed. This makes
+    #   opening the package faster if you only need some resources from it.
+    #   \param concurrent In read-only mode, allow multiple threads to read
+    #   from the package at the same time. Every stream then reads the archive
+    #   independently, at its own position, instead of through the zip file,
+    #   and getting a stream doesn't close the previous one. All parts of the
+    #   package are read when it's opened, as if ``lazy`` is ``False``. The
+    #   streams must be closed before the package is closed.
+    #   \param blob_cache A cache to share the data of identical resources with
+    #   other packages. When reading, resources that fit in the cache are
+    #   decompressed once, and served from the cache by every package that
+    #   contains them. When writing, deflated resources are compressed once,
+    #   and the compressed data is taken from the cache by every package that
+    #   writes them. Those resources are spooled until they're complete. This
+    #   doesn't apply to resources that are compressed on multiple threads.
+    #   \param write_options How to write the package, when writing. If
+    #   ``None``, the package is written the default way.
+    #
+    #   In read-write mode, the existing resources can be read, and resources
+    #   and metadata can be changed. Only the changed resources and metadata
+    #   files are written, after the existing data, followed by a new central
+    #   directory that refers to them. The rest of the archive is left as it
+    #   is, so changing a bit of metadata is fast even if the toolpath is big.
+    #   The stream must be readable, writable and seekable for this.
     def openStream(self, stream: IO[bytes], mime: str = "application/x-opc",
-                   mode: OpenMode = OpenMode.ReadOnly) -> None:
+                   mode: OpenMode = OpenMode.ReadOnly, lazy: bool = False, concurrent: bool = False,
+                   blob_cache: Optional[BlobCache] = None, write_options: Optional[WriteOptions] = None) -> None:
+        if write_options is None or mode == OpenMode.ReadOnly:
+            write_options = WriteOptions()
         self._mode = mode
-        self._stream = stream  # A copy in case we need to rewind for toByteArray. We should mostly be reading via self._zipfile.
-        self._zipfile = zipfile.ZipFile(self._stream, self._mode.value, compression=zipfile.ZIP_DEFLATED)
-
-        self._readContentTypes()  # Load or create the content types element.
-        self._readRels()  # Load or create the relations.
-        self._readMetadata()  # Load the metadata, if any.
+        self._stream = stream  # A copy in case we need to read ranges for toByteArray. We should mostly be reading via self._zipfile.
+        self._map = None
+        self._map_attempted = False
+        if write_options.streaming and self._mode == OpenMode.WriteOnly:
+            stream = cast(IO[bytes], ForwardOnlyStream(stream))
+        self._zipfile = zipfile.ZipFile(stream, "a" if self._mode == OpenMode.ReadWrite else self._mode.value, compression=zipfile.ZIP_DEFLATED)
+        self._indexEntries()
+        self._derived_metadata = set()
+        self._spool_threshold = write_options.spool_threshold
+        self._spooled_streams = deque()
+        self._blob_cache = blob_cache
+        self._parallel_writer = None
+        self._seek_index_interval = 0
+        self._seek_indices = {}
+        if self._mode != OpenMode.ReadOnly and not ZipInternals.supportsRawEntries(self._zipfile):
+            pass  # This version of the zipfile module can't take compressed data. Everything is compressed by the zipfile module.
+        elif write_options.seek_index_interval > 0:
+            # Only the parallel writer can make the compressed data start at a byte boundary at every point in the index.
+            self._seek_index_interval = write_options.seek_index_interval
+            self._parallel_writer = ParallelDeflateWriter(self._zipfile, max(write_options.compression_threads, 1), block_size=self._seek_index_interval, record_checkpoints=True)
+        elif write_options.compression_threads > 0:
+            self._parallel_writer = ParallelDeflateWriter(self._zipfile, write_options.compression_threads)
+        self._preview_sizes = []
+        self._preview_pool = None
+        self._pending_previews = []
+        if write_options.preview_sizes:
+            self._preview_sizes = [(int(width), int(height)) for width, height in write_options.preview_sizes]
+            self._preview_pool = ThreadPoolExecutor(max_workers=min(len(self._preview_sizes), os.cpu_count() or 1))
+
+        self._unread_parts = OrderedDict([
+            ("content_types", self._readContentTypes),  # Load or create the content types element.
+            ("rels", self._readRels),  # Load or create the relations.
+            ("metadata", self._readMetadata)  # Load the metadata, if any.
+        ])
+        self._concurrent = concurrent and self._mode == OpenMode.ReadOnly
+        if not lazy or self._mode != OpenMode.ReadOnly or self._concurrent:  # Reading parts later could happen on multiple threads at once.
+            for part in list(self._unread_parts.keys()):
+                self._requirePart(part)
+        if self._concurrent:
+            self._getMap()  # Create it now, so that threads don't race to create it.
 
     def close(self) -> None:
         if not self._stream:
@@ -60,7 +175,14 @@ class OpenPackagingConvention(FileInterface):
             return
 
         self.flush()
+        if self._parallel_writer is not None:
+            self._parallel_writer.close()
+            self._parallel_writer = None
+        if self._preview_pool is not None:
+            self._preview_pool.shutdown()
+            self._preview_pool = None
         self._zipfile.close()
+        self._closeMap()
 
     def flush(self) -> None:
         if not self._stream:
@@ -70,14 +192,15 @@ class OpenPackagingConvention(FileInterface):
         if self._mode == OpenMode.ReadOnly:
             return  # No need to flush reading of zip archives as they are blocking calls.
 
-        if self._last_open_stream is not None and self._last_open_path not in self._open_bytes_streams:
+        if self._last_open_stream is not None:
             self._last_open_stream.close()
-
-        # If using old Python versions (<= 3.5), the write streams were kept in memory to be written all at once when flushing.
-        for virtual_path, stream in self._open_bytes_streams.items():
-            stream.seek(0)
-            self._zipfile.writestr(virtual_path, stream.read())
-            stream.close()
+        while self._spooled_streams:  # Closing them writes them to the archive, in order.
+            self._spooled_streams[0].outer.close()
+            self._commitSpooledStreams()
+        if self._parallel_writer is not None:
+            self._parallel_writer.drain()  # Everything must be written before we can write the metadata.
+        self._writeSeekIndices()
+        self._writePreviews()  # Previews add rels too.
 
         self._writeMetadata()  # Metadata must be updated first, because that adds rels and a content type.
         self._writeContentTypes()
@@ -86,8 +209,8 @@ class OpenPackagingConvention(FileInterface):
     def listPaths(self) -> List[str]:
         if not self._stream:
             raise ValueError("Can't list the paths in a closed file.")
-        paths = [self._zipNameToVirtualPath(zip_name) for zip_name in self._zipfile.namelist()]
-        return list(self._metadata.keys()) + paths
+        self._requirePart("metadata")
+        return list(self._metadata.keys()) + list(self._entries.keys())
 
     def getData(self, virtual_path: str) -> Dict[str, Any]:
         if not self._stream:
@@ -108,6 +231,17 @@ class OpenPackagingConvention(FileInterface):
 
         return result
 
+    def iterData(self, virtual_path: str, chunk_size: int = 1024 * 1024, offset: int = 0, count: int = -1) -> Iterator[bytes]:
+        if not self._stream:
+            raise ValueError("Can't get data from a closed file.")
+        if self._mode == OpenMode.WriteOnly:
+            raise WriteOnlyError(virtual_path)
+
+        canonical_path = self._processAliases(virtual_path)
+        if virtual_path.startswith(self._metadata_prefix) or not self._resourceExists(canonical_path):
+            return iter(())
+        return self._readChunks(self.getStream(canonical_path), chunk_size, offset, count)
+
     def setData(self, data: Dict[str, Any]) -> None:
         if not self._stream:
             raise ValueError("Can't change the data in a closed file.")
@@ -118,6 +252,11 @@ class OpenPackagingConvention(FileInterface):
                     self._metadata_prefix):  # Detect metadata by virtue of being in the Metadata folder.
                 self.setMetadata({virtual_path: value[len(self._metadata_prefix):]})
             else:  # Virtual file resources.
+                if self._mode == OpenMode.ReadWrite:  # Replace existing resources instead of reading them.
+                    canonical_path = self._processAliases(virtual_path)
+                    if canonical_path in self._entries:
+                        self._forgetEntry(self._entries.pop(canonical_path))
+                        self._png_entries.discard(canonical_path)
                 self.getStream(virtual_path).write(value)
 
     def getMetadata(self, virtual_path: str) -> Dict[str, Any]:
@@ -127,6 +266,7 @@ class OpenPackagingConvention(FileInterface):
 
         if self._mode == OpenMode.WriteOnly:
             raise WriteOnlyError(virtual_path)
+        self._requirePart("metadata")
         canonical_path = self._processAliases(virtual_path)
 
         # Find all metadata that begins with the specified virtual path!
@@ -134,21 +274,20 @@ class OpenPackagingConvention(FileInterface):
 
         if canonical_path in self._metadata:  # The exact match.
             result[self._metadata_prefix + virtual_path] = self._metadata[canonical_path]
-        for entry_path, value in self._metadata.items():
-            # We only want to match subdirectories of the provided virtual paths.
-            # So if you provide "/foo" then we don't want to match on "/foobar"
-            # but we do want to match on "/foo/zoo". This is why we check if they
-            # start with the provided virtual path plus a slash.
-            if entry_path.startswith(canonical_path + "/"):
-                # We need to return the originally requested alias, so replace the canonical path with the virtual path.
-                result[self._metadata_prefix + virtual_path + "/" + entry_path[len(canonical_path) + 1:]] = value
+        # We only want to match subdirectories of the provided virtual paths.
+        # So if you provide "/foo" then we don't want to match on "/foobar"
+        # but we do want to match on "/foo/zoo". This is why we look for keys
+        # that start with the provided virtual path plus a slash.
+        for entry_path in self._metadata.keysWithPrefix(canonical_path + "/"):
+            # We need to return the originally requested alias, so replace the canonical path with the virtual path.
+            result[self._metadata_prefix + virtual_path + "/" + entry_path[len(canonical_path) + 1:]] = self._metadata[entry_path]
 
         # If requesting the size of a file.
         if canonical_path.endswith("/size"):
             requested_resource = canonical_path[:-len("/size")]
-            if self._resourceExists(requested_resource):
+            if requested_resource in self._entries:
                 result[self._metadata_prefix + virtual_path] = self._zipfile.getinfo(
-                    requested_resource.strip("/")).file_size
+                    self._entries[requested_resource]).file_size
 
         return result
 
@@ -159,7 +298,12 @@ class OpenPackagingConvention(FileInterface):
             raise ReadOnlyError()
         metadata = {self._processAliases(virtual_path): metadata[virtual_path] for virtual_path in metadata}
         self._metadata.update(metadata)
+        self._derived_metadata.difference_update(metadata.keys())  # If it's set explicitly, it must be stored.
 
+    ##  Gets a stream to read or write a resource.
+    #
+    #   In read-write mode, this reads the resource if it exists, or creates it
+    #   if it doesn't. Use ``setData`` to replace existing resources.
     def getStream(self, virtual_path: str) -> IO[bytes]:
         if not self._stream:
             raise ValueError("Can't get a stream from a closed file.")
@@ -177,25 +321,47 @@ class OpenPackagingConvention(FileInterface):
             raise FileNotFoundError(virtual_path)
 
         # The zipfile module may only have one write stream open at a time. So when you open a new stream, close the previous one.
-        if self._last_open_stream is not None and self._last_open_path not in self._open_bytes_streams:  # Don't close streams that we still need to flush.
+        if self._last_open_stream is not None and not self._concurrent and not self._spool_threshold:
             self._last_open_stream.close()
 
         # If we are requesting a stream of an image resized, resize the image and return that.
-        if self._mode == OpenMode.ReadOnly and ".png/" in virtual_path:
+        if self._mode != OpenMode.WriteOnly and ".png/" in virtual_path:
             png_file = virtual_path[:virtual_path.find(".png/") + 4]
             size_spec = virtual_path[virtual_path.find(".png/") + 5:]
             if re.match(r"^\s*\d+\s*x\s*\d+\s*$", size_spec):
                 dimensions = []
                 for dimension in re.finditer(r"\d+", size_spec):
                     dimensions.append(int(dimension.group()))
-                return self._resizeImage(png_file, dimensions[0], dimensions[1])
-
-        self._last_open_path = virtual_path
-        try:  # If it happens to match some existing PNG file, we have to rescale that file and return the result.
-            self._last_open_stream = self._zipfile.open(virtual_path, self._mode.value, force_zip64=True)
-        except RuntimeError:  # Python 3.5 and before couldn't open resources in the archive in write mode.
-            self._last_open_stream = BytesIO()
-            self._open_bytes_streams[virtual_path] = self._last_open_stream  # Save this for flushing later.
+                return self._previewImage(png_file, dimensions[0], dimensions[1])
+
+        if self._concurrent:
+            return self._concurrentStream(virtual_path)
+
+        if self._mode == OpenMode.ReadOnly or (self._mode == OpenMode.ReadWrite and virtual_path in self._entries):
+            zip_info = self._zipfile.getinfo(self._entries[virtual_path])
+            cached = self._cachedData(zip_info)
+            if cached is not None:
+                self._last_open_stream = BytesIO(cached)
+            elif zip_info.compress_type == zipfile.ZIP_DEFLATED and not zip_info.flag_bits & 0x01 and self._hasSeekIndex(virtual_path, zip_info):  # Not encrypted.
+                self._last_open_stream = io.BufferedReader(SeekableDeflateStream(self._readRange, self._dataOffset(zip_info), zip_info, self._seek_indices[virtual_path]), buffer_size=SeekableDeflateStream.ChunkSize)
+            else:
+                self._last_open_stream = self._zipfile.open(zip_info, "r")
+            return self._last_open_stream
+
+        self._indexEntry(virtual_path)
+        if self._spool_threshold > 0:
+            self._last_open_stream = self._spool(virtual_path, self._spool_threshold)
+        elif self._cachesCompression(self._zipInfoFor(self._entries[virtual_path])):  # Needs to be complete to find it in the cache.
+            self._last_open_stream = self._spool(virtual_path, self._fallback_spool_threshold)
+        else:
+            try:
+                self._last_open_stream = self._openEntryStream(virtual_path)
+            except RuntimeError:  # Python 3.5 and before couldn't open resources in the archive in write mode. Write it once it's complete.
+                self._last_open_stream = self._spool(virtual_path, self._fallback_spool_threshold)
+
+        if self._preview_sizes and virtual_path.endswith(".png"):  # Render the previews of this image once it's complete.
+            image = bytearray()
+            return self._observeStream(self._last_open_stream, image.extend, lambda: self._renderPreviews(virtual_path, bytes(image)))
         return self._last_open_stream
 
     def toByteArray(self, offset: int = 0, count: int = -1) -> bytes:
@@ -203,16 +369,121 @@ class OpenPackagingConvention(FileInterface):
             raise ValueError("Can't get the bytes from a closed file.")
         if self._mode == OpenMode.WriteOnly:
             raise WriteOnlyError()
-        assert self._zipfile is not None
-        assert self._mode is not None
 
-        self._zipfile.close()  # Close the zipfile first so that we won't be messing with the stream without its consent.
+        with self.toMemoryView(offset, count) as view:
+            return view.tobytes()
 
-        self._stream.seek(offset)
-        result = self._stream.read(count)
+    ##  Gets a range of bytes of the file without copying it, if possible.
+    #
+    #   If the file is stored on disk, the result is a view on a memory map of
+    #   the file. Otherwise the bytes are read from the stream with a
+    #   positioned read, which doesn't disturb the open archive. Resources
+    #   inside the file are not supported by this method. Use ``getStream`` for
+    #   that.
+    #   \param offset The number of bytes to skip at the beginning of the file.
+    #   \param count The maximum number of bytes to return. If not specified,
+    #   the entire file will be returned except the initial offset.
+    #   \return A memory view of the bytes in the requested range.
+    def toMemoryView(self, offset: int = 0, count: int = -1) -> memoryview:
+        if not self._stream:
+            raise ValueError("Can't get the bytes from a closed file.")
+        if self._mode == OpenMode.WriteOnly:
+            raise WriteOnlyError()
 
-        self._zipfile = zipfile.ZipFile(self._stream, self._mode.value, compression=zipfile.ZIP_DEFLATED)
-        return result
+        file_map = self._getMap()
+        if file_map is not None:
+            end = len(file_map) if count < 0 else min(len(file_map), offset + count)
+            return memoryview(file_map)[offset:max(offset, end)]
+        return memoryview(self._readRange(offset, count))
+
+    ##  Sets how resources are compressed when they are written.
+    #
+    #   Compression that is set later takes precedence over compression that
+    #   was set earlier, and over the default compression of the file type.
+    #   Resources that don't match anything are deflated with the default
+    #   level.
+    #   \param compress_type The compression type, one of ``zipfile.ZIP_STORED``,
+    #   ``zipfile.ZIP_DEFLATED``, ``zipfile.ZIP_BZIP2`` and
+    #   ``zipfile.ZIP_LZMA``.
+    #   \param compress_level The compression level for deflate (0 to 9) or
+    #   bzip2 (1 to 9). If not provided, the default level is used.
+    #   \param path A regular expression that the virtual paths of the
+    #   resources to compress this way must match.
+    #   \param content_type The MIME type of the resources to compress this way,
+    #   as registered with ``addContentType``.
+    def setCompression(self, compress_type: int, compress_level: Optional[int] = None, path: Optional[str] = None, content_type: Optional[str] = None) -> None:
+        if (path is None) == (content_type is None):
+            raise ValueError("Specify either a path or a content type to set the compression for.")
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+            raise ValueError("Unknown compression type {compress_type}.".format(compress_type=compress_type))
+        if path is not None:
+            self._compression_rules.insert(0, ("path", path, compress_type, compress_level))
+        else:
+            self._compression_rules.insert(0, ("content_type", content_type, compress_type, compress_level))
+
+    ##  Copies resources from another package into this one, without
+    #   decompressing and compressing them again.
+    #
+    #   The compressed data and CRC of every resource are copied as they are.
+    #   The metadata of the resources is copied along, as are the relations
+    #   between the copied resources and their content types, if this package
+    #   doesn't have a content type for them yet.
+    #   \param other The package to copy from. It must be open for reading.
+    #   \param paths The virtual paths of the resources to copy. If not
+    #   provided, all resources are copied except for the relations, content
+    #   types and metadata files, which this package writes itself.
+    def copyEntriesFrom(self, other: "OpenPackagingConvention", paths: Optional[Iterable[str]] = None) -> None:
+        if not self._stream:
+            raise ValueError("Can't copy resources to a closed file.")
+        if not other._stream:
+            raise ValueError("Can't copy resources from a closed file.")
+        if self._mode == OpenMode.ReadOnly:
+            raise ReadOnlyError()
+        if other._mode == OpenMode.WriteOnly:
+            raise WriteOnlyError()
+        assert self._zipfile is not None
+        assert other._zipfile is not None
+        other._requirePart("metadata")  # Reads the relations as well.
+
+        if paths is None:
+            skipped = {other._content_types_file}
+            for relationships in other._relations.values():
+                for relationship in relationships:
+                    if relationship.type == other._opc_metadata_relationship_type:
+                        skipped.add(relationship.target)
+            copied = [virtual_path for virtual_path in other._entries if virtual_path not in skipped and "/_rels/" not in virtual_path]
+        else:
+            copied = []
+            for virtual_path in paths:
+                virtual_path = other._processAliases(virtual_path)
+                if virtual_path not in other._entries:
+                    raise FileNotFoundError(virtual_path)
+                copied.append(virtual_path)
+
+        # The zipfile module may only have one write stream open at a time, and we're going to write to the archive directly.
+        if self._last_open_stream is not None and not self._spool_threshold:
+            self._last_open_stream.close()
+            self._last_open_stream = None
+        if self._parallel_writer is not None:
+            self._parallel_writer.drain()
+
+        for virtual_path in copied:
+            with self._lock:  # Spooled streams that get closed in the meanwhile must wait.
+                self._copyEntry(other, virtual_path)
+            for metadata_key in other._metadata.keysWithPrefix(virtual_path + "/"):
+                if metadata_key not in other._derived_metadata:
+                    self._metadata[metadata_key] = other._metadata[metadata_key]
+                    self._derived_metadata.discard(metadata_key)
+            content_type = other._contentTypeOf(virtual_path)
+            extension = virtual_path[virtual_path.rfind(".") + 1:] if "." in virtual_path[virtual_path.rfind("/"):] else ""
+            if content_type and extension and not self._contentTypeOf(virtual_path):
+                self.addContentType(extension, content_type)
+
+        copied_set = set(copied)
+        for origin in copied_set & set(other._relations.keys()):
+            for relationship in other._relations[origin]:
+                if relationship.target in copied_set:
+                    self._ensureRelationExists(relationship.target, relationship.type, origin)
 
     ##  Adds a new content type to the archive.
     #   \param extension The file extension of the type
@@ -221,14 +492,16 @@ class OpenPackagingConvention(FileInterface):
             raise ValueError("Can't add a content type to a closed file.")
         if self._mode == OpenMode.ReadOnly:
             raise ReadOnlyError()
-        assert self._content_types_element is not None
+        assert self._content_types is not None
 
         # First check if it already exists.
-        for content_type in self._content_types_element.iterfind("Default"):
-            if "Extension" in content_type.attrib and content_type.attrib["Extension"] == extension:
-                raise OPCError("Content type for extension {extension} already exists.".format(extension=extension))
+        extensions, defaults, _ = self._contentTypeIndex()
+        if extension in extensions:
+            raise OPCError("Content type for extension {extension} already exists.".format(extension=extension))
 
-        ET.SubElement(self._content_types_element, "Default", Extension=extension, ContentType=mime_type)
+        self._content_types.append(ContentType("Default", extension, mime_type))
+        extensions.add(extension)
+        defaults[extension.lower()] = mime_type
 
     ##  Adds a relation concerning a file type.
     #   \param virtual_path The target file that the relation is about.
@@ -245,27 +518,84 @@ class OpenPackagingConvention(FileInterface):
         virtual_path = self._processAliases(virtual_path)
 
         # First check if it already exists.
-        if origin not in self._relations:
-            self._relations[origin] = ET.Element("Relationships",
-                                                 xmlns="http://schemas.openxmlformats.org/package/2006/relationships")
-        else:
-            for relationship in self._relations[origin].iterfind("Relationship"):
-                if "Target" in relationship.attrib and relationship.attrib["Target"] == virtual_path:
-                    raise OPCError("Relation for virtual path {target} already exists.".format(target=virtual_path))
-
-        # Find a unique name.
-        unique_id = 0
-        while True:
-            for relationship in self._relations[origin].iterfind("Relationship"):
-                if "Id" in relationship.attrib and relationship.attrib["Id"] == "rel" + str(unique_id):
-                    break
-            else:  # Unique ID didn't exist yet! It's safe to use
-                break
+        targets, ids = self._relationIndex(origin)
+        if virtual_path in targets:
+            raise OPCError("Relation for virtual path {target} already exists.".format(target=virtual_path))
+
+        # Find a unique name. IDs are handed out in increasing order, so only IDs that were already in the file need to be skipped.
+        unique_id = self._next_relation_id.get(origin, 0)
+        while "rel" + str(unique_id) in ids:
             unique_id += 1
+        self._next_relation_id[origin] = unique_id + 1
         unique_name = "rel" + str(unique_id)
 
         # Create the element itself.
-        ET.SubElement(self._relations[origin], "Relationship", Target=virtual_path, Type=relation_type, Id=unique_name)
+        self._relations[origin].append(Relationship(virtual_path, relation_type, unique_name, ""))
+        targets.add(virtual_path)
+        ids.add(unique_name)
+
+    ##  Gets a read-only memory map of the archive.
+    #
+    #   The map is only created once. If the stream is not a file on disk or
+    #   can't be mapped for another reason, no map is created.
+    #   \return A memory map of the archive, or ``None`` if it can't be mapped.
+    def _getMap(self) -> Optional[mmap.mmap]:
+        if not self._map_attempted and self._mode == OpenMode.ReadOnly:  # If the archive can change, the map would get outdated.
+            self._map_attempted = True
+            try:
+                self._map = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, UnsupportedOperation):  # Not a file, or an empty file.
+                self._map = None
+        return self._map
+
+    ##  Releases the memory map of the archive, if any.
+    def _closeMap(self) -> None:
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:  # Someone still holds a view on the map. It'll be closed when that view is released.
+                pass
+            self._map = None
+        self._map_attempted = False
+
+    ##  Reads a range of bytes from the archive, without moving the file pointer
+    #   that the zip archive uses.
+    #   \param offset The position in the archive to start reading.
+    #   \param count The maximum number of bytes to read, or -1 to read up to
+    #   the end of the archive.
+    #   \return The bytes in the requested range.
+    def _readRange(self, offset: int, count: int) -> bytes:
+        assert self._stream is not None
+
+        if self._map is not None:
+            return self._map[offset:] if count < 0 else self._map[offset:offset + count]
+        try:
+            file_descriptor = self._stream.fileno()
+        except (AttributeError, OSError, UnsupportedOperation):
+            file_descriptor = -1
+        if file_descriptor >= 0 and hasattr(os, "pread"):
+            if count < 0:
+                count = max(0, os.fstat(file_descriptor).st_size - offset)
+            return os.pread(file_descriptor, count, offset)
+
+        # The zip archive keeps track of its own position when reading, so we only need to put the stream back for any other users.
+        with self._lock:
+            original_position = self._stream.tell()
+            try:
+                self._stream.seek(offset)
+                return self._stream.read(count)
+            finally:
+                self._stream.seek(original_position)
+
+    ##  Makes sure that a part of the archive has been read.
+    #
+    #   If the archive was opened lazily, this reads the part if it hasn't been
+    #   read yet. Otherwise this does nothing.
+    #   \param part The part to read: "content_types", "rels" or "metadata".
+    def _requirePart(self, part: str) -> None:
+        read_function = self._unread_parts.pop(part, None)
+        if read_function is not None:
+            read_function()
 
     ##  Figures out if a resource exists in the archive.
     #
@@ -274,18 +604,37 @@ class OpenPackagingConvention(FileInterface):
     #   \return ``True`` if it exists as a normal resource, or ``False`` if it
     #   doesn't.
     def _resourceExists(self, virtual_path: str) -> bool:
+        if virtual_path in self._entries:
+            return True
+        png_end = virtual_path.find(".png/")
+        if png_end >= 0 and virtual_path[:png_end + 4] in self._png_entries:  # We can rescale PNG images if you want.
+            if re.match(r"^\s*\d+\s*x\s*\d+\s*$", virtual_path[png_end + 5:]):  # Matches the form "NxM" with optional whitespace.
+                return True
+        return False
+
+    ##  Builds the index of the resources in the archive from its central
+    #   directory.
+    #
+    #   This is done once when opening the archive, so that finding a resource
+    #   doesn't require going through all of the names in the archive.
+    def _indexEntries(self) -> None:
         assert self._zipfile is not None
 
+        self._entries = {}
+        self._png_entries = set()
         for zip_name in self._zipfile.namelist():
-            zip_virtual_path = self._zipNameToVirtualPath(zip_name)
-            if virtual_path == zip_virtual_path:
-                return True
-            if zip_virtual_path.endswith(".png") and virtual_path.startswith(
-                    zip_virtual_path + "/"):  # We can rescale PNG images if you want.
-                if re.match(r"^\s*\d+\s*x\s*\d+\s*$", virtual_path[len(
-                        zip_virtual_path) + 1:]):  # Matches the form "NxM" with optional whitespace.
-                    return True
-        return False
+            self._indexEntry(zip_name)
+
+    ##  Adds a single resource to the index of resources in the archive.
+    #
+    #   This needs to be called for every resource that gets written, to keep
+    #   the index in sync with the archive.
+    #   \param zip_name The name of the resource in the zip file.
+    def _indexEntry(self, zip_name: str) -> None:
+        virtual_path = self._zipNameToVirtualPath(zip_name)
+        self._entries[virtual_path] = zip_name
+        if virtual_path.endswith(".png"):
+            self._png_entries.add(virtual_path)
 
     ##  Dereference the aliases for OPC files.
     #
@@ -293,18 +642,28 @@ class OpenPackagingConvention(FileInterface):
     #   yet, to allow referencing virtual paths with or without the initial
     #   slash.
     def _processAliases(self, virtual_path: str) -> str:
-        if not virtual_path.startswith("/"):
-            virtual_path = "/" + virtual_path
+        return _resolveAliases(self._compiledAliases(), virtual_path)
 
-        # Replace all aliases.
-        for regex, replacement in self._aliases.items():
-            if regex.startswith("/"):
-                expression = r"^" + regex
-            else:
-                expression = regex
-            virtual_path = re.sub(expression, replacement, virtual_path)
-
-        return virtual_path
+    ##  Gets the aliases of this file type as compiled regular expressions.
+    #
+    #   The aliases are compiled only once for every class, or for every
+    #   instance if the instance has its own aliases. The aliases dictionary is
+    #   not expected to change after its first use. To change the aliases,
+    #   assign a new dictionary instead.
+    #   \return A tuple of compiled regular expressions along with their
+    #   replacements, in the order in which they must be applied.
+    def _compiledAliases(self) -> Tuple[Tuple[Pattern, str], ...]:
+        owner = self if "_aliases" in self.__dict__ else type(self)  # Whoever has the aliases holds the compiled version as well.
+        compiled = owner.__dict__.get("_compiled_aliases")
+        if compiled is None or compiled[0] is not self._aliases:
+            table = []
+            for regex, replacement in self._aliases.items():
+                if regex.startswith("/"):
+                    regex = r"^" + regex
+                table.append((re.compile(regex), replacement))
+            compiled = (self._aliases, tuple(table))
+            setattr(owner, "_compiled_aliases", compiled)
+        return compiled[1]
 
     ##  Convert the resource name inside the zip to a virtual path as this
     #   library specifies it should be.
@@ -325,57 +684,213 @@ class OpenPackagingConvention(FileInterface):
     #   \return A bytes stream representing a new PNG image with the desired
     #   width and height.
     def _resizeImage(self, virtual_path: str, width: int, height: int) -> IO[bytes]:
-        input = self.getStream(virtual_path)
+        assert self._zipfile is not None
+
+        cache_key = (self._archiveIdentity(), virtual_path, self._zipfile.getinfo(self._entries[virtual_path]).CRC, width, height)
+        cached = self.resized_image_cache.get(cache_key)
+        if cached is not None:
+            return BytesIO(cached)
+
+        result = self._resizePng(self.getStream(virtual_path).read(), width, height)
+        self.resized_image_cache.put(cache_key, result)
+        return BytesIO(result)
+
+    ##  Resizes a PNG image, with Qt if it's available.
+    #   \param data The PNG image to resize.
+    #   \param width The desired width of the image.
+    #   \param height The desired height of the image.
+    #   \return A PNG image of the desired width and height.
+    @staticmethod
+    def _resizePng(data: bytes, width: int, height: int) -> bytes:
         try:
             from PyQt5.QtGui import QImage
             from PyQt5.QtCore import Qt, QBuffer
 
             image = QImage()
-            image.loadFromData(input.read())
+            image.loadFromData(data)
             image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
             output_buffer = QBuffer()
             output_buffer.open(QBuffer.ReadWrite)
             image.save(output_buffer, "PNG")
             output_buffer.seek(0)  # Reset that buffer so that the next guy can request it.
-            return BytesIO(output_buffer.readAll())
-        except ImportError:
-            # TODO: Try other image loaders.
-            raise  # Raise import error again if we find no other image loaders.
+            return bytes(output_buffer.readAll())
+        except ImportError:  # No Qt. Use our own PNG implementation.
+            return PngImage.resize(data, width, height)
+
+    ##  Gets an image in a certain size, from the pre-rendered previews of the
+    #   image if possible.
+    #
+    #   If a preview of exactly the requested size is stored in the archive,
+    #   that one is returned as it is. Otherwise the smallest stored image that
+    #   is at least as big as requested is resized, which is the original image
+    #   if there are no big enough previews.
+    #   \param virtual_path The virtual path of the original image.
+    #   \param width The desired width of the image.
+    #   \param height The desired height of the image.
+    #   \return A bytes stream representing a PNG image with the desired width
+    #   and height.
+    def _previewImage(self, virtual_path: str, width: int, height: int) -> IO[bytes]:
+        self._requirePart("rels")
+        source = virtual_path
+        source_area = None  # type: Optional[int]
+        if virtual_path in self._relations:
+            for relationship in self._relations[virtual_path]:
+                if relationship.type != self._opc_preview_relationship_type or relationship.target not in self._entries:
+                    continue
+                target = relationship.target
+                size_match = re.search(r"_(\d+)x(\d+)\.png$", target)
+                if not size_match:
+                    continue
+                preview_width, preview_height = int(size_match.group(1)), int(size_match.group(2))
+                if (preview_width, preview_height) == (width, height):
+                    return self.getStream(target)
+                if preview_width >= width and preview_height >= height and (source_area is None or preview_width * preview_height < source_area):
+                    source = target
+                    source_area = preview_width * preview_height
+        return self._resizeImage(source, width, height)
+
+    ##  Gets a stream to read a resource with, in concurrent mode.
+    #
+    #   The stream reads the archive at its own position, so it doesn't affect
+    #   any other streams.
+    #   \param virtual_path The virtual path of the resource.
+    #   \return A stream of the resource.
+    def _concurrentStream(self, virtual_path: str) -> IO[bytes]:
+        assert self._zipfile is not None
+
+        zip_info = self._zipfile.getinfo(self._entries[virtual_path])
+        cached = self._cachedData(zip_info)
+        if cached is not None:
+            return BytesIO(cached)
+        if zip_info.flag_bits & 0x01 or zip_info.compress_type not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):  # Encrypted, or compressed with something we can't read ourselves.
+            with self._lock:
+                return self._zipfile.open(zip_info, "r")  # The zip file can have multiple streams open for reading, and those take turns with a lock.
+        data_offset = self._dataOffset(zip_info)
+        if zip_info.compress_type == zipfile.ZIP_STORED:
+            return io.BufferedReader(StoredEntryStream(self._readRange, data_offset, zip_info), buffer_size=SeekableDeflateStream.ChunkSize)
+        with self._lock:
+            if self._hasSeekIndex(virtual_path, zip_info):
+                index = self._seek_indices[virtual_path]
+            else:
+                index = DeflateSeekIndex(zip_info.CRC, zip_info.file_size)  # Too small to share. Just for seeking in this stream.
+        return io.BufferedReader(SeekableDeflateStream(self._readRange, data_offset, zip_info, index), buffer_size=SeekableDeflateStream.ChunkSize)
+
+    ##  Gets the data of a resource from the blob cache.
+    #
+    #   If it's not in the cache yet, it's read and stored there, together with
+    #   its compressed data if it's deflated, as long as it fits. The data is
+    #   cached with the SHA-256 of the resource as it's stored in the archive,
+    #   which can be computed without decompressing it, so that a different
+    #   resource with the same CRC-32 and size doesn't get the cached data.
+    #   \param zip_info The resource in the zip file.
+    #   \return The data of the resource, or ``None`` if there is no cache or
+    #   the resource doesn't fit in it.
+    def _cachedData(self, zip_info: zipfile.ZipInfo) -> Optional[bytes]:
+        assert self._zipfile is not None
+
+        if self._blob_cache is None or zip_info.flag_bits & 0x01 or zip_info.file_size > self._blob_cache.size_limit:  # Encrypted or too big.
+            return None
+        stored_data = self._readRange(self._dataOffset(zip_info), zip_info.compress_size)
+        stored_sha256 = hashlib.sha256(stored_data).digest()
+        result = self._blob_cache.get("data", zip_info.CRC, zip_info.file_size, stored_sha256)
+        if result is not None:
+            return result
+
+        with self._lock:
+            result = self._zipfile.open(zip_info, "r").read()
+        self._blob_cache.put("data", zip_info.CRC, zip_info.file_size, result, sha256=stored_sha256)
+        if zip_info.compress_type == zipfile.ZIP_DEFLATED:  # Packages that write this resource can use its compressed data.
+            sha256 = hashlib.sha256(result).digest()  # Packages that write it only know the SHA-256 of the data.
+            if self._blob_cache.get("deflated", zip_info.CRC, zip_info.file_size, sha256) is None:
+                self._blob_cache.put("deflated", zip_info.CRC, zip_info.file_size, stored_data, sha256=sha256)
+        return result
+
+    ##  Finds out whether resources are written through the blob cache.
+    #   \param zip_info The resource to write.
+    #   \return Whether the compressed data of the resource can be taken from
+    #   or stored in the cache.
+    def _cachesCompression(self, zip_info: zipfile.ZipInfo) -> bool:
+        return self._blob_cache is not None and self._parallel_writer is None and zip_info.compress_type == zipfile.ZIP_DEFLATED and ZipInternals.supportsRawEntries(self._zipfile)
+
+    ##  Finds out whether a resource is big enough to need a seek index, and
+    #   if so, loads its index from the archive or creates an empty one.
+    #   \param virtual_path The virtual path of the resource.
+    #   \param zip_info The resource in the zip file.
+    #   \return Whether the resource has a seek index.
+    def _hasSeekIndex(self, virtual_path: str, zip_info: zipfile.ZipInfo) -> bool:
+        if virtual_path in self._seek_indices:
+            return True
+
+        self._requirePart("rels")
+        index = None  # type: Optional[DeflateSeekIndex]
+        for relationship in self._relations.get(virtual_path, []):
+            if relationship.type == self._opc_seek_index_relationship_type and relationship.target in self._entries:
+                try:
+                    index = DeflateSeekIndex.parse(self._zipfile.read(self._entries[relationship.target]))
+                except ValueError:  # Corrupt index. Build a new one.
+                    continue
+                if (index.crc, index.file_size) != (zip_info.CRC, zip_info.file_size):  # Index of a different version of the resource.
+                    index = None
+                    continue
+                break
+        if index is None:
+            if zip_info.file_size <= DeflateSeekIndex.DefaultInterval:  # Small enough to decompress from the start every time.
+                return False
+            index = DeflateSeekIndex(zip_info.CRC, zip_info.file_size)
+        self._seek_indices[virtual_path] = index
+        return True
+
+    ##  Finds where the data of a resource starts in the archive.
+    #   \param zip_info The resource in the zip file.
+    #   \return The position in the archive of the first byte of its data.
+    def _dataOffset(self, zip_info: zipfile.ZipInfo) -> int:
+        return ZipInternals.dataOffset(zip_info, self._readRange)
+
+    ##  Gets something that identifies the archive that is open, for use in
+    #   caches that are shared between packages.
+    #
+    #   If the archive is a file, this is its path, so that it's recognised
+    #   when the same file is opened again.
+    def _archiveIdentity(self) -> Any:
+        name = getattr(self._stream, "name", None)
+        if isinstance(name, str):
+            return os.path.abspath(name)
+        return id(self._stream)
 
     #### Below follow some methods to read/write components of the archive. ####
 
     ##  When loading a file, load the relations from the archive.
     #
-    #   If the relations are missing, empty elements are created.
+    #   If the relations are missing, an empty list is created for the root.
     def _readRels(self) -> None:
         assert self._zipfile is not None
 
-        self._relations[""] = ET.Element("Relationships",
-                                         xmlns="http://schemas.openxmlformats.org/package/2006/relationships")  # There must always be a global relationships document.
+        self._relation_index = {}
+        self._next_relation_id = {}
+        self._relations[""] = []  # There must always be a global relationships document.
 
         # Below is some parsing of paths and extensions.
         # Normally you'd use os.path for this. But this is platform-dependent.
         # For instance, the path separator in Windows is a backslash, but zipfile still uses a slash on Windows.
         # So instead we have custom implementations here. Sorry.
 
-        for virtual_path in self._zipfile.namelist():
-            virtual_path = self._zipNameToVirtualPath(virtual_path)
+        for virtual_path, zip_name in list(self._entries.items()):
             if not virtual_path.endswith(".rels"):  # We only want to read rels files.
                 continue
             directory = virtual_path[:virtual_path.rfind("/")]  # Before the last slash.
             if directory != "_rels" and not directory.endswith("/_rels"):  # Rels files must be in a directory _rels.
                 continue
 
-            document = ET.fromstring(self._zipfile.open(virtual_path).read())
+            relationships = parseRelationships(self._zipfile.open(zip_name).read(), self.use_element_tree)
 
             # Find out what file or directory this relation is about.
             origin_filename = virtual_path[virtual_path.rfind("/") + 1:-len(
                 ".rels")]  # Just the filename (no path) and without .rels extension.
             origin_directory = directory[
                                :-len("/_rels")]  # The parent path. We already know it's in the _rels directory.
-            origin = (origin_directory + "/" if (origin_directory != "") else "") + origin_filename
+            origin = (origin_directory + "/" + origin_filename) if origin_filename != "" else ""  # Files in the root get a slash in front too, like all virtual paths.
 
-            self._relations[origin] = document
+            self._relations[origin] = relationships
 
     ##  At the end of writing a file, write the relations to the archive.
     #
@@ -388,7 +903,7 @@ class OpenPackagingConvention(FileInterface):
         # For instance, the path separator in Windows is a backslash, but zipfile still uses a slash on Windows.
         # So instead we have custom implementations here. Sorry.
 
-        for origin, element in self._relations.items():
+        for origin, relationships in self._relations.items():
             # Find out where to store the rels file.
             if "/" not in origin:  # Is in root.
                 origin_directory = ""
@@ -398,31 +913,22 @@ class OpenPackagingConvention(FileInterface):
                 origin_filename = origin[origin.rfind("/") + 1:]
             relations_file = origin_directory + "/_rels/" + origin_filename + ".rels"
 
-            self._indent(element)
-            self._zipfile.writestr(relations_file, ET.tostring(self._xml_header) + b"\n" + ET.tostring(element))
+            self._writeEntryData(relations_file, serializeRelationships(relationships, self.use_element_tree))
 
     ##  When loading a file, load the content types from the archive.
     #
-    #   If the content types are missing, an empty element is created.
+    #   If the content types are missing, an empty list is created.
     def _readContentTypes(self) -> None:
         assert self._zipfile is not None
 
-        if self._content_types_file in self._zipfile.namelist():
-            content_types_element = ET.fromstring(self._zipfile.open(self._content_types_file).read())
-            if content_types_element:
-                self._content_types_element = content_types_element
-        if not self._content_types_element:
-            self._content_types_element = ET.Element("Types",
-                                                     xmlns="http://schemas.openxmlformats.org/package/2006/content-types")
+        self._content_type_index = None
+
+        self._content_types = []
+        if self._content_types_file in self._entries:
+            self._content_types = parseContentTypes(self._zipfile.open(self._entries[self._content_types_file]).read(), self.use_element_tree)
         # If there is no type for the .rels file, create it.
-        if self._mode != OpenMode.ReadOnly:
-            for type_element in self._content_types_element.iterfind(
-                    "{http://schemas.openxmlformats.org/package/2006/content-types}Default"):
-                if "Extension" in type_element.attrib and type_element.attrib["Extension"] == "rels":
-                    break
-            else:
-                ET.SubElement(self._content_types_element, "Default", Extension="rels",
-                              ContentType="application/vnd.openxmlformats-package.relationships+xml")
+        if self._mode != OpenMode.ReadOnly and "rels" not in self._contentTypeIndex()[0]:
+            self.addContentType(extension="rels", mime_type="application/vnd.openxmlformats-package.relationships+xml")
 
     ##  At the end of writing a file, write the content types to the archive.
     #
@@ -430,31 +936,29 @@ class OpenPackagingConvention(FileInterface):
     #   content types are known.
     def _writeContentTypes(self) -> None:
         assert self._zipfile is not None
-        assert self._content_types_element is not None
+        assert self._content_types is not None
 
-        self._indent(self._content_types_element)
-        self._zipfile.writestr(self._content_types_file,
-                               ET.tostring(self._xml_header) + b"\n" + ET.tostring(self._content_types_element))
+        self._writeEntryData(self._content_types_file, serializeContentTypes(self._content_types, self.use_element_tree))
 
     ##  When loading a file, read its metadata from the archive.
     #
+    #   If the package has a toolpath without metadata, the metadata is taken
+    #   from its header, with ``_readToolpathHeader``.
+    #
     #   This depends on the relations! Read the relations first!
     def _readMetadata(self) -> None:
         assert self._zipfile is not None
+        self._requirePart("rels")
 
-        for origin, relations_element in self._relations.items():
-            for relationship in relations_element.iterfind(
-                    "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"):
-                if "Target" not in relationship.attrib or "Type" not in relationship.attrib:  # These two are required, and we actually need them here. Better ignore this one.
+        for origin, relationships in self._relations.items():
+            for relationship in relationships:
+                if relationship.type != self._opc_metadata_relationship_type:  # Not interested in this one. It's not metadata that we recognise.
                     continue
-                if relationship.attrib[
-                    "Type"] != self._opc_metadata_relationship_type:  # Not interested in this one. It's not metadata that we recognise.
-                    continue
-                metadata_file = relationship.attrib["Target"]
-                if metadata_file not in self._zipfile.namelist():  # The metadata file is unknown to us.
+                metadata_file = relationship.target
+                if metadata_file not in self._entries:  # The metadata file is unknown to us.
                     continue
 
-                metadata = json.loads(self._zipfile.open(metadata_file).read().decode("utf-8"))
+                metadata = json.loads(self._zipfile.open(self._entries[metadata_file]).read().decode("utf-8"))
                 if metadata_file == self._global_metadata_file:  # Store globals as if coming from root.
                     metadata_file = ""
                 elif metadata_file.endswith(
@@ -462,16 +966,33 @@ class OpenPackagingConvention(FileInterface):
                     metadata_file = metadata_file[:-len(".json")]
                 self._readMetadataElement(metadata, metadata_file)
 
-        if self._mode != OpenMode.WriteOnly and not self.getMetadata("/3D/model.gcode"):
-            try:
-                # Check if the G-code file actually exists in the package.
-                self._zipfile.getinfo("/3D/model.gcode")
-            except KeyError:
-                return
+        self._readToolpathHeader()
 
-            gcode_stream = self._zipfile.open("/3D/model.gcode")
-            header_data = GCodeFile.parseHeader(gcode_stream, prefix="/3D/model.gcode/")
-            self._metadata.update(header_data)
+    ##  Takes the metadata of the toolpath at ``/3D/model.gcode`` from its
+    #   G-code header, if the toolpath has no metadata in the archive.
+    #
+    #   The metadata is stored as nested dictionaries under the top-level keys
+    #   of the header, the same as ``GCodeFile.parseHeader`` gives them. It's
+    #   not stored again when changing the package.
+    def _readToolpathHeader(self) -> None:
+        assert self._zipfile is not None
+
+        if self._mode == OpenMode.WriteOnly or "/3D/model.gcode" not in self._entries or self._hasToolpathMetadata():
+            return
+        zip_info = self._zipfile.getinfo(self._entries["/3D/model.gcode"])
+        header_data = self._blob_cache.get("G-code header", zip_info.CRC, zip_info.file_size) if self._blob_cache is not None else None
+        if header_data is None:
+            header_data = GCodeFile.parseHeader(self._zipfile.open(zip_info), prefix="/3D/model.gcode/")
+            if self._blob_cache is not None:  # Other packages with the same toolpath don't need to parse it again.
+                self._blob_cache.put("G-code header", zip_info.CRC, zip_info.file_size, header_data, size=len(json.dumps(header_data)))
+        header_data = copy.deepcopy(header_data)  # Don't share the nested dictionaries with other packages.
+        self._metadata.update(header_data)
+        self._derived_metadata.update(header_data.keys())
+
+    ##  Checks whether there is metadata about the toolpath.
+    #   \return ``True`` if there is such metadata, or ``False`` if there isn't.
+    def _hasToolpathMetadata(self) -> bool:
+        return "/3D/model.gcode" in self._metadata or len(self._metadata.keysWithPrefix("/3D/model.gcode/")) > 0
 
     ##  Reads a single node of metadata from a JSON document (recursively).
     #   \param element The node in the JSON document to read.
@@ -493,25 +1014,26 @@ class OpenPackagingConvention(FileInterface):
         assert self._zipfile is not None
 
         keys_left = set(
-            self._metadata.keys())  # The keys that are not associated with a particular file (global metadata).
+            self._metadata.keys()) - self._derived_metadata  # The keys that are not associated with a particular file (global metadata).
         metadata_per_file = {}  # type: Dict[str, Dict[str, Any]]
-        for file_name in self._zipfile.namelist():
+        for file_name in self._entries.values():
             metadata_per_file[file_name] = {}
-            for metadata_key in self._metadata:
-                if metadata_key.startswith(file_name + "/"):
-                    # Strip the prefix: "/a/b/c.stl/print_time" becomes just "print_time" about the file "/a/b/c.stl".
-                    metadata_per_file[file_name][metadata_key[len(file_name) + 1:]] = self._metadata[metadata_key]
-                    keys_left.remove(metadata_key)
+            for metadata_key in self._metadata.keysWithPrefix(file_name + "/"):
+                if metadata_key in self._derived_metadata:
+                    continue
+                # Strip the prefix: "/a/b/c.stl/print_time" becomes just "print_time" about the file "/a/b/c.stl".
+                metadata_per_file[file_name][metadata_key[len(file_name) + 1:]] = self._metadata[metadata_key]
+                keys_left.discard(metadata_key)
         # keys_left now contains only global metadata keys.
 
         global_metadata = {key: self._metadata[key] for key in keys_left}
         if len(global_metadata) > 0:
             self._writeMetadataToFile(global_metadata, self._global_metadata_file)
-            self.addRelation(self._global_metadata_file, self._opc_metadata_relationship_type)
+            self._ensureRelationExists(self._global_metadata_file, self._opc_metadata_relationship_type, "")
         for file_name, metadata in metadata_per_file.items():
             if len(metadata) > 0:
                 self._writeMetadataToFile(metadata, file_name + ".json")
-                self.addRelation(file_name + ".json", self._opc_metadata_relationship_type)
+                self._ensureRelationExists(file_name + ".json", self._opc_metadata_relationship_type, "")
         if len(self._metadata) > 0:  # If we've written any metadata at all, we must include the content type as well.
             try:
                 self.addContentType(extension="json", mime_type="text/json")
@@ -550,7 +1072,311 @@ class OpenPackagingConvention(FileInterface):
                 assert "" in current_element
                 parent[path[-1]] = current_element[""]  # Fold down the singleton dictionary.
 
-        self._zipfile.writestr(file_name, json.dumps(document, sort_keys=True, indent=4))
+        self._writeEntryData(file_name, json.dumps(document, sort_keys=True, indent=4).encode("UTF-8"))
+
+    ##  Starts rendering the previews of an image that was written, in the
+    #   background.
+    #   \param virtual_path The virtual path of the image.
+    #   \param data The PNG image.
+    def _renderPreviews(self, virtual_path: str, data: bytes) -> None:
+        assert self._preview_pool is not None
+
+        for width, height in self._preview_sizes:
+            preview_path = self._previewPath(virtual_path, width, height)
+            self._pending_previews.append((virtual_path, preview_path, self._preview_pool.submit(self._resizePng, data, width, height)))
+
+    ##  Writes the seek indices of the resources that were written in blocks
+    #   since the last flush, along with relations from the resources to them.
+    def _writeSeekIndices(self) -> None:
+        if self._seek_index_interval <= 0:
+            return
+        assert self._zipfile is not None
+        assert self._parallel_writer is not None
+
+        for zip_name, checkpoints in self._parallel_writer.checkpoints.items():
+            zip_info = self._zipfile.getinfo(zip_name)
+            index = DeflateSeekIndex(zip_info.CRC, zip_info.file_size, self._seek_index_interval)
+            for offset, compressed_offset, window in checkpoints:
+                index.add(offset, compressed_offset, window)
+            virtual_path = self._zipNameToVirtualPath(zip_name)
+            self._writeEntryData(virtual_path + ".seekindex", index.serialize())
+            self._ensureRelationExists(virtual_path + ".seekindex", self._opc_seek_index_relationship_type, virtual_path)
+        self._parallel_writer.checkpoints = {}
+
+    ##  Writes the previews that were rendered to the archive, along with
+    #   relations from the original images to them.
+    def _writePreviews(self) -> None:
+        for virtual_path, preview_path, rendering in self._pending_previews:
+            self._writeEntryData(preview_path, rendering.result())
+            self._ensureRelationExists(preview_path, self._opc_preview_relationship_type, virtual_path)
+        self._pending_previews = []
+
+    ##  Gets the virtual path to store a preview of an image at.
+    #
+    #   Previews are stored in the metadata directory, in the same relative
+    #   directory as the image itself.
+    #   \param virtual_path The virtual path of the image.
+    #   \param width The width of the preview.
+    #   \param height The height of the preview.
+    #   \return The virtual path for the preview.
+    def _previewPath(self, virtual_path: str, width: int, height: int) -> str:
+        directory = virtual_path[:virtual_path.rfind("/")]
+        file_name = virtual_path[virtual_path.rfind("/") + 1:-len(".png")]
+        if directory != "/Metadata" and not directory.startswith("/Metadata/"):
+            directory = "/Metadata" + directory
+        return "{directory}/{file_name}_{width}x{height}.png".format(directory=directory, file_name=file_name, width=width, height=height)
+
+    ##  Writes a complete resource to the archive at once, and adds it to the
+    #   index of resources.
+    #   \param zip_name The name of the resource in the zip file.
+    #   \param data The contents of the resource.
+    def _writeEntryData(self, zip_name: str, data: bytes) -> None:
+        assert self._zipfile is not None
+
+        try:
+            existing = self._zipfile.getinfo(zip_name)
+            if existing.file_size == len(data) and existing.CRC == zlib.crc32(data):
+                return  # Already in the archive like this. Happens when changing a package, or when flushing twice.
+        except KeyError:  # Not in the archive yet.
+            pass
+        self._forgetEntry(zip_name)
+        self._zipfile.writestr(self._zipInfoFor(zip_name), data)
+        self._indexEntry(zip_name)
+
+    ##  Copies the compressed data of a single resource from another package.
+    #   \param other The package to copy from.
+    #   \param virtual_path The virtual path of the resource to copy.
+    def _copyEntry(self, other: "OpenPackagingConvention", virtual_path: str) -> None:
+        assert self._zipfile is not None
+        assert other._zipfile is not None
+
+        source_info = other._zipfile.getinfo(other._entries[virtual_path])
+        if source_info.flag_bits & 0x01:
+            raise OPCError("Can't copy encrypted resource {virtual_path}.".format(virtual_path=virtual_path))
+        zip_info = zipfile.ZipInfo(virtual_path, date_time=source_info.date_time)
+        zip_info.compress_type = source_info.compress_type
+        zip_info.external_attr = source_info.external_attr
+        self._forgetEntry(virtual_path)
+        if not ZipInternals.supportsRawEntries(self._zipfile):  # Can't take the compressed data, so decompress it and compress it again.
+            with other._zipfile.open(source_info) as source:
+                try:
+                    with self._zipfile.open(zip_info, "w", force_zip64=True) as target:
+                        shutil.copyfileobj(source, target, self._copy_chunk_size)
+                except RuntimeError:  # Python 3.5 and before couldn't open resources in the archive in write mode.
+                    self._zipfile.writestr(zip_info, source.read())
+            self._indexEntry(virtual_path)
+            return
+
+        zip_info.CRC = source_info.CRC
+        zip_info.file_size = source_info.file_size
+        zip_info.create_system = source_info.create_system
+        zip_info.extract_version = max(source_info.extract_version, zip_info.extract_version)
+
+        ZipInternals.beginRawEntry(self._zipfile, zip_info)
+        data_offset = other._dataOffset(source_info)
+        for start in range(0, source_info.compress_size, self._copy_chunk_size):
+            ZipInternals.writeRaw(self._zipfile, zip_info, other._readRange(data_offset + start, min(self._copy_chunk_size, source_info.compress_size - start)))
+        if zip_info.compress_size != source_info.compress_size:
+            raise zipfile.BadZipFile("The data of {virtual_path} is truncated.".format(virtual_path=virtual_path))
+        ZipInternals.endRawEntry(self._zipfile, zip_info)
+        self._indexEntry(virtual_path)
+
+    ##  Opens a stream that writes a resource directly into the archive.
+    #
+    #   Any earlier version of the resource is replaced.
+    #   \param virtual_path The virtual path of the resource.
+    #   \return A stream to write the resource to.
+    #   \raises RuntimeError The zipfile module is too old to write resources
+    #   as a stream.
+    def _openEntryStream(self, virtual_path: str) -> IO[bytes]:
+        assert self._zipfile is not None
+
+        self._forgetEntry(self._entries[virtual_path])  # Replace any earlier version of the resource.
+        zip_info = self._zipInfoFor(self._entries[virtual_path])
+        if self._parallel_writer is not None and zip_info.compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            compress_level = ZipInternals.compressLevel(zip_info)
+            if compress_level is None:
+                compress_level = zlib.Z_DEFAULT_COMPRESSION
+            return cast(IO[bytes], self._parallel_writer.open(zip_info, compress_level))
+        if self._parallel_writer is not None:
+            self._parallel_writer.drain()  # Other compression types are written by the zipfile module, which can only start after the writer is done.
+        return self._zipfile.open(zip_info, "w", force_zip64=True)
+
+    ##  Creates a stream that collects a resource in a spooled temporary file,
+    #   to write it to the archive once it's closed.
+    #   \param virtual_path The virtual path of the resource.
+    #   \param threshold How many bytes to keep in memory before moving the data
+    #   to a temporary file.
+    #   \return A stream to write the resource to.
+    def _spool(self, virtual_path: str, threshold: int) -> IO[bytes]:
+        stream = SpooledWriteStream(virtual_path, threshold, self._commitSpooledStreams, hash_data=self._blob_cache is not None)
+        with self._lock:
+            self._spooled_streams.append(stream)
+        return stream.outer
+
+    ##  Writes the spooled streams that are closed to the archive, as far as
+    #   all streams that were opened before them are closed too.
+    def _commitSpooledStreams(self) -> None:
+        assert self._zipfile is not None
+
+        with self._lock:
+            while self._spooled_streams and self._spooled_streams[0].closed:
+                spooled_stream = self._spooled_streams.popleft()
+                spool = spooled_stream.spool
+                spool.seek(0)
+                if self._cachesCompression(self._zipInfoFor(self._entries[spooled_stream.virtual_path])):
+                    self._writeThroughCache(spooled_stream)
+                else:
+                    try:
+                        with self._openEntryStream(spooled_stream.virtual_path) as target:
+                            shutil.copyfileobj(spool, target, self._copy_chunk_size)
+                    except RuntimeError:  # Python 3.5 and before couldn't open resources in the archive in write mode.
+                        self._zipfile.writestr(self._zipInfoFor(self._entries[spooled_stream.virtual_path]), spool.read())
+                spool.close()
+
+    ##  Writes a complete deflated resource to the archive, with the compressed
+    #   data from the blob cache if it's there, or compresses it and stores the
+    #   compressed data in the cache.
+    #   \param spooled_stream The closed stream with the resource.
+    def _writeThroughCache(self, spooled_stream: "SpooledWriteStream") -> None:
+        assert self._zipfile is not None
+        assert self._blob_cache is not None
+
+        zip_name = self._entries[spooled_stream.virtual_path]
+        self._forgetEntry(zip_name)  # Replace any earlier version of the resource.
+        zip_info = self._zipInfoFor(zip_name)
+        zip_info.CRC = spooled_stream.crc
+        zip_info.file_size = spooled_stream.size
+        compressed = self._blob_cache.get("deflated", zip_info.CRC, zip_info.file_size, spooled_stream.sha256)
+        ZipInternals.beginRawEntry(self._zipfile, zip_info)
+        if compressed is not None:
+            ZipInternals.writeRaw(self._zipfile, zip_info, compressed)
+        else:
+            compress_level = ZipInternals.compressLevel(zip_info)
+            compressor = zlib.compressobj(compress_level if compress_level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            keep = zip_info.file_size <= self._blob_cache.size_limit  # Only collect the compressed data if it's likely to fit in the cache.
+            chunks = []  # type: List[bytes]
+            for chunk in iter(lambda: spooled_stream.spool.read(self._copy_chunk_size), b""):
+                chunks.append(compressor.compress(chunk))
+                ZipInternals.writeRaw(self._zipfile, zip_info, chunks[-1])
+                if not keep:
+                    chunks.clear()
+            chunks.append(compressor.flush())
+            ZipInternals.writeRaw(self._zipfile, zip_info, chunks[-1])
+            if keep:
+                self._blob_cache.put("deflated", zip_info.CRC, zip_info.file_size, b"".join(chunks), sha256=spooled_stream.sha256)
+        ZipInternals.endRawEntry(self._zipfile, zip_info)
+
+    ##  Wraps a stream that was returned by ``getStream`` to observe what is
+    #   written to it.
+    #
+    #   The wrapper takes the place of the stream, so that it gets closed
+    #   instead of the stream when the package closes the stream.
+    #   \param stream The stream to wrap.
+    #   \param on_write The function to call with every piece of data that is
+    #   written.
+    #   \param on_close The function to call once the stream is closed.
+    #   \return The wrapper.
+    def _observeStream(self, stream: IO[bytes], on_write: Callable[[bytes], Any], on_close: Callable[[], Any]) -> IO[bytes]:
+        result = cast(IO[bytes], ObservingStream(stream, on_write, on_close))
+        with self._lock:
+            for spooled_stream in self._spooled_streams:
+                if spooled_stream.outer is stream:
+                    spooled_stream.outer = result
+        if self._last_open_stream is stream:
+            self._last_open_stream = result
+        return result
+
+    ##  Removes a resource from the central directory of the archive, because
+    #   a new version of it is going to be written.
+    #
+    #   The data of the old version stays in the archive, but nothing refers
+    #   to it any more.
+    #   \param zip_name The name of the resource in the zip file.
+    def _forgetEntry(self, zip_name: str) -> None:
+        assert self._zipfile is not None
+
+        ZipInternals.forgetEntry(self._zipfile, zip_name)
+
+    ##  Creates the information of a new resource to write to the archive, with
+    #   the compression that was set for it.
+    #   \param zip_name The name of the resource in the zip file.
+    #   \return The information to write the resource with.
+    def _zipInfoFor(self, zip_name: str) -> zipfile.ZipInfo:
+        zip_info = zipfile.ZipInfo(zip_name, date_time=time.localtime(time.time())[:6])
+        compress_type, compress_level = self._compressionFor(self._zipNameToVirtualPath(zip_name))
+        zip_info.compress_type = compress_type
+        ZipInternals.setCompressLevel(zip_info, compress_level)
+        return zip_info
+
+    ##  Finds out how a resource should be compressed.
+    #   \param virtual_path The virtual path of the resource.
+    #   \return The compression type and level (or ``None`` for the default
+    #   level) to compress it with.
+    def _compressionFor(self, virtual_path: str) -> Tuple[int, Optional[int]]:
+        content_type = None  # type: Optional[str]
+        for kind, key, compress_type, compress_level in self._compression_rules:
+            if kind == "path":
+                if re.search(key, virtual_path):
+                    return compress_type, compress_level
+            else:
+                if content_type is None:
+                    content_type = self._contentTypeOf(virtual_path)
+                if content_type == key:
+                    return compress_type, compress_level
+        for regex, (compress_type, compress_level) in self._default_compression.items():
+            if re.search(regex, virtual_path):
+                return compress_type, compress_level
+        return zipfile.ZIP_DEFLATED, None
+
+    ##  Finds the content type of a resource from the content types of the
+    #   archive.
+    #   \param virtual_path The virtual path of the resource.
+    #   \return The MIME type of the resource, or an empty string if it has no
+    #   known content type.
+    def _contentTypeOf(self, virtual_path: str) -> str:
+        self._requirePart("content_types")
+
+        extension = virtual_path[virtual_path.rfind(".") + 1:] if "." in virtual_path[virtual_path.rfind("/"):] else ""
+        _, defaults, overrides = self._contentTypeIndex()
+        if virtual_path in overrides:
+            return overrides[virtual_path]  # Overrides win from defaults.
+        return defaults.get(extension.lower(), "")
+
+    ##  Gets the lookup tables of the content types of the archive, building
+    #   them from the list of content types if they weren't built yet.
+    #
+    #   They're kept up to date by ``addContentType``.
+    #   \return The extensions that have a content type, the content type for
+    #   every extension in lowercase, and the content type for every resource
+    #   with an override.
+    def _contentTypeIndex(self) -> Tuple[Set[str], Dict[str, str], Dict[str, str]]:
+        assert self._content_types is not None
+        if self._content_type_index is None:
+            extensions = set()  # type: Set[str]
+            defaults = {}  # type: Dict[str, str]
+            overrides = {}  # type: Dict[str, str]
+            for content_type in self._content_types:
+                if content_type.kind == "Override":
+                    overrides.setdefault(content_type.key, content_type.content_type)  # The first override counts.
+                else:
+                    extensions.add(content_type.key)
+                    defaults[content_type.key.lower()] = content_type.content_type  # The last default counts.
+            self._content_type_index = (extensions, defaults, overrides)
+        return self._content_type_index
+
+    ##  Gets the targets and IDs of the relations of an origin, creating the
+    #   list of relations of the origin if it doesn't exist yet.
+    #
+    #   These are collected from the list once, and then kept up to date by
+    #   ``addRelation``.
+    #   \param origin The origin of the relations.
+    #   \return The targets of the relations and the IDs of the relations.
+    def _relationIndex(self, origin: str) -> Tuple[Set[str], Set[str]]:
+        if origin not in self._relation_index:
+            relationships = self._relations.setdefault(origin, [])
+            self._relation_index[origin] = ({relationship.target for relationship in relationships}, {relationship.id for relationship in relationships})
+        return self._relation_index[origin]
 
     ##  Helper method to write data directly into an aliased path.
     def _writeToAlias(self, path_alias: str, package_filename: str, file_data: bytes) -> None:
@@ -566,23 +1392,196 @@ class OpenPackagingConvention(FileInterface):
         except OPCError:
             pass
 
-    ##  Helper function for pretty-printing XML because ETree is stupid.
-    #
-    #   Source: https://stackoverflow.com/questions/749796/pretty-printing-xml-in-python
-    def _indent(self, elem: ET.Element, level: int = 0) -> None:
-        i = "\n" + level * "  "
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + "  "
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-            for elem in elem:
-                self._indent(elem, level + 1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
+
+##  Dereference the aliases in a virtual path.
+#
+#   The result is cached, since the same few virtual paths tend to be requested
+#   over and over again.
+#   \param aliases The compiled aliases, as given by ``_compiledAliases``.
+#   \param virtual_path The virtual path to dereference.
+#   \return The virtual path with an initial slash and all aliases replaced.
+@functools.lru_cache(maxsize=1024)
+def _resolveAliases(aliases: Tuple[Tuple[Pattern, str], ...], virtual_path: str) -> str:
+    if not virtual_path.startswith("/"):
+        virtual_path = "/" + virtual_path
+
+    # Replace all aliases.
+    for expression, replacement in aliases:
+        virtual_path = expression.sub(replacement, virtual_path)
+
+    return virtual_path
+
+
+##  Wraps an output stream to hide that it can seek.
+#
+#   The zipfile module writes to streams that can't seek in a single pass. The
+#   size and CRC of every resource are then written in a data descriptor after
+#   its data, instead of seeking back to fill them in in the local header. This
+#   wrapper makes it use that mode for any stream, so that everything that has
+#   been written to the stream is final and can be sent on right away.
+#
+#   Closing the wrapper doesn't close the stream.
+class ForwardOnlyStream(io.RawIOBase):
+    ##  Creates the wrapper.
+    #   \param stream The stream to write to.
+    def __init__(self, stream: IO[bytes]) -> None:
+        super().__init__()
+        self._stream = stream
+        try:
+            self._position = stream.tell()  # If we're appending to existing data, the positions in the archive must include it.
+        except (AttributeError, OSError):
+            self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._stream.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def seekable(self) -> bool:
+        return False
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        raise UnsupportedOperation("This stream can only be written forward.")
+
+    def flush(self) -> None:
+        if hasattr(self._stream, "flush") and not getattr(self._stream, "closed", False):
+            self._stream.flush()
+
+
+##  A stream that reads a resource that is stored without compression from an
+#   archive, at any position.
+class StoredEntryStream(io.RawIOBase):
+    ##  Creates the stream.
+    #   \param read_range A function that reads a range of bytes from the
+    #   archive, given the offset and number of bytes.
+    #   \param data_offset The position in the archive where the data of the
+    #   resource starts.
+    #   \param zip_info The resource to read.
+    def __init__(self, read_range: Callable[[int, int], bytes], data_offset: int, zip_info: zipfile.ZipInfo) -> None:
+        super().__init__()
+        self._read_range = read_range
+        self._data_offset = data_offset
+        self._zip_info = zip_info
+        self._position = 0
+        self._crc = 0  # type: Optional[int] # The CRC of what was read so far, as long as it was read from the start without seeking.
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._zip_info.file_size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence ({whence}).".format(whence=whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {offset}.".format(offset=offset))
+        offset = min(offset, self._zip_info.file_size)
+        if offset != self._position:
+            self._crc = None  # Won't be reading everything in order any more.
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        count = min(len(buffer), self._zip_info.file_size - self._position)
+        if count <= 0:
+            return 0
+        data = self._read_range(self._data_offset + self._position, count)
+        if len(data) < count:
+            raise zipfile.BadZipFile("The data of {file_name} is truncated.".format(file_name=self._zip_info.filename))
+        buffer[:count] = data
+        self._position += count
+        if self._crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+            if self._position == self._zip_info.file_size and self._crc != self._zip_info.CRC:
+                raise zipfile.BadZipFile("Bad CRC-32 for file {file_name}.".format(file_name=self._zip_info.filename))
+        return count
+
+
+##  A write stream that collects a resource in a spooled temporary file, which
+#   is written to the archive when the stream is closed.
+class SpooledWriteStream(io.RawIOBase):
+    ##  Creates the stream.
+    #   \param virtual_path The virtual path of the resource.
+    #   \param threshold How many bytes to keep in memory before moving the data
+    #   to a temporary file.
+    #   \param on_close The function to call once the stream is closed.
+    #   \param hash_data Whether to compute the SHA-256 of the data.
+    def __init__(self, virtual_path: str, threshold: int, on_close: Callable[[], Any], hash_data: bool = False) -> None:
+        super().__init__()
+        self.virtual_path = virtual_path
+        self.spool = tempfile.SpooledTemporaryFile(max_size=threshold)
+        self.outer = cast(IO[bytes], self)  # The stream that was given out for this stream, which may be a wrapper around it.
+        self.crc = 0  # The CRC-32 of the data that was written so far.
+        self.size = 0  # The number of bytes that were written so far.
+        self._hash = hashlib.sha256() if hash_data else None
+        self._on_close = on_close
+
+    ##  Gets the SHA-256 digest of the data that was written so far, or
+    #   ``None`` if it's not computed.
+    @property
+    def sha256(self) -> Optional[bytes]:
+        return self._hash.digest() if self._hash is not None else None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if self.closed:
+            raise ValueError("Can't write to a closed stream.")
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+        return self.spool.write(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self._on_close()
+
+
+##  A write stream that passes everything through to another stream, and lets
+#   callbacks know what was written and when the stream is closed.
+class ObservingStream(io.RawIOBase):
+    ##  Creates the stream.
+    #   \param stream The stream to pass the data through to.
+    #   \param on_write The function to call with every piece of data that is
+    #   written.
+    #   \param on_close The function to call once the stream is closed.
+    def __init__(self, stream: IO[bytes], on_write: Callable[[bytes], Any], on_close: Callable[[], Any]) -> None:
+        super().__init__()
+        self._stream = stream
+        self._on_write = on_write
+        self._on_close = on_close
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._on_write(data)
+        return self._stream.write(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._stream.close()
+        super().close()
+        self._on_close()
 
 
 ##  Error to raise that something went wrong with reading/writing a OPC file.
@@ -0,0 +1,200 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+from collections import deque  # The queue of pending writes to the archive.
+from concurrent.futures import Future, ThreadPoolExecutor  # To compress on multiple threads.
+import io
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import zipfile
+import zlib  # To compress the blocks and compute their CRC.
+
+from Charon.filetypes.ZipInternals import ZipInternals  # To write the compressed data directly to the archive.
+
+
+##  Compresses resources for a zip archive on a pool of threads.
+#
+#   The data of every resource is cut into blocks, which are deflated
+#   independently on worker threads and then written to the archive in order.
+#   Each block but the last ends with a sync flush, which aligns it to a byte
+#   boundary, so the concatenated blocks form a single valid deflate stream.
+#   Like pigz does, each block is primed with the last 32kB of the block
+#   before it, so the compression ratio is hardly affected.
+#
+#   Resources don't wait for each other to be compressed. Small resources are
+#   compressed concurrently, and big resources are split over all threads. The
+#   compressed data is written to the archive on the thread of the caller, in
+#   the same order in which the resources were opened. Every resource has a
+#   data descriptor after its data, so the archive is never seeked in.
+#
+#   This writes to the archive through ``ZipInternals``, so it can only be used
+#   if ``ZipInternals.supportsRawEntries`` is ``True`` for the archive.
+class ParallelDeflateWriter:
+    ##  The size of the blocks that resources are cut into by default.
+    DefaultBlockSize = 1024 * 1024
+
+    ##  The size of the deflate window, which is how much of the previous block
+    #   is used to prime the compression of a block.
+    WindowSize = 32 * 1024
+
+    ##  Creates a writer for an archive.
+    #   \param zip_file The archive to write the resources to.
+    #   \param threads The number of threads to compress with.
+    #   \param block_size How much data of a resource to compress per task.
+    #   \param record_checkpoints Whether to keep track of where the blocks start
+    #   in the compressed data of every resource, in ``checkpoints``.
+    def __init__(self, zip_file: zipfile.ZipFile, threads: int, block_size: int = DefaultBlockSize, record_checkpoints: bool = False) -> None:
+        self._zip_file = zip_file
+        self._pool = ThreadPoolExecutor(max_workers = threads)
+        self._block_size = block_size
+        self._max_pending_blocks = threads * 2  # Limits how much compressed data we keep in memory before writing it.
+        self._pending = deque()  # type: Deque[Tuple[str, zipfile.ZipInfo, Any]] # Writes to the archive that have yet to be done, in order.
+        self._pending_blocks = 0  # How many of the pending writes are blocks of data.
+        self._open_stream = None  # type: Optional[ParallelDeflateStream] # The stream that is currently being written to, if any.
+        self._record_checkpoints = record_checkpoints
+
+        ##  For each deflated resource that was written, where the blocks after
+        #   the first start: The offset in the uncompressed data, the offset in
+        #   the compressed data and the 32kB of data before the block. Since
+        #   every block starts at a byte boundary, decompression can start at
+        #   any of these with the data before it as dictionary.
+        self.checkpoints = {}  # type: Dict[str, List[Tuple[int, int, bytes]]]
+
+    ##  Starts writing a new resource to the archive.
+    #   \param zip_info The name and properties of the resource. Its compression
+    #   type must be ``ZIP_DEFLATED`` or ``ZIP_STORED``.
+    #   \param compress_level The deflate level to compress the resource with.
+    #   \return A stream to write the data of the resource to.
+    def open(self, zip_info: zipfile.ZipInfo, compress_level: int = zlib.Z_DEFAULT_COMPRESSION) -> "ParallelDeflateStream":
+        if zip_info.compress_type not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            raise ValueError("Only deflated or stored resources can be written in parallel.")
+        if self._open_stream is not None and not self._open_stream.closed:
+            raise ValueError("Close the previous stream before opening another.")  # Otherwise the data of the two would get interleaved.
+        self._pending.append(("header", zip_info, None))
+        self._open_stream = ParallelDeflateStream(self, zip_info, compress_level)
+        return self._open_stream
+
+    ##  Writes the pending writes to the archive, as far as they are done.
+    #   \param block Whether to wait for the compression of all resources to
+    #   finish and write everything. If ``False``, only the writes that can be
+    #   done right away are done.
+    def drain(self, block: bool = True) -> None:
+        while self._pending:
+            action, zip_info, argument = self._pending[0]
+            if action == "header":
+                ZipInternals.beginRawEntry(self._zip_file, zip_info)
+            elif action == "checkpoint":
+                offset, dictionary = argument
+                self.checkpoints.setdefault(zip_info.filename, []).append((offset, zip_info.compress_size, dictionary))
+            elif action == "data":
+                if isinstance(argument, Future):
+                    if not block and not argument.done():
+                        return
+                    argument = argument.result()
+                    self._pending_blocks -= 1
+                ZipInternals.writeRaw(self._zip_file, zip_info, argument)
+            else:  # End of the resource.
+                ZipInternals.endRawEntry(self._zip_file, zip_info)
+            self._pending.popleft()
+
+    ##  Waits for all resources to be compressed and written to the archive,
+    #   and stops the threads.
+    #
+    #   All streams that were opened must have been closed before this.
+    def close(self) -> None:
+        self.drain(block = True)
+        self._pool.shutdown()
+
+    ##  Adds a block of data of a resource to be written.
+    #
+    #   Called by the streams of this writer.
+    #   \param zip_info The resource that the data belongs to.
+    #   \param data The uncompressed data.
+    #   \param compress_level The deflate level to use, or ``None`` to store the
+    #   data as it is.
+    #   \param dictionary The uncompressed data right before this block.
+    #   \param final Whether this is the last block of the resource.
+    #   \param offset Where the block starts in the uncompressed data.
+    def _addBlock(self, zip_info: zipfile.ZipInfo, data: bytes, compress_level: Optional[int], dictionary: bytes, final: bool, offset: int) -> None:
+        if self._record_checkpoints and compress_level is not None and offset > 0:
+            self._pending.append(("checkpoint", zip_info, (offset, dictionary)))
+        if compress_level is None:
+            self._pending.append(("data", zip_info, data))
+        else:
+            self._pending.append(("data", zip_info, self._pool.submit(self._deflateBlock, data, compress_level, dictionary, final)))
+            self._pending_blocks += 1
+        if final:
+            self._pending.append(("end", zip_info, None))
+
+        self.drain(block = False)
+        while self._pending_blocks > self._max_pending_blocks:  # Too much in memory. Wait until some has been written.
+            action, _, future = self._pending[0]
+            if action == "data" and isinstance(future, Future):
+                future.result()
+            self.drain(block = False)
+
+    ##  Deflates a block of data into raw deflate data.
+    #   \param data The data to compress.
+    #   \param compress_level The deflate level to use.
+    #   \param dictionary The data right before this block, to prime the
+    #   compressor with.
+    #   \param final Whether this is the last block of the stream. Other
+    #   blocks end with a sync flush so that the next block can follow.
+    #   \return The compressed data.
+    @staticmethod
+    def _deflateBlock(data: bytes, compress_level: int, dictionary: bytes, final: bool) -> bytes:
+        if dictionary:
+            compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+##  A stream to write a resource to, which gets compressed in parallel by a
+#   ``ParallelDeflateWriter``.
+class ParallelDeflateStream(io.RawIOBase):
+    ##  Creates the stream. Use ``ParallelDeflateWriter.open`` for this.
+    #   \param writer The writer that compresses the data.
+    #   \param zip_info The resource that is written.
+    #   \param compress_level The deflate level to compress the resource with.
+    def __init__(self, writer: ParallelDeflateWriter, zip_info: zipfile.ZipInfo, compress_level: int) -> None:
+        super().__init__()
+        self._writer = writer
+        self._zip_info = zip_info
+        self._compress_level = compress_level if zip_info.compress_type == zipfile.ZIP_DEFLATED else None  # type: Optional[int]
+        self._buffer = bytearray()
+        self._dictionary = b""  # The end of the previous block.
+        self._offset = 0  # Where the next block starts in the uncompressed data.
+        self._crc = 0
+        self._file_size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        if self.closed:
+            raise ValueError("Can't write to a closed stream.")
+        self._buffer += data
+        self._crc = zlib.crc32(data, self._crc)
+        self._file_size += len(data)
+        block_size = self._writer._block_size
+        while len(self._buffer) > block_size:  # Keep at least something for the final block.
+            self._submit(bytes(self._buffer[:block_size]), final = False)
+            del self._buffer[:block_size]
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._submit(bytes(self._buffer), final = True)
+        self._buffer = bytearray()
+        super().close()
+
+    ##  Sends a block of data to the writer to be compressed and written.
+    #   \param block The data to send.
+    #   \param final Whether this is the last block of the resource.
+    def _submit(self, block: bytes, final: bool) -> None:
+        if final:  # Before the last block is sent, the writer must know the CRC and size for in the data descriptor.
+            self._zip_info.CRC = self._crc
+            self._zip_info.file_size = self._file_size
+        self._writer._addBlock(self._zip_info, block, self._compress_level, self._dictionary, final, self._offset)
+        self._offset += len(block)
+        self._dictionary = block[-ParallelDeflateWriter.WindowSize:]
@@ -0,0 +1,309 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+import struct  # To read and write the chunks of PNG files.
+from typing import List, Tuple
+import zlib  # PNG image data is deflated.
+
+try:
+    import numpy  # Optional, to resample images faster.
+except ImportError:
+    numpy = None
+
+
+##  Decodes, resizes and encodes PNG images without any dependencies.
+#
+#   This is used to resize thumbnails when Qt is not available. If NumPy is
+#   installed, it is used for the resampling. Otherwise everything is done in
+#   plain Python, which is slower but fine for thumbnail-sized images.
+#
+#   Images are always converted to 8-bit RGBA.
+class PngImage:
+    Signature = b"\x89PNG\r\n\x1a\n"
+
+    # For each colour type, the number of samples per pixel.
+    _channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    # The passes of Adam7 interlacing: Start column, start row, column step, row step.
+    _adam7 = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+
+    ##  Resizes a PNG image.
+    #
+    #   When making an image smaller, each output pixel is the average of the
+    #   input pixels it covers. When making it bigger, pixels are interpolated
+    #   linearly. Colours are weighed by their alpha.
+    #   \param data The PNG file to resize.
+    #   \param width The desired width of the image.
+    #   \param height The desired height of the image.
+    #   \return A PNG file with the image at the desired size.
+    @staticmethod
+    def resize(data: bytes, width: int, height: int) -> bytes:
+        if width <= 0 or height <= 0:
+            raise ValueError("Can't resize an image to {width}x{height}.".format(width = width, height = height))
+        original_width, original_height, pixels = PngImage.decode(data)
+        if numpy is not None:
+            resized = PngImage._resampleNumPy(pixels, original_width, original_height, width, height)
+        else:
+            resized = PngImage._resamplePython(pixels, original_width, original_height, width, height)
+        return PngImage.encode(resized, width, height)
+
+    ##  Decodes a PNG file.
+    #   \param data The PNG file.
+    #   \return The width and height of the image, and its pixels as 8-bit RGBA
+    #   rows from top to bottom.
+    @staticmethod
+    def decode(data: bytes) -> Tuple[int, int, bytes]:
+        if not data.startswith(PngImage.Signature):
+            raise ValueError("Not a PNG file.")
+        position = len(PngImage.Signature)
+        header = b""
+        palette = b""
+        transparency = b""
+        image_data = []  # type: List[bytes]
+        while position + 8 <= len(data):
+            length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+            chunk = data[position + 8:position + 8 + length]
+            position += 12 + length  # Length, type, data and CRC.
+            if chunk_type == b"IHDR":
+                header = chunk
+            elif chunk_type == b"PLTE":
+                palette = chunk
+            elif chunk_type == b"tRNS":
+                transparency = chunk
+            elif chunk_type == b"IDAT":
+                image_data.append(chunk)
+            elif chunk_type == b"IEND":
+                break
+        if len(header) != 13:
+            raise ValueError("PNG file has no valid header.")
+        width, height, bit_depth, colour_type, _, _, interlace = struct.unpack(">IIBBBBB", header)
+        if colour_type not in PngImage._channels or bit_depth not in (1, 2, 4, 8, 16):
+            raise ValueError("Unsupported PNG colour type {colour_type} with bit depth {bit_depth}.".format(colour_type = colour_type, bit_depth = bit_depth))
+
+        raw = zlib.decompress(b"".join(image_data))
+        channels = PngImage._channels[colour_type]
+        if interlace:
+            samples = bytearray(width * height * channels)
+            offset = 0
+            for start_x, start_y, step_x, step_y in PngImage._adam7:
+                pass_width = (width - start_x + step_x - 1) // step_x
+                pass_height = (height - start_y + step_y - 1) // step_y
+                if pass_width <= 0 or pass_height <= 0:
+                    continue
+                pass_samples, offset = PngImage._readSamples(raw, offset, pass_width, pass_height, channels, bit_depth)
+                for pass_y in range(pass_height):
+                    for pass_x in range(pass_width):
+                        source = (pass_y * pass_width + pass_x) * channels
+                        target = ((start_y + pass_y * step_y) * width + start_x + pass_x * step_x) * channels
+                        samples[target:target + channels] = pass_samples[source:source + channels]
+        else:
+            samples, _ = PngImage._readSamples(raw, 0, width, height, channels, bit_depth)
+        return width, height, PngImage._toRGBA(samples, colour_type, bit_depth, palette, transparency)
+
+    ##  Encodes an image as PNG file.
+    #   \param pixels The pixels as 8-bit RGBA rows from top to bottom.
+    #   \param width The width of the image.
+    #   \param height The height of the image.
+    #   \return The PNG file.
+    @staticmethod
+    def encode(pixels: bytes, width: int, height: int) -> bytes:
+        stride = width * 4
+        raw = bytearray()
+        for y in range(height):
+            raw.append(0)  # No filter.
+            raw += pixels[y * stride:(y + 1) * stride]
+        return PngImage.Signature \
+            + PngImage._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) \
+            + PngImage._chunk(b"IDAT", zlib.compress(bytes(raw))) \
+            + PngImage._chunk(b"IEND", b"")
+
+    ##  Creates a PNG chunk.
+    #   \param chunk_type The four-letter type of the chunk.
+    #   \param chunk The contents of the chunk.
+    #   \return The chunk with its length and CRC.
+    @staticmethod
+    def _chunk(chunk_type: bytes, chunk: bytes) -> bytes:
+        return struct.pack(">I", len(chunk)) + chunk_type + chunk + struct.pack(">I", zlib.crc32(chunk_type + chunk) & 0xFFFFFFFF)
+
+    ##  Reads the filtered scanlines of an image (or of one interlacing pass)
+    #   and undoes the filters.
+    #   \param raw The decompressed image data.
+    #   \param offset Where the scanlines start in the image data.
+    #   \param width The number of pixels per scanline.
+    #   \param height The number of scanlines.
+    #   \param channels The number of samples per pixel.
+    #   \param bit_depth The number of bits per sample.
+    #   \return The samples, one per byte (the most significant byte for 16-bit
+    #   samples), along with the offset after the scanlines.
+    @staticmethod
+    def _readSamples(raw: bytes, offset: int, width: int, height: int, channels: int, bit_depth: int) -> Tuple[bytearray, int]:
+        bits_per_pixel = channels * bit_depth
+        stride = (width * bits_per_pixel + 7) // 8
+        distance = max(1, bits_per_pixel // 8)  # Filters look at the corresponding byte of the pixel to the left.
+        previous = bytearray(stride)
+        rows = []
+        for _ in range(height):
+            filter_type = raw[offset]
+            row = bytearray(raw[offset + 1:offset + 1 + stride])
+            offset += 1 + stride
+            if filter_type == 1:  # Sub.
+                for i in range(distance, stride):
+                    row[i] = (row[i] + row[i - distance]) & 0xFF
+            elif filter_type == 2:  # Up.
+                row = bytearray((a + b) & 0xFF for a, b in zip(row, previous))
+            elif filter_type == 3:  # Average.
+                for i in range(stride):
+                    left = row[i - distance] if i >= distance else 0
+                    row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+            elif filter_type == 4:  # Paeth.
+                for i in range(stride):
+                    left = row[i - distance] if i >= distance else 0
+                    up_left = previous[i - distance] if i >= distance else 0
+                    up = previous[i]
+                    estimate = left + up - up_left
+                    distance_left = abs(estimate - left)
+                    distance_up = abs(estimate - up)
+                    distance_up_left = abs(estimate - up_left)
+                    if distance_left <= distance_up and distance_left <= distance_up_left:
+                        predictor = left
+                    elif distance_up <= distance_up_left:
+                        predictor = up
+                    else:
+                        predictor = up_left
+                    row[i] = (row[i] + predictor) & 0xFF
+            elif filter_type != 0:
+                raise ValueError("Unknown PNG filter type {filter_type}.".format(filter_type = filter_type))
+            rows.append(row)
+            previous = row
+
+        samples = bytearray()
+        for row in rows:
+            if bit_depth == 8:
+                samples += row
+            elif bit_depth == 16:
+                samples += row[0::2]  # Only keep the most significant byte.
+            else:  # Several samples packed in a byte.
+                mask = (1 << bit_depth) - 1
+                count = width * channels
+                samples += bytearray((row[(i * bit_depth) // 8] >> (8 - bit_depth - (i * bit_depth) % 8)) & mask for i in range(count))
+        return samples, offset
+
+    ##  Converts the samples of an image to 8-bit RGBA.
+    #   \param samples The samples, one per byte.
+    #   \param colour_type The colour type of the image.
+    #   \param bit_depth The original number of bits per sample.
+    #   \param palette The palette, for palette images.
+    #   \param transparency The contents of the tRNS chunk, if any.
+    #   \return The pixels in 8-bit RGBA.
+    @staticmethod
+    def _toRGBA(samples: bytearray, colour_type: int, bit_depth: int, palette: bytes, transparency: bytes) -> bytes:
+        if colour_type == 6:
+            return bytes(samples)
+        if colour_type == 3:
+            alphas = bytearray(transparency) + bytearray([255] * (256 - len(transparency)))
+            colours = [bytes(palette[i * 3:i * 3 + 3]) + bytes([alphas[i]]) for i in range(len(palette) // 3)]
+            return b"".join(colours[index] for index in samples)
+
+        scale = 255 // ((1 << bit_depth) - 1) if bit_depth < 8 else 1  # Low bit depths must be scaled up to the full range.
+        result = bytearray()
+        if colour_type == 0:
+            transparent = struct.unpack(">H", transparency)[0] * scale if len(transparency) == 2 and bit_depth <= 8 else -1
+            for grey in samples:
+                grey *= scale
+                result += bytes((grey, grey, grey, 0 if grey == transparent else 255))
+        elif colour_type == 4:
+            for i in range(0, len(samples), 2):
+                result += bytes((samples[i], samples[i], samples[i], samples[i + 1]))
+        else:  # RGB.
+            transparent_colour = struct.unpack(">HHH", transparency) if len(transparency) == 6 and bit_depth == 8 else None
+            for i in range(0, len(samples), 3):
+                colour = samples[i:i + 3]
+                result += colour
+                result.append(0 if transparent_colour is not None and tuple(colour) == transparent_colour else 255)
+        return bytes(result)
+
+    ##  Computes the weights of the input pixels for every output pixel, along
+    #   one axis.
+    #   \param original_size The number of input pixels.
+    #   \param size The number of output pixels.
+    #   \return For every output pixel, a list of input pixels with their
+    #   weights, which add up to 1.
+    @staticmethod
+    def _weights(original_size: int, size: int) -> List[List[Tuple[int, float]]]:
+        scale = original_size / size
+        result = []
+        for output in range(size):
+            if scale >= 1:  # Shrinking: Average over the area that this pixel covers.
+                start = output * scale
+                end = start + scale
+                weights = []
+                for source in range(int(start), min(original_size, int(end) + 1)):
+                    overlap = min(end, source + 1) - max(start, source)
+                    if overlap > 0:
+                        weights.append((source, overlap / scale))
+            else:  # Growing: Interpolate linearly between the two nearest pixels.
+                centre = min(max((output + 0.5) * scale - 0.5, 0), original_size - 1)
+                left = int(centre)
+                right = min(left + 1, original_size - 1)
+                fraction = centre - left
+                weights = [(left, 1 - fraction), (right, fraction)] if right != left else [(left, 1.0)]
+            result.append(weights)
+        return result
+
+    ##  Resamples an image with NumPy.
+    @staticmethod
+    def _resampleNumPy(pixels: bytes, original_width: int, original_height: int, width: int, height: int) -> bytes:
+        image = numpy.frombuffer(pixels, dtype = numpy.uint8).reshape(original_height, original_width, 4).astype(numpy.float64)
+        image[:, :, :3] *= image[:, :, 3:] / 255  # Premultiply alpha so transparent pixels don't bleed their colour.
+
+        horizontal = numpy.zeros((width, original_width))
+        for output, weights in enumerate(PngImage._weights(original_width, width)):
+            for source, weight in weights:
+                horizontal[output, source] += weight
+        vertical = numpy.zeros((height, original_height))
+        for output, weights in enumerate(PngImage._weights(original_height, height)):
+            for source, weight in weights:
+                vertical[output, source] += weight
+
+        result = numpy.tensordot(vertical, image, axes = (1, 0))  # Vertically: (height, original_width, 4).
+        result = numpy.tensordot(result, horizontal, axes = (1, 1)).transpose(0, 2, 1)  # Horizontally: (height, width, 4).
+        alpha = result[:, :, 3:]
+        result[:, :, :3] = numpy.divide(result[:, :, :3] * 255, alpha, out = numpy.zeros_like(result[:, :, :3]), where = alpha > 0)
+        return numpy.clip(numpy.rint(result), 0, 255).astype(numpy.uint8).tobytes()
+
+    ##  Resamples an image in plain Python.
+    @staticmethod
+    def _resamplePython(pixels: bytes, original_width: int, original_height: int, width: int, height: int) -> bytes:
+        # Premultiply alpha so transparent pixels don't bleed their colour.
+        premultiplied = []  # type: List[float]
+        for i in range(0, len(pixels), 4):
+            source_alpha = pixels[i + 3]
+            premultiplied += (pixels[i] * source_alpha / 255, pixels[i + 1] * source_alpha / 255, pixels[i + 2] * source_alpha / 255, source_alpha)
+
+        # Resample horizontally, then vertically.
+        horizontal_weights = PngImage._weights(original_width, width)
+        rows = []
+        for y in range(original_height):
+            row_start = y * original_width * 4
+            row = []  # type: List[float]
+            for weights in horizontal_weights:
+                pixel = [0.0, 0.0, 0.0, 0.0]
+                for source, weight in weights:
+                    source_index = row_start + source * 4
+                    for channel in range(4):
+                        pixel[channel] += premultiplied[source_index + channel] * weight
+                row += pixel
+            rows.append(row)
+
+        result = bytearray()
+        for weights in PngImage._weights(original_height, height):
+            for x in range(0, width * 4, 4):
+                pixel = [0.0, 0.0, 0.0, 0.0]
+                for source, weight in weights:
+                    for channel in range(4):
+                        pixel[channel] += rows[source][x + channel] * weight
+                alpha = pixel[3]
+                for channel in range(3):
+                    value = pixel[channel] * 255 / alpha if alpha > 0 else 0
+                    result.append(min(255, max(0, int(round(value)))))
+                result.append(min(255, max(0, int(round(alpha)))))
+        return bytes(result)
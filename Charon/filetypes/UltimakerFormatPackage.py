@@ -1,9 +1,17 @@
 # Copyright (c) 2018 Ultimaker B.V.
 # libCharon is released under the terms of the LGPLv3 or higher.
 from collections import OrderedDict
+from io import BytesIO
+import json
+import re
+from typing import Any, cast, Dict, IO, Optional
+import zipfile
 
 from Charon.OpenMode import OpenMode
-from Charon.filetypes.GCodeFile import GCodeFile
+from Charon.WriteOnlyError import WriteOnlyError
+from Charon.filetypes.GCodeAnalyzer import GCodeAnalyzer, MovesStream
+from Charon.filetypes.GCodeFile import GCodeFile, InvalidHeaderException
+from Charon.filetypes.GCodeLayerIndex import GCodeLayerIndex
 from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention
 
 
@@ -30,24 +38,204 @@ class UltimakerFormatPackage(OpenPackagingConvention):
         (r"^/toolpath", "/3D/model.gcode"),
     ])
 
+    # Compression of the resources. Thumbnails are already compressed, and the toolpath is big enough that a fast
+    # compression level pays off.
+    _default_compression = OrderedDict([
+        (r"\.png$", (zipfile.ZIP_STORED, None)),
+        (r"^/3D/model\.gcode$", (zipfile.ZIP_DEFLATED, 1)),
+    ])
+
+    # Sizes of the previews that printers commonly show, to pre-render the thumbnail in with the preview_sizes of
+    # WriteOptions.
+    standard_preview_sizes = [(32, 32), (64, 64), (128, 128), (256, 256)]
+
+    # How many bytes of every write to the toolpath to keep to parse the header from, at most. Header lines are short.
+    _header_size_limit = 64 * 1024
+
+    # Where the index of the layers in the toolpath is stored, and the relationship type that relates the toolpath to it.
+    _layer_index_file = "/3D/model.gcode.layerindex"
+    _layer_index_relationship_type = "http://schemas.ultimaker.org/package/2018/relationships/ufp_layer_index"
+
+    # Virtual paths of a single layer of the toolpath and of the index of all layers, after resolving the aliases.
+    _layer_path = re.compile(r"^/3D/model\.gcode/layer/(-?\d+)$")
+    _layers_path = re.compile(r"^/3D/model\.gcode/layers$")
+
+    # Virtual path of the moves of the toolpath, as records, after resolving the aliases.
+    _moves_path = re.compile(r"^/3D/model\.gcode/moves$")
+
     mime_type = "application/x-ufp"
 
     ##  Initialises the fields of this class.
     def __init__(self):
         super().__init__()
+        self._layer_index = None  # type: Optional[GCodeLayerIndex] # The positions of the layers in the toolpath, once they're known.
+        self._pending_layer_index = None  # type: Optional[GCodeLayerIndex] # The index of the toolpath that was written, until it's stored.
+        self._store_toolpath_header = False  # Whether to store the metadata from the header of the toolpath in the package.
+
+    ##  Opens a stream for reading or writing.
+    #
+    #   This takes the same arguments as ``OpenPackagingConvention.openStream``,
+    #   and one more.
+    #   \param store_toolpath_header When writing, store the metadata from the
+    #   header of the toolpath in the metadata of the toolpath, so that reading
+    #   the package doesn't need to parse the header. It's taken from the
+    #   toolpath while that is written. In read-write mode, the metadata of a
+    #   header that was parsed when opening the package gets stored too.
+    #   Without this, the header is parsed when reading the package if the
+    #   toolpath has no metadata.
+    def openStream(self, *args, store_toolpath_header: bool = False, **kwargs) -> None:
+        self._layer_index = None
+        self._pending_layer_index = None
+        self._store_toolpath_header = store_toolpath_header
+        super().openStream(*args, **kwargs)
+        if store_toolpath_header and self._mode == OpenMode.ReadWrite:
+            self._derived_metadata.difference_update(self._metadata.keysWithPrefix("/3D/model.gcode/"))
+
+    ##  Gets a stream of a resource.
+    #
+    #   Apart from the resources in the archive, this can get a single layer of
+    #   the toolpath, with ``/toolpath/default/layer/<number>``, or the index
+    #   of the layers as JSON with ``/toolpath/default/layers``. When the
+    #   toolpath is written, its layer index is stored next to it, so it
+    #   doesn't need to be built from the toolpath when reading. The moves of
+    #   the toolpath can be read with ``/toolpath/default/moves``, as records
+    #   of the type ``MoveDtype`` from ``GCodeAnalyzer``. This requires NumPy.
+    def getStream(self, virtual_path: str) -> IO[bytes]:
+        canonical_path = self._processAliases(virtual_path)
+        if self._moves_path.match(canonical_path):
+            if self._mode == OpenMode.WriteOnly:
+                raise WriteOnlyError(virtual_path)
+            if not self._resourceExists(canonical_path):
+                raise FileNotFoundError(virtual_path)
+            return cast(IO[bytes], MovesStream(GCodeAnalyzer.iterMoves(super().getStream("/3D/model.gcode"))))
+        layer_match = self._layer_path.match(canonical_path)
+        if layer_match or self._layers_path.match(canonical_path):
+            if self._mode == OpenMode.WriteOnly:
+                raise WriteOnlyError(virtual_path)
+            if not self._resourceExists(canonical_path):
+                raise FileNotFoundError(virtual_path)
+            if not layer_match:
+                return BytesIO(json.dumps(self._layerIndex().toDict()).encode("UTF-8"))
+            start, end = self._layerIndex().range(int(layer_match.group(1)))
+            toolpath = super().getStream("/3D/model.gcode")
+            if toolpath.seekable():
+                toolpath.seek(start)
+            else:  # Before Python 3.7, resources in the zipfile module can't seek.
+                skipped = 0
+                while skipped < start:
+                    chunk = toolpath.read(min(start - skipped, self._copy_chunk_size))
+                    if not chunk:
+                        break
+                    skipped += len(chunk)
+            return BytesIO(toolpath.read(end - start))
 
-    ##  When loading a file, read its metadata from the archive.
+        stream = super().getStream(virtual_path)
+        if canonical_path == "/3D/model.gcode" and stream.writable() and not stream.readable():  # Cached resources are read from streams that are writable too.
+            layer_index = GCodeLayerIndex()
+            header = bytearray()  # The start of the toolpath, as far as the header can go.
+            store_header = self._store_toolpath_header
+
+            def observe(data: bytes) -> None:
+                layer_index.feed(data)
+                if store_header and header.count(b"\n") <= GCodeFile.MaximumHeaderLength:
+                    header.extend(data[:self._header_size_limit])
+
+            def finish() -> None:
+                self._storeLayerIndex(layer_index)
+                if store_header:
+                    self._storeToolpathHeader(bytes(header))
+            return self._observeStream(stream, observe, finish)
+        return stream
+
+    ##  Figures out if a resource exists in the archive, including the layers
+    #   and moves of the toolpath.
+    def _resourceExists(self, virtual_path: str) -> bool:
+        layer_match = self._layer_path.match(virtual_path)
+        if layer_match or self._layers_path.match(virtual_path) or self._moves_path.match(virtual_path):
+            if "/3D/model.gcode" not in self._entries or self._mode == OpenMode.WriteOnly:
+                return False
+            if layer_match:
+                return int(layer_match.group(1)) in self._layerIndex().numbers
+            return True
+        return super()._resourceExists(virtual_path)
+
+    ##  Gets the index of the layers in the toolpath.
     #
-    #   This depends on the relations! Read the relations first!
-    def _readMetadata(self) -> None:
-        super()._readMetadata()
-        if self._mode != OpenMode.WriteOnly and not self.getMetadata("/3D/model.gcode"):
-            try:
-                # Check if the G-code file actually exists in the package.
-                self._zipfile.getinfo("/3D/model.gcode")
-            except KeyError:
-                return
-
-            gcode_stream = self._zipfile.open("/3D/model.gcode")
-            header_data = GCodeFile.parseHeader(gcode_stream, prefix="/3D/model.gcode/")
-            self._metadata.update(header_data)
+    #   The index is read from the archive if it's stored there. Otherwise
+    #   it's built by going through the toolpath once.
+    #   \return The index of the layers.
+    def _layerIndex(self) -> GCodeLayerIndex:
+        if self._layer_index is None:
+            self._requirePart("rels")
+            file_size = self._zipfile.getinfo(self._entries["/3D/model.gcode"]).file_size
+            for relationship in self._relations.get("/3D/model.gcode", []):
+                if relationship.type != self._layer_index_relationship_type or relationship.target not in self._entries:
+                    continue
+                try:
+                    layer_index = GCodeLayerIndex.fromDict(json.loads(self._zipfile.read(self._entries[relationship.target]).decode("UTF-8")))
+                except ValueError:  # Corrupt. JSONDecodeError and UnicodeDecodeError are ValueErrors too.
+                    continue
+                if layer_index.size == file_size:  # Otherwise it belongs to a different version of the toolpath.
+                    self._layer_index = layer_index
+                    break
+            if self._layer_index is None:
+                self._layer_index = GCodeLayerIndex.build(super().getStream("/3D/model.gcode"))
+        return self._layer_index
+
+    ##  Keeps the index of the layers of the toolpath that was written, to
+    #   store it in the archive along with the metadata.
+    #   \param layer_index The index of the toolpath.
+    def _storeLayerIndex(self, layer_index: GCodeLayerIndex) -> None:
+        layer_index.finish()
+        self._layer_index = layer_index
+        self._pending_layer_index = layer_index
+
+    ##  Writes the index of the layers of the toolpath that was written since
+    #   the last flush, along with a relation from the toolpath to it.
+    #
+    #   The index is a separate resource, so that it doesn't end up in the
+    #   metadata of the toolpath. Toolpaths without layers get no index.
+    def _writeLayerIndex(self) -> None:
+        layer_index = self._pending_layer_index
+        self._pending_layer_index = None
+        if layer_index is None or not layer_index.numbers:
+            return
+        self._writeEntryData(self._layer_index_file, json.dumps(layer_index.toDict()).encode("UTF-8"))
+        self._ensureRelationExists(self._layer_index_file, self._layer_index_relationship_type, "/3D/model.gcode")
+
+    ##  Stores the metadata from the header of the toolpath that was written in
+    #   the metadata of the toolpath.
+    #
+    #   Metadata that was set explicitly is kept. If the header can't be parsed,
+    #   nothing is stored.
+    #   \param header The start of the toolpath.
+    def _storeToolpathHeader(self, header: bytes) -> None:
+        try:
+            header_data = self._flattenHeader(GCodeFile.parseHeader(BytesIO(header)), "/3D/model.gcode")
+        except InvalidHeaderException:
+            return
+        for key, value in header_data.items():
+            if key not in self._metadata:
+                self._metadata[key] = value
+
+    ##  At the end of writing a file, write the metadata to the archive, and
+    #   the layer index of the toolpath along with it.
+    def _writeMetadata(self) -> None:
+        self._writeLayerIndex()
+        super()._writeMetadata()
+
+    ##  Turns the nested dictionaries of a parsed G-code header into metadata
+    #   keys, the same way as they are read from a metadata file. This is only
+    #   used to store the header in a metadata file.
+    #   \param header The parsed header, or a part of it.
+    #   \param path The path of the metadata keys of the header.
+    #   \return The metadata, by key.
+    @classmethod
+    def _flattenHeader(cls, header: Dict[str, Any], path: str) -> Dict[str, Any]:
+        result = {}  # type: Dict[str, Any]
+        for key, value in header.items():
+            if isinstance(value, dict):
+                result.update(cls._flattenHeader(value, path + "/" + str(key)))
+            else:
+                result[path + "/" + str(key)] = value
+        return result
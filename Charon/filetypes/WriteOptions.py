@@ -0,0 +1,43 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+from typing import Optional, Sequence, Tuple
+
+
+##  How to write a package, for ``OpenPackagingConvention.openStream``.
+#
+#   These options only apply when writing, in write-only or read-write mode.
+#   When reading, they are ignored.
+class WriteOptions:
+    ##  Creates the options. Without arguments, packages are written the
+    #   default way.
+    #   \param streaming In write-only mode, write the package in a single pass
+    #   without ever seeking back in the stream, even if the stream supports
+    #   seeking. Streams that can't seek, such as pipes and sockets, are always
+    #   written this way.
+    #   \param compression_threads Compress the resources on this many threads.
+    #   Big resources are split into blocks that are compressed in parallel,
+    #   and small resources are compressed concurrently. If 0, all compression
+    #   happens on the calling thread. This only helps with multiple cores. On
+    #   a single core, the threads make writing slower.
+    #   \param preview_sizes Store a copy of every PNG image in each of these
+    #   sizes (width, height) next to it. Requesting an image in one of these
+    #   sizes then doesn't require resizing it. The copies are rendered in the
+    #   background while the rest of the package is written.
+    #   \param seek_index_interval Store an index next to every deflated
+    #   resource that is bigger than this many bytes, with a point every this
+    #   many bytes where decompression can start. Seeking in those resources
+    #   when reading them is then fast. Big resources without a stored index
+    #   get one built on the go when they are read.
+    #   \param spool_threshold Allow multiple streams to be open at the same
+    #   time, on any threads. Every stream keeps its data in memory up to this
+    #   many bytes, and in a temporary file beyond that. Once it's closed, it's
+    #   written to the archive, after all streams that were opened before it.
+    #   Flushing closes the streams that are still open. If 0, only one stream
+    #   can be open at a time, and getting a stream closes the previous one.
+    def __init__(self, *, streaming: bool = False, compression_threads: int = 0, preview_sizes: Optional[Sequence[Tuple[int, int]]] = None,
+                 seek_index_interval: int = 0, spool_threshold: int = 0) -> None:
+        self.streaming = streaming
+        self.compression_threads = compression_threads
+        self.preview_sizes = list(preview_sizes) if preview_sizes else []  # type: Sequence[Tuple[int, int]]
+        self.seek_index_interval = seek_index_interval
+        self.spool_threshold = spool_threshold
@@ -0,0 +1,149 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+import struct  # To write data descriptors and read local headers.
+from typing import Callable, Optional
+import zipfile
+
+
+##  The only place that touches the private state of the zipfile module.
+#
+#   Writing the data of a resource directly to the file of an archive, and
+#   replacing resources, need attributes of ``zipfile.ZipFile`` and
+#   ``zipfile.ZipInfo`` that aren't part of its public interface and that
+#   differ between Python versions. These functions check that the attributes
+#   exist. Where they don't, callers must fall back to the public
+#   ``writestr`` and ``open(..., "w")`` of the zipfile module. Reading the data
+#   of a resource directly from the archive needs the layout of its local
+#   header, which is defined here instead of taken from the zipfile module.
+class ZipInternals:
+    ##  The attributes of ``zipfile.ZipFile`` that are needed to write the data
+    #   of resources directly to the archive.
+    _raw_entry_attributes = ["fp", "start_dir", "filelist", "NameToInfo", "_writing", "_seekable", "_writecheck", "_didModify"]
+
+    ##  The layout of the local header in front of the data of every resource,
+    #   and the signature it starts with, from the zip file specification. The
+    #   zipfile module has these too, but not as part of its public interface.
+    _local_header = struct.Struct("<4s2B4HL2L2H")
+    _local_header_signature = b"PK\x03\x04"
+
+    ##  The attributes of ``zipfile.ZipFile`` that are needed to remove a
+    #   resource from the central directory.
+    _forget_entry_attributes = ["filelist", "NameToInfo"]
+
+    ##  Checks whether the data of resources can be written directly to an
+    #   archive with ``beginRawEntry``, ``writeRaw`` and ``endRawEntry``.
+    #   \param zip_file The archive to write to.
+    #   \return ``True`` if it can, or ``False`` if the zipfile module lacks
+    #   the attributes that this needs.
+    @staticmethod
+    def supportsRawEntries(zip_file: zipfile.ZipFile) -> bool:
+        return all(hasattr(zip_file, attribute) for attribute in ZipInternals._raw_entry_attributes)
+
+    ##  Writes the local header of a resource of which the data will be
+    #   written directly to the file of the archive.
+    #
+    #   The CRC and sizes are left out of the header, and must be written in a
+    #   data descriptor by ``endRawEntry`` after the data. Only call this if
+    #   ``supportsRawEntries`` is ``True``.
+    #   \param zip_file The archive to write the resource to.
+    #   \param zip_info The resource to write.
+    @staticmethod
+    def beginRawEntry(zip_file: zipfile.ZipFile, zip_info: zipfile.ZipInfo) -> None:
+        if zip_file._writing:  # type: ignore
+            raise ValueError("Can't write to the archive while another resource is being written.")
+        zip_info.compress_size = 0  # Counted while writing the data. The CRC and file size may already be known, but aren't written in the header.
+        zip_info.flag_bits = 0x08  # The sizes and CRC follow in a data descriptor.
+        if not zip_info.external_attr:
+            zip_info.external_attr = 0o600 << 16  # Permissions: ?rw-------, like the zipfile module does.
+
+        if zip_file._seekable:  # type: ignore
+            zip_file.fp.seek(zip_file.start_dir)
+        zip_info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(zip_info)  # type: ignore
+        zip_file._didModify = True  # type: ignore
+        zip_file.fp.write(zip_info.FileHeader(zip64=True))
+        zip_file._writing = True  # type: ignore
+
+    ##  Writes data of a resource that was started with ``beginRawEntry``.
+    #
+    #   The data is written as it is, so it must already be compressed. The
+    #   size of the compressed data is counted in the resource info.
+    #   \param zip_file The archive the resource is written to.
+    #   \param zip_info The resource that is written.
+    #   \param data The (compressed) data to write.
+    @staticmethod
+    def writeRaw(zip_file: zipfile.ZipFile, zip_info: zipfile.ZipInfo, data: bytes) -> None:
+        zip_file.fp.write(data)
+        zip_info.compress_size += len(data)
+
+    ##  Finishes a resource that was started with ``beginRawEntry``.
+    #
+    #   The CRC and sizes must have been filled in in the resource info.
+    #   \param zip_file The archive the resource was written to.
+    #   \param zip_info The resource that was written.
+    @staticmethod
+    def endRawEntry(zip_file: zipfile.ZipFile, zip_info: zipfile.ZipInfo) -> None:
+        zip_file.fp.write(struct.pack("<LLQQ", 0x08074b50, zip_info.CRC, zip_info.compress_size, zip_info.file_size))
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(zip_info)
+        zip_file.NameToInfo[zip_info.filename] = zip_info
+        zip_file._writing = False  # type: ignore
+
+    ##  Finds where the data of a resource starts in an archive, by reading
+    #   its local header.
+    #   \param zip_info The resource.
+    #   \param read_range A function that reads a number of bytes from an
+    #   offset in the archive.
+    #   \return The position in the archive of the first byte of its data.
+    #   \raises zipfile.BadZipFile The resource has no valid local header.
+    @staticmethod
+    def dataOffset(zip_info: zipfile.ZipInfo, read_range: Callable[[int, int], bytes]) -> int:
+        header_data = read_range(zip_info.header_offset, ZipInternals._local_header.size)
+        if len(header_data) != ZipInternals._local_header.size:
+            raise zipfile.BadZipFile("Truncated file header of {file_name}.".format(file_name=zip_info.filename))
+        header = ZipInternals._local_header.unpack(header_data)
+        if header[0] != ZipInternals._local_header_signature:
+            raise zipfile.BadZipFile("Bad magic number for file header of {file_name}.".format(file_name=zip_info.filename))
+        return zip_info.header_offset + ZipInternals._local_header.size + header[10] + header[11]  # Skip the header, the file name and the extra field.
+
+    ##  Removes a resource from the central directory of an archive.
+    #
+    #   The data of the resource stays in the archive, but nothing refers to it
+    #   any more. If the zipfile module lacks the attributes to do this, the
+    #   resource is left in, and a new version of it that is written later
+    #   hides it when the archive is read.
+    #   \param zip_file The archive to remove the resource from.
+    #   \param zip_name The name of the resource in the zip file.
+    #   \return Whether the resource was removed.
+    @staticmethod
+    def forgetEntry(zip_file: zipfile.ZipFile, zip_name: str) -> bool:
+        if not all(hasattr(zip_file, attribute) for attribute in ZipInternals._forget_entry_attributes):
+            return False
+        zip_info = zip_file.NameToInfo.pop(zip_name, None)
+        if zip_info is None:
+            return False
+        zip_file.filelist.remove(zip_info)
+        return True
+
+    ##  Gets the deflate level that a resource is compressed with.
+    #   \param zip_info The resource.
+    #   \return The level, or ``None`` for the default level.
+    @staticmethod
+    def compressLevel(zip_info: zipfile.ZipInfo) -> Optional[int]:
+        for attribute in ["compress_level", "_compresslevel"]:  # Public since Python 3.13.
+            if hasattr(zip_info, attribute):
+                return getattr(zip_info, attribute)
+        return None
+
+    ##  Sets the deflate level to compress a resource with.
+    #
+    #   Before Python 3.7, the level can't be set per resource, and the default
+    #   level is used.
+    #   \param zip_info The resource.
+    #   \param compress_level The level, or ``None`` for the default level.
+    @staticmethod
+    def setCompressLevel(zip_info: zipfile.ZipInfo, compress_level: Optional[int]) -> None:
+        for attribute in ["compress_level", "_compresslevel"]:
+            if hasattr(zip_info, attribute):
+                setattr(zip_info, attribute, compress_level)
+                return
@@ -0,0 +1,47 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Micro-benchmark of resolving the virtual path aliases of a UFP file.
+#
+#   Compares the cached resolution of aliases with applying every alias as a
+#   fresh regular expression substitution, which is what happened before.
+#
+#   Usage: python3 benchmarks/benchmark_aliases.py [number of resolutions]
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.UltimakerFormatPackage import UltimakerFormatPackage
+
+PATHS = ["/toolpath", "/preview", "/toolpath/default", "/preview/default/300x300", "/Metadata/UFP_Global.json"]
+
+
+def uncachedAliases(package: UltimakerFormatPackage, virtual_path: str) -> str:
+    if not virtual_path.startswith("/"):
+        virtual_path = "/" + virtual_path
+    for regex, replacement in package._aliases.items():
+        if regex.startswith("/"):
+            expression = r"^" + regex
+        else:
+            expression = regex
+        virtual_path = re.sub(expression, replacement, virtual_path)
+    return virtual_path
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    package = UltimakerFormatPackage()
+    for path in PATHS:
+        assert package._processAliases(path) == uncachedAliases(package, path)
+
+    cached_time = timeit.timeit(lambda: [package._processAliases(path) for path in PATHS], number = count // len(PATHS))
+    uncached_time = timeit.timeit(lambda: [uncachedAliases(package, path) for path in PATHS], number = count // len(PATHS))
+    print("{count} alias resolutions, cached: {time:.3f}s".format(count = count, time = cached_time))
+    print("{count} alias resolutions, uncached: {time:.3f}s".format(count = count, time = uncached_time))
+
+
+if __name__ == "__main__":
+    main()
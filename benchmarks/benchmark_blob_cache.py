@@ -0,0 +1,97 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of packages that share the same toolpath, with and without a
+#   blob cache.
+#
+#   Writes a number of packages that only differ in their metadata, and then
+#   opens all of them to read the metadata from the G-code header and the
+#   toolpath, like a print farm that gets the same job many times.
+#
+#   Usage: python3 benchmarks/benchmark_blob_cache.py [number of packages]
+import io
+import os
+import sys
+import timeit
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.BlobCache import BlobCache
+from Charon.filetypes.UltimakerFormatPackage import UltimakerFormatPackage
+from Charon.OpenMode import OpenMode
+
+HEADER = b""";START_OF_HEADER
+;HEADER_VERSION:0.1
+;FLAVOR:Griffin
+;GENERATOR.NAME:Cura_SteamEngine
+;GENERATOR.VERSION:4.0.0
+;GENERATOR.BUILD_DATE:2018-11-01
+;TARGET_MACHINE.NAME:Ultimaker 3
+;EXTRUDER_TRAIN.0.INITIAL_TEMPERATURE:210
+;EXTRUDER_TRAIN.0.MATERIAL.VOLUME_USED:1234
+;EXTRUDER_TRAIN.0.NOZZLE.DIAMETER:0.4
+;BUILD_PLATE.INITIAL_TEMPERATURE:60
+;PRINT.TIME:5000
+;PRINT.SIZE.MIN.X:0
+;PRINT.SIZE.MIN.Y:0
+;PRINT.SIZE.MIN.Z:0
+;PRINT.SIZE.MAX.X:200
+;PRINT.SIZE.MAX.Y:200
+;PRINT.SIZE.MAX.Z:100
+;END_OF_HEADER
+"""
+
+
+def createToolpath() -> bytes:
+    lines = [HEADER]
+    for layer in range(200):
+        lines.append(";LAYER:{}\n".format(layer).encode("UTF-8"))
+        lines.append(b"".join("G1 X{x:.3f} Y{y:.3f} E{e:.5f}\n".format(x = (i * 7) % 200, y = (i * 13) % 200, e = i * 0.01).encode("UTF-8") for i in range(layer * 1000, layer * 1000 + 1000)))
+    return b"".join(lines)
+
+
+def writePackages(toolpath: bytes, num_packages: int, cache: Optional[BlobCache]) -> List[io.BytesIO]:
+    result = []
+    for index in range(num_packages):
+        stream = io.BytesIO()
+        package = UltimakerFormatPackage()
+        package.openStream(stream, mode = OpenMode.WriteOnly, blob_cache = cache)
+        package.setData({"/3D/model.gcode": toolpath})
+        package.setMetadata({"/job/name": "Job {}".format(index)})
+        package.close()
+        result.append(stream)
+    return result
+
+
+def readPackages(streams: List[io.BytesIO], cache: Optional[BlobCache]) -> None:
+    for stream in streams:
+        stream.seek(0)
+        package = UltimakerFormatPackage()
+        package.openStream(stream, blob_cache = cache)
+        package.getMetadata("/3D/model.gcode")
+        package.getStream("/3D/model.gcode").read()
+        package.close()
+
+
+def main() -> None:
+    num_packages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    toolpath = createToolpath()
+    print("Toolpath of {size:.1f}MB, shared by {count} packages.".format(size = len(toolpath) / 1024 / 1024, count = num_packages))
+
+    streams = []  # type: List[io.BytesIO]
+    write_time = timeit.timeit(lambda: streams.extend(writePackages(toolpath, num_packages, None)), number = 1)
+    print("Writing, without cache: {time:.3f}s".format(time = write_time))
+    cache = BlobCache()
+    write_time = timeit.timeit(lambda: writePackages(toolpath, num_packages, cache), number = 1)
+    print("Writing, with cache: {time:.3f}s".format(time = write_time))
+
+    read_time = timeit.timeit(lambda: readPackages(streams, None), number = 1)
+    print("Reading, without cache: {time:.3f}s".format(time = read_time))
+    cache = BlobCache()
+    read_time = timeit.timeit(lambda: readPackages(streams, cache), number = 1)
+    print("Reading, with cache: {time:.3f}s".format(time = read_time))
+
+
+if __name__ == "__main__":
+    main()
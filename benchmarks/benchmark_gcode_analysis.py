@@ -0,0 +1,110 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of analysing the moves in G-code.
+#
+#   Analyses a synthetic G-code file of several megabytes with the analyzer,
+#   which processes the moves of every chunk with NumPy, and with a simple
+#   analysis that handles the file line by line in Python. The latter only
+#   computes the filament and bounding box, so it does less work. Then reads
+#   the moves of the file as NumPy record arrays, and as a Python tuple per
+#   move.
+#
+#   Usage: python3 benchmarks/benchmark_gcode_analysis.py [number of layers]
+import io
+import math
+import os
+import random
+import sys
+import timeit
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.GCodeAnalyzer import GCodeAnalyzer, MoveDtype
+
+
+def syntheticGCode(layers: int) -> bytes:
+    generator = random.Random(1)
+    lines = [";FLAVOR:Griffin\n", "M82\n", "G92 E0\n", "T0\n"]
+    extruded = 0.0
+    for layer in range(layers):
+        lines.append(";LAYER:{}\n".format(layer))
+        lines.append("G0 F9000 X10 Y10 Z{:.2f}\n".format(0.2 + layer * 0.2))
+        for index in range(2000):
+            extruded += 0.05
+            feedrate = "F1500 " if index % 7 == 0 else ""
+            lines.append("G1 {}X{:.3f} Y{:.3f} E{:.5f} ;extrude\n".format(feedrate, 10 + generator.random() * 100, 10 + generator.random() * 100, extruded))
+        lines.append("G1 F2400 E{:.5f}\n".format(extruded - 6.5))  # Retract.
+        lines.append("M204 S500\n")
+        lines.append("G1 F2400 E{:.5f}\n".format(extruded))
+        if layer == layers // 2:
+            lines.append("T1\n")
+    return "".join(lines).encode("UTF-8")
+
+
+##  Computes the filament per extruder and the bounding box line by line.
+def analyseLines(data: bytes) -> Tuple[Dict[int, float], List[float], List[float]]:
+    position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+    extruder = 0
+    filament = {}  # type: Dict[int, float]
+    minimum = [math.inf] * 3
+    maximum = [-math.inf] * 3
+    for line in io.BytesIO(data):
+        words = line.split(b";", 1)[0].decode("UTF-8").split()
+        if not words:
+            continue
+        if words[0] in ("G0", "G1"):
+            start = [position["X"], position["Y"], position["Z"]]
+            previous_extruded = position["E"]
+            for word in words[1:]:
+                if word[0] in position:
+                    position[word[0]] = float(word[1:])
+            filament[extruder] = filament.get(extruder, 0.0) + position["E"] - previous_extruded
+            if position["E"] > previous_extruded:
+                for axis, name in enumerate("XYZ"):
+                    minimum[axis] = min(minimum[axis], start[axis], position[name])
+                    maximum[axis] = max(maximum[axis], start[axis], position[name])
+        elif words[0] == "G92":
+            for word in words[1:]:
+                position[word[0]] = float(word[1:])
+        elif words[0].startswith("T"):
+            extruder = int(words[0][1:])
+    return filament, minimum, maximum
+
+
+##  Reads the end position, extrusion and feedrate of every move line by line.
+def movesOfLines(data: bytes) -> List[Tuple[float, float, float, float, float]]:
+    position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0, "F": 0.0}
+    result = []
+    for line in io.BytesIO(data):
+        words = line.split(b";", 1)[0].decode("UTF-8").split()
+        if words and words[0] in ("G0", "G1"):
+            previous_extruded = position["E"]
+            for word in words[1:]:
+                if word[0] in position:
+                    position[word[0]] = float(word[1:])
+            result.append((position["X"], position["Y"], position["Z"], position["E"] - previous_extruded, position["F"]))
+    return result
+
+
+def main() -> None:
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    data = syntheticGCode(layers)
+
+    analyzer = GCodeAnalyzer.build(io.BytesIO(data))
+    filament, minimum, maximum = analyseLines(data)
+    assert analyzer.minimum == minimum and analyzer.maximum == maximum
+    assert all(math.isclose(analyzer.filament[extruder], length) for extruder, length in filament.items())
+
+    numpy_time = timeit.timeit(lambda: GCodeAnalyzer.build(io.BytesIO(data)), number = 1)
+    lines_time = timeit.timeit(lambda: analyseLines(data), number = 1)
+    print("{size:.1f}MB, {moves} moves: analyzer {numpy:.3f}s, line by line {lines:.3f}s".format(size = len(data) / 1024 / 1024, moves = analyzer.move_count, numpy = numpy_time, lines = lines_time))
+
+    records_time = timeit.timeit(lambda: list(GCodeAnalyzer.iterMoves(io.BytesIO(data))), number = 1)
+    tuples_time = timeit.timeit(lambda: movesOfLines(data), number = 1)
+    print("Reading the moves: record arrays {records:.3f}s ({record_size} bytes per move), tuples {tuples:.3f}s".format(records = records_time, record_size = MoveDtype.itemsize, tuples = tuples_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of parsing G-code headers.
+#
+#   Parses the header of the G-code file in the test resources, and a
+#   synthetic header with as many lines as a header can have, with the fast
+#   scanner and with the older parser that evaluates every value as a Python
+#   literal. Both with and without validating the header afterwards.
+#
+#   Usage: python3 benchmarks/benchmark_gcode_header.py [number of parses]
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.GCodeFile import GCodeFile
+
+
+def syntheticHeader() -> bytes:
+    lines = [
+        ";START_OF_HEADER",
+        ";HEADER_VERSION:0.1",
+        ";FLAVOR:Griffin",
+        ";GENERATOR.NAME:Cura_SteamEngine",
+        ";GENERATOR.VERSION:4.0.0",
+        ";GENERATOR.BUILD_DATE:2018-11-01",
+        ";TARGET_MACHINE.NAME:Ultimaker 3",
+        ";BUILD_PLATE.INITIAL_TEMPERATURE:60",
+        ";PRINT.TIME:5000",
+        ";PRINT.SIZE.MIN.X:0",
+        ";PRINT.SIZE.MIN.Y:0",
+        ";PRINT.SIZE.MIN.Z:0.27",
+        ";PRINT.SIZE.MAX.X:200.5",
+        ";PRINT.SIZE.MAX.Y:200.5",
+        ";PRINT.SIZE.MAX.Z:100",
+    ]
+    for extruder in range(2):
+        lines.append(";EXTRUDER_TRAIN.{}.INITIAL_TEMPERATURE:210".format(extruder))
+        lines.append(";EXTRUDER_TRAIN.{}.MATERIAL.VOLUME_USED:1234.5".format(extruder))
+        lines.append(";EXTRUDER_TRAIN.{}.MATERIAL.GUID:506c9f0d-e3aa-4bd4-b2d2-23e2425b1aa9".format(extruder))
+        lines.append(";EXTRUDER_TRAIN.{}.NOZZLE.DIAMETER:0.4".format(extruder))
+        lines.append(";EXTRUDER_TRAIN.{}.NOZZLE.NAME:AA 0.4".format(extruder))
+    index = 0
+    while len(lines) < GCodeFile.MaximumHeaderLength - 1:
+        lines.append(";SETTINGS.GROUP{}.SETTING{}:{}".format(index % 7, index, ["1", "0.25", "(1, 2)", "some text", "True"][index % 5]))
+        index += 1
+    lines.append(";END_OF_HEADER")
+    lines.append(";LAYER:0")
+    return "\n".join(lines).encode("UTF-8") + b"\nG1 X1 Y1\n" * 1000
+
+
+def main() -> None:
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with open(os.path.join(os.path.dirname(__file__), "..", "tests", "filetypes", "resources", "um3.gcode"), "rb") as gcode_file:
+        resource = gcode_file.read()
+    for name, data in [("um3.gcode", resource), ("synthetic header", syntheticHeader())]:
+        assert GCodeFile.parseHeader(io.BytesIO(data)) == GCodeFile.parseHeader(io.BytesIO(data), use_literal_eval = True)
+        scan_time = timeit.timeit(lambda: GCodeFile.parseHeader(io.BytesIO(data)), number = number)
+        literal_eval_time = timeit.timeit(lambda: GCodeFile.parseHeader(io.BytesIO(data), use_literal_eval = True), number = number)
+        print("{name}, {number} parses: scanner {scan:.3f}s, literal_eval {literal_eval:.3f}s".format(name = name, number = number, scan = scan_time, literal_eval = literal_eval_time))
+
+        # Without the validation of the header, which both share.
+        scan_time = timeit.timeit(lambda: GCodeFile._GCodeFile__scanHeader(io.BytesIO(data)), number = number)
+        literal_eval_time = timeit.timeit(lambda: GCodeFile._GCodeFile__readHeaderLines(io.BytesIO(data)), number = number)
+        print("{name}, {number} reads of the key-value pairs: scanner {scan:.3f}s, literal_eval {literal_eval:.3f}s".format(name = name, number = number, scan = scan_time, literal_eval = literal_eval_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of reading a G-code file through a memory map.
+#
+#   Writes a G-code file of many megabytes with many layers to a temporary
+#   file, and then opens it with and without memory mapping to get random
+#   layers, get the toolpath in chunks and go through all of its lines.
+#
+#   Usage: python3 benchmarks/benchmark_gcode_mmap.py [size of the file in MB]
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.GCodeFile import GCodeFile
+
+
+def createGCode(size: int) -> bytes:
+    lines = [b";FLAVOR:UltiGCode\n;END_OF_HEADER\n"]
+    length = len(lines[0])
+    layer = 0
+    while length < size:
+        lines.append(";LAYER:{}\n".format(layer).encode("UTF-8"))
+        lines.append(b"".join("G1 X{x:.3f} Y{y:.3f} E{e:.5f}\n".format(x = (index * 7) % 200, y = (index * 13) % 200, e = index * 0.01).encode("UTF-8") for index in range(layer * 1000, layer * 1000 + 1000)))
+        length += len(lines[-1]) + len(lines[-2])
+        layer += 1
+    return b"".join(lines)
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, "benchmark.gcode")
+    with open(file_name, "wb") as gcode_file:
+        gcode_file.write(createGCode(size * 1024 * 1024))
+
+    for memory_map in [False, True]:
+        gcode = GCodeFile()
+        gcode.openStream(open(file_name, "rb"), "text/x-gcode", memory_map = memory_map)
+        layers = json.loads(gcode.getData("/toolpath/default/layers")["/toolpath/default/layers"].decode("UTF-8"))["numbers"]  # Builds the layer index.
+        generator = random.Random(1)
+        numbers = [generator.choice(layers) for _ in range(1000)]
+        layers_time = timeit.timeit(lambda: [gcode.getData("/toolpath/default/layer/{}".format(number)) for number in numbers], number = 1)
+        chunks_time = timeit.timeit(lambda: sum(len(chunk) for chunk in gcode.iterData("/toolpath")), number = 1)
+        lines_time = timeit.timeit(lambda: sum(1 for _ in gcode.iterLines()), number = 1)
+        print("memory_map = {memory_map}: 1000 random layers {layers:.3f}s, toolpath in chunks {chunks:.3f}s, all lines {lines:.3f}s".format(memory_map = memory_map, layers = layers_time, chunks = chunks_time, lines = lines_time))
+        gcode.close()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of getting a big toolpath all at once and in chunks.
+#
+#   Writes a package with a toolpath of many megabytes to a temporary file, and
+#   then reads the toolpath with getData and with iterData, measuring the time
+#   and the peak memory that is allocated, like a printer that streams a job
+#   to its motion controller.
+#
+#   Usage: python3 benchmarks/benchmark_iter_data.py [size of the toolpath in MB]
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.OpenMode import OpenMode
+from Charon.VirtualFile import VirtualFile
+
+HEADER = b";FLAVOR:UltiGCode\n;END_OF_HEADER\n"
+
+
+def createToolpath(size: int) -> bytes:
+    lines = [HEADER]
+    length = len(HEADER)
+    index = 0
+    while length < size:
+        line = "G1 X{x:.3f} Y{y:.3f} E{e:.5f}\n".format(x = (index * 7) % 200, y = (index * 13) % 200, e = index * 0.01).encode("UTF-8")
+        lines.append(line)
+        length += len(line)
+        index += 1
+    return b"".join(lines)
+
+
+##  Runs a function and measures how long it takes and how much memory it
+#   allocates at most.
+def measure(function: Callable[[], int]) -> Tuple[float, int, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak, result
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    toolpath = createToolpath(size * 1024 * 1024)
+    file_name = os.path.join(tempfile.mkdtemp(), "benchmark.ufp")
+    package = VirtualFile()
+    package.open(file_name, OpenMode.WriteOnly)
+    package.setData({"/toolpath": toolpath})
+    package.close()
+    del toolpath
+
+    package = VirtualFile()
+    package.open(file_name)
+
+    def getData() -> int:
+        return len(package.getData("/toolpath")["/toolpath"])
+
+    def iterData() -> int:
+        return sum(len(chunk) for chunk in package.iterData("/toolpath", chunk_size = 1024 * 1024))
+
+    for name, function in [("getData", getData), ("iterData", iterData)]:
+        duration, peak, length = measure(function)
+        print("{name}: {length:.1f}MB in {duration:.3f}s, peak memory {peak:.1f}MB".format(name = name, length = length / 1024 / 1024, duration = duration, peak = peak / 1024 / 1024))
+    package.close()
+    os.remove(file_name)
+    os.rmdir(os.path.dirname(file_name))
+
+
+if __name__ == "__main__":
+    main()
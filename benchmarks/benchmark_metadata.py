@@ -0,0 +1,63 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of metadata lookups and writing metadata in large packages.
+#
+#   Creates a package with many resources and many metadata keys, then times
+#   writing the package and querying subtrees of the metadata. For reference,
+#   the same subtree queries are also timed with a linear scan over all keys.
+#
+#   Usage: python3 benchmarks/benchmark_metadata.py [number of metadata keys]
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention
+from Charon.OpenMode import OpenMode
+
+KEYS_PER_FILE = 400
+
+
+def createPackage(num_keys: int) -> io.BytesIO:
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    num_files = num_keys // KEYS_PER_FILE
+    for file_index in range(num_files):
+        package.setData({"/files/file{}.txt".format(file_index): b"Some data."})
+    metadata = {}
+    for key_index in range(num_keys):
+        metadata["/files/file{}.txt/setting{}".format(key_index % num_files, key_index)] = key_index
+    package.setMetadata(metadata)
+    package.close()
+    stream.seek(0)
+    return stream
+
+
+def linearScan(package: OpenPackagingConvention, virtual_path: str) -> dict:
+    return {key: value for key, value in package._metadata.items() if key.startswith(virtual_path + "/")}
+
+
+def main() -> None:
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_files = num_keys // KEYS_PER_FILE
+
+    write_time = timeit.timeit(lambda: createPackage(num_keys), number = 1)
+    print("Writing {keys} metadata keys over {files} files: {time:.3f}s".format(keys = num_keys, files = num_files, time = write_time))
+
+    package = OpenPackagingConvention()
+    package.openStream(createPackage(num_keys))
+    queries = ["/files/file{}.txt".format(index) for index in range(0, num_files, max(1, num_files // 100))]
+
+    indexed_time = timeit.timeit(lambda: [package.getMetadata(query) for query in queries], number = 10)
+    linear_time = timeit.timeit(lambda: [linearScan(package, query) for query in queries], number = 10)
+    print("{count} subtree queries, indexed: {time:.4f}s".format(count = len(queries) * 10, time = indexed_time))
+    print("{count} subtree queries, linear scan: {time:.4f}s".format(count = len(queries) * 10, time = linear_time))
+    package.close()
+
+
+if __name__ == "__main__":
+    main()
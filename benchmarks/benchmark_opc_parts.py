@@ -0,0 +1,31 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of reading and writing the relationships files of packages.
+#
+#   Times writing and reading a relationships document with many relations,
+#   with the streaming parser and templates and with ElementTree.
+#
+#   Usage: python3 benchmarks/benchmark_opc_parts.py [number of relations]
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.OPCParts import Relationship, parseRelationships, serializeRelationships
+
+
+def main() -> None:
+    num_relations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    relationships = [Relationship("/files/file{}.txt.json".format(index), "http://schemas.ultimaker.org/package/2018/relationships/opc_metadata", "rel{}".format(index), "") for index in range(num_relations)]
+    data = serializeRelationships(relationships)
+
+    for use_element_tree, name in ((False, "streaming parser and templates"), (True, "ElementTree")):
+        write_time = timeit.timeit(lambda: serializeRelationships(relationships, use_element_tree), number = 10) / 10
+        read_time = timeit.timeit(lambda: parseRelationships(data, use_element_tree), number = 10) / 10
+        print("{count} relations with {name}: writing {write:.4f}s, reading {read:.4f}s".format(count = num_relations, name = name, write = write_time, read = read_time))
+
+
+if __name__ == "__main__":
+    main()
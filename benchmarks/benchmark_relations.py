@@ -0,0 +1,55 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# libCharon is released under the terms of the LGPLv3 or higher.
+
+##  Benchmark of adding relations and content types to large packages.
+#
+#   Writes a package with many resources, each with some metadata of its own
+#   and a relation from the root, so that writing the package adds two
+#   relations per resource. Then adds content types for many extensions.
+#
+#   Usage: python3 benchmarks/benchmark_relations.py [number of resources]
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention
+from Charon.OpenMode import OpenMode
+
+
+def writePackage(num_resources: int) -> io.BytesIO:
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    for index in range(num_resources):
+        virtual_path = "/files/file{}.txt".format(index)
+        package.setData({virtual_path: b"Some data."})
+        package.setMetadata({virtual_path + "/index": index})
+        package.addRelation(virtual_path, "http://example.com/relationships/file")
+    package.close()
+    stream.seek(0)
+    return stream
+
+
+def addContentTypes(num_types: int) -> None:
+    package = OpenPackagingConvention()
+    package.openStream(io.BytesIO(), mode = OpenMode.WriteOnly)
+    for index in range(num_types):
+        package.addContentType("ext{}".format(index), "application/x-ext{}".format(index))
+    package.close()
+
+
+def main() -> None:
+    num_resources = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    write_time = timeit.timeit(lambda: writePackage(num_resources), number = 1)
+    print("Writing {count} resources with metadata and relations: {time:.3f}s".format(count = num_resources, time = write_time))
+
+    content_types_time = timeit.timeit(lambda: addContentTypes(num_resources), number = 1)
+    print("Adding {count} content types: {time:.3f}s".format(count = num_resources, time = content_types_time))
+
+
+if __name__ == "__main__":
+    main()
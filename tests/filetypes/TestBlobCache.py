@@ -0,0 +1,82 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import io #To create fake streams to write to and read from.
+import zipfile #To inspect the contents of the zip archives.
+
+from Charon.filetypes.BlobCache import BlobCache #The class we're testing.
+from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention #To share resources between packages.
+from Charon.OpenMode import OpenMode #To open archives.
+
+
+#### Now follow the actual tests. ####
+
+##  Tests that the entries that were used least recently are dropped when the
+#   cache is full.
+def test_leastRecentlyUsed():
+    cache = BlobCache(size_limit = 10)
+    cache.put("data", 1, 4, b"1111")
+    cache.put("data", 2, 4, b"2222")
+    assert cache.get("data", 1, 4) == b"1111" #Now 2 was used least recently.
+    cache.put("data", 3, 4, b"3333")
+    assert cache.get("data", 2, 4) is None
+    assert cache.get("data", 1, 4) == b"1111"
+    assert cache.get("data", 3, 4) == b"3333"
+    assert cache.size == 8
+
+    cache.put("data", 4, 11, b"Way too big")
+    assert cache.get("data", 4, 11) is None
+    assert len(cache) == 2
+
+##  Tests that entries are not used for resources with a different SHA-256.
+def test_sha256():
+    cache = BlobCache()
+    cache.put("deflated", 1, 4, b"abcd", sha256 = b"first")
+    assert cache.get("deflated", 1, 4, b"first") == b"abcd"
+    assert cache.get("deflated", 1, 4) == b"abcd" #Unknown, so it's trusted.
+    assert cache.get("deflated", 1, 4, b"second") is None
+    assert cache.get("data", 1, 4, b"first") is None #Different kind.
+
+##  Tests sharing a resource between packages that are written and read.
+def test_sharedResource():
+    cache = BlobCache()
+    toolpath = b"".join("G1 X{x} Y{y}\n".format(x = i % 100, y = i % 70).encode("UTF-8") for i in range(10000))
+    archives = []
+    for index in range(2):
+        stream = io.BytesIO()
+        package = OpenPackagingConvention()
+        package.openStream(stream, mode = OpenMode.WriteOnly, blob_cache = cache)
+        package.setData({"/toolpath.gcode": toolpath, "/name.txt": "Package {index}".format(index = index).encode("UTF-8")})
+        package.close()
+        archives.append(stream)
+    assert len(cache) == 3 #The compressed toolpath, and the compressed names of both packages.
+    for stream in archives:
+        archive = zipfile.ZipFile(stream)
+        assert archive.read("/toolpath.gcode") == toolpath
+        assert archive.getinfo("/toolpath.gcode").compress_size == len(cache.get("deflated", zipfile.crc32(toolpath), len(toolpath)))
+
+    cache.clear()
+    for stream in archives:
+        stream.seek(0)
+        package = OpenPackagingConvention()
+        package.openStream(stream, blob_cache = cache)
+        assert package.getData("/toolpath.gcode") == {"/toolpath.gcode": toolpath}
+        package.close()
+    assert cache.get("data", zipfile.crc32(toolpath), len(toolpath)) == toolpath
+    assert len(cache) == 2 #Data and compressed data of the toolpath, which is the same in both packages.
+
+##  Tests that the data of a resource is not taken from an entry of a different
+#   resource that has the same CRC-32 and size.
+def test_sameCrcDifferentResource():
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath.gcode": b"G1 X1\n" * 100})
+    package.close()
+
+    cache = BlobCache()
+    cache.put("data", zipfile.crc32(b"G1 X1\n" * 100), 600, b"G1 X2\n" * 100, sha256 = b"Digest of another resource")
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream, blob_cache = cache)
+    assert package.getData("/toolpath.gcode") == {"/toolpath.gcode": b"G1 X1\n" * 100}
+    package.close()
@@ -0,0 +1,124 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import io #To create fake streams to read from.
+import pytest #This module contains unit tests.
+
+from Charon.OpenMode import OpenMode #To write a package with moves.
+from Charon.filetypes.GCodeAnalyzer import GCodeAnalyzer, MoveDtype #The class we're testing. It can be imported without NumPy.
+from Charon.filetypes.GCodeFile import GCodeFile #To test the analysis of G-code files without header.
+from Charon.filetypes.UltimakerFormatPackage import UltimakerFormatPackage #To test the moves of the toolpath of packages.
+
+numpy = pytest.importorskip("numpy") #The analyzer requires NumPy. Also to compare the moves.
+
+##  G-code without header, with two extruders, two heights, a reset of the
+#   extruder position, relative extrusion, a retraction and a dwell.
+moves_gcode = b"G28\n" \
+    b"G1 F1200 X10 Y10 Z0.2\n" \
+    b"G1 X20 E1\n" \
+    b"G1 Y20 E2 ;X99 E99\n" \
+    b"T1\n" \
+    b"G92 E0\n" \
+    b"G1 X10 E0.5\n" \
+    b"G0 Z0.4\n" \
+    b"M83\n" \
+    b"G1 X20 E1\n" \
+    b"G1 X20.5 E-0.5\n" \
+    b"G4 P500"
+
+
+#### Now follow the actual tests. ####
+
+##  Tests the results of the analysis, regardless of how the file is chopped
+#   up.
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_build(chunk_size: int):
+    analyzer = GCodeAnalyzer.build(io.BytesIO(moves_gcode), chunk_size = chunk_size)
+    assert analyzer.move_count == 7
+    assert analyzer.filament == {0: pytest.approx(2), 1: pytest.approx(1)} #The retraction is subtracted.
+    assert analyzer.minimum == pytest.approx([10, 10, 0.2])
+    assert analyzer.maximum == pytest.approx([20, 20, 0.4]) #The retraction at X20.5 isn't printed.
+    assert analyzer.layerCount() == 2 #No layer markers, so by height.
+    assert analyzer.time > 0.5 #At least the dwell.
+
+    reference = GCodeAnalyzer.build(io.BytesIO(moves_gcode)).toMetadata()
+    assert analyzer.toMetadata() == pytest.approx(reference)
+
+
+##  Tests that numbers that are not well-formed are ignored.
+def test_malformedNumbers():
+    analyzer = GCodeAnalyzer.build(io.BytesIO(b"G1 X1.2.3 Y5 E1\nG1 X- Y-6-\nG1 X Y2 Z.5 E2\nG1 X+-1 E-.5\n"))
+    assert analyzer.move_count == 4
+    assert analyzer.minimum == pytest.approx([0, 0, 0]) #From the origin.
+    assert analyzer.maximum == pytest.approx([0, 5, 0.5])
+    assert analyzer.filament == {0: pytest.approx(-0.5)}
+
+
+##  Tests that commands are recognised in lowercase and after whitespace, the
+#   same as the header of G-code files is.
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_normalisedCommands(chunk_size: int):
+    normalised = GCodeAnalyzer.build(io.BytesIO(moves_gcode), chunk_size = chunk_size).toMetadata()
+    mixed = b"\n".join((b"  \t" if index % 2 else b"") + (line.lower() if index % 3 else line) for index, line in enumerate(moves_gcode.split(b"\n")))
+    assert GCodeAnalyzer.build(io.BytesIO(mixed), chunk_size = chunk_size).toMetadata() == pytest.approx(normalised)
+
+
+##  Tests counting layers by their markers when there are some.
+def test_layerMarkers():
+    analyzer = GCodeAnalyzer.build(io.BytesIO(b";LAYER:0\nG1 X1 Z0.2 E1\n;LAYER:1\nG1 X2 Z0.2 E2\nG1 X2 Y1 ;LAYER:5\n"))
+    assert analyzer.layerCount() == 2
+
+
+##  Tests that the analysis is in the metadata of G-code files that are opened
+#   to be analysed, even if they have no header.
+def test_gcodeFileAnalysis():
+    gcode = GCodeFile()
+    gcode.openStream(io.BytesIO(moves_gcode), "text/x-gcode", analyze = True)
+    metadata = gcode.getData("/metadata/toolpath/default/analysis")
+    assert metadata["/metadata/toolpath/default/analysis/layer_count"] == 2
+    assert metadata["/metadata/toolpath/default/analysis/bounding_box/max/y"] == 20
+    assert metadata["/metadata/toolpath/default/analysis/filament/1"] == pytest.approx(1)
+    assert gcode.getStream("/toolpath").read() == moves_gcode #The analysis doesn't disturb the toolpath stream.
+
+    gcode = GCodeFile()
+    with pytest.raises(Exception): #Without analysis, the header is required.
+        gcode.openStream(io.BytesIO(moves_gcode), "text/x-gcode")
+
+
+##  Tests collecting the moves, regardless of how the file is chopped up.
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_iterMoves(chunk_size: int):
+    gcode = b";LAYER:0\n" + moves_gcode + b"\n;LAYER:1\nG1 X5"
+    moves = numpy.concatenate(list(GCodeAnalyzer.iterMoves(io.BytesIO(gcode), chunk_size = chunk_size)))
+    assert moves.dtype == MoveDtype
+    assert moves["x"].tolist() == [10, 20, 20, 10, 10, 20, 20.5, 5]
+    assert moves["z"].tolist() == pytest.approx([0.2, 0.2, 0.2, 0.2, 0.4, 0.4, 0.4, 0.4])
+    assert moves["e"].tolist() == pytest.approx([0, 1, 1, 0.5, 0, 1, -0.5, 0]) #Per move, also in absolute mode.
+    assert moves["f"].tolist() == [1200] * 8
+    assert moves["layer"].tolist() == [0] * 7 + [1]
+    assert moves["extruder"].tolist() == [0, 0, 0, 1, 1, 1, 1, 1]
+    assert moves["type"].tolist() == [GCodeAnalyzer.Travel, GCodeAnalyzer.Extrusion, GCodeAnalyzer.Extrusion, GCodeAnalyzer.Extrusion, GCodeAnalyzer.Travel, GCodeAnalyzer.Extrusion, GCodeAnalyzer.Retraction, GCodeAnalyzer.Travel]
+
+
+##  Tests getting the moves of G-code files and of the toolpath of packages, as
+#   bytes and as record arrays.
+def test_moves():
+    gcode = GCodeFile()
+    gcode.openStream(io.BytesIO(moves_gcode), "text/x-gcode", analyze = True)
+    expected = numpy.concatenate(list(GCodeAnalyzer.iterMoves(io.BytesIO(moves_gcode))))
+    assert gcode.getData("/toolpath/default/moves") == {"/toolpath/default/moves": expected.tobytes()}
+    stream = gcode.getStream("/toolpath/moves")
+    assert numpy.concatenate(list(stream.chunks())).tobytes() == expected.tobytes()
+    assert gcode.getStream("/toolpath").read() == moves_gcode #Getting moves doesn't disturb the toolpath stream.
+
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath": b";FLAVOR:UltiGCode\n;END_OF_HEADER\n" + moves_gcode}) #Packages need a header.
+    package.close()
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    moves = package.getStream("/toolpath/default/moves")
+    assert moves.read(MoveDtype.itemsize + 1) == expected[:1].tobytes() + expected[1:].tobytes()[:1]
+    assert numpy.concatenate(list(moves.chunks())).tobytes() == expected[2:].tobytes() #The partly read move is left out.
+    package.close()
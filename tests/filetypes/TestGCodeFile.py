@@ -1,7 +1,13 @@
+import gzip
 import io
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 from Charon.filetypes.GCodeFile import GCodeFile, InvalidHeaderException
+from Charon.filetypes.GCodeGzFile import GCodeGzFile
 
 
 class TestGcodeFile(unittest.TestCase):
@@ -241,3 +247,64 @@ class TestGcodeFile(unittest.TestCase):
 
         self.assertEqual(metadata["a"]["b"]["c"], '')
 
+
+    def testParseHeader_SameAsLiteralEval(self) -> None:
+        values = ["5", "-0", "007", "1.", ".5", "1e5", "(1, 2.5)", "(1,)", "(1)", "[1, 2]", "'quoted'", "True", "True #comment", "None",
+                  "Ultimaker 3", "4.0.0", "2018-11-01", "PLA-Generic", "0x10", "1_000", "1+2j", "...",
+                  "set()", "frozenset()", "set ()", "Ultimaker (beta)", "{}", "{1, 2}"]
+        for value in values:
+            gcode = self.__minimal_griffin_header.format(";A.B:{}\n;A.C.D:{}".format(value, value))
+            fast = GCodeFile.parseHeader(io.BytesIO(str.encode(gcode)))
+            literal_eval = GCodeFile.parseHeader(io.BytesIO(str.encode(gcode)), use_literal_eval = True)
+            self.assertEqual(repr(fast), repr(literal_eval), value)
+
+        gcode = self.__minimal_griffin_header.format(";A.B:set()")
+        expected = set() if sys.version_info >= (3, 9) else "set()" #Only a literal since Python 3.9.
+        self.assertEqual(GCodeFile.parseHeader(io.BytesIO(str.encode(gcode)))["a"]["b"], expected)
+
+        with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_stream:
+            self.assertEqual(GCodeFile.parseHeader(gcode_stream), GCodeFile.parseHeader(gcode_stream, use_literal_eval = True))
+
+    def testIterData(self) -> None:
+        resources = os.path.join(os.path.dirname(__file__), "resources")
+        with open(os.path.join(resources, "um3.gcode"), "rb") as gcode_file:
+            data = gcode_file.read()
+        with tempfile.TemporaryDirectory() as directory: #Work on copies, so that nothing is written next to the resources.
+            for name in ["um3.gcode", "um3.gcode.gz"]:
+                shutil.copy(os.path.join(resources, name), directory)
+            for gcode, stream in [(GCodeFile(), open(os.path.join(directory, "um3.gcode"), "rb")),
+                                  (GCodeGzFile(), gzip.open(os.path.join(directory, "um3.gcode.gz"), "rb"))]:
+                gcode.openStream(stream, gcode.mime_type)
+                stream = gcode.getStream("/toolpath")
+                stream.seek(10)
+                chunks = gcode.iterData("/toolpath", chunk_size = 100)
+                first_chunk = next(chunks)
+                stream.read(5) #Reading the toolpath stream in between doesn't disturb the chunks.
+                self.assertEqual(first_chunk + b"".join(chunks), data)
+                self.assertEqual(stream.tell(), 10) #And the stream is put back afterwards.
+                self.assertEqual(b"".join(gcode.iterData("/toolpath/default", chunk_size = 7, offset = 100, count = 50)), data[100:150])
+                self.assertEqual(list(gcode.iterData("/toolpath/default/layer/9999")), [])
+                gcode.close()
+
+    def testMemoryMap(self) -> None:
+        data = b";FLAVOR:UltiGCode\n;LAYER:0\nG1 X1\n;LAYER:1\nG1 X2\nG1 X3"
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "mapped.gcode")
+            with open(file_name, "wb") as gcode_file:
+                gcode_file.write(data)
+
+            for memory_map in [True, False]:
+                gcode = GCodeFile()
+                gcode.openStream(open(file_name, "rb"), "text/x-gcode", memory_map = memory_map)
+                self.assertEqual([bytes(line) for line in gcode.iterLines()], data.splitlines(keepends = True))
+                self.assertEqual([bytes(line) for line in gcode.iterLines(offset = 18, count = 15)], [b";LAYER:0\n", b"G1 X1\n"])
+                self.assertEqual(b"".join(gcode.iterData("/toolpath", chunk_size = 4, offset = 1, count = 6)), data[1:7])
+                layer = gcode.getData("/toolpath/default/layer/1")["/toolpath/default/layer/1"]
+                self.assertEqual(bytes(layer), b";LAYER:1\nG1 X2\nG1 X3")
+                self.assertEqual(gcode.getData("/toolpath/default/layer/2"), {})
+                if memory_map:
+                    self.assertIsInstance(layer, memoryview) #Not copied.
+                    self.assertEqual(bytes(gcode.getData("/toolpath")["/toolpath"]), data)
+                gcode.close() #Even while the memoryview of the layer is in use.
+                self.assertEqual(bytes(layer), b";LAYER:1\nG1 X2\nG1 X3")
+                del layer
@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import gzip #To test caching the index of compressed files.
+import io #To create fake streams to read from.
+import json #To change the cached index.
+import os #To find the test resources.
+import pytest #This module contains unit tests.
+
+from Charon.filetypes.GCodeFile import GCodeFile #To test the layers of plain G-code files.
+from Charon.filetypes.GCodeGzFile import GCodeGzFile #To test the layers of compressed G-code files.
+from Charon.filetypes.GCodeLayerIndex import GCodeLayerIndex #The class we're testing.
+
+##  G-code with a header, three layers and a comment that looks like a layer
+#   marker but isn't at the start of a line.
+layered_gcode = b";FLAVOR:UltiGCode\nM104 S200\n;LAYER:0\nG1 X1 ;LAYER:5\nG1 X2\n;LAYER:1\nG1 X3\n;LAYER:2\nG1 X4\nM104 S0"
+
+
+#### Now follow the actual tests. ####
+
+##  Tests that the index is the same, regardless of how the file is chopped up.
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1024])
+def test_build(chunk_size: int):
+    index = GCodeLayerIndex.build(io.BytesIO(layered_gcode), chunk_size = chunk_size)
+    assert index.numbers == [0, 1, 2]
+    assert index.offsets == [layered_gcode.find(b";LAYER:0"), layered_gcode.find(b";LAYER:1"), layered_gcode.find(b";LAYER:2")]
+    assert index.lines == [2, 5, 7]
+    assert index.size == len(layered_gcode)
+    start, end = index.range(1)
+    assert layered_gcode[start:end] == b";LAYER:1\nG1 X3\n"
+    assert layered_gcode[slice(*index.range(2))] == b";LAYER:2\nG1 X4\nM104 S0" #The last layer lasts until the end.
+    with pytest.raises(KeyError):
+        index.range(5)
+
+
+##  Tests storing and restoring the index.
+def test_toDictFromDict():
+    index = GCodeLayerIndex.build(io.BytesIO(layered_gcode))
+    restored = GCodeLayerIndex.fromDict(index.toDict())
+    assert restored.toDict() == index.toDict()
+    assert restored.range(0) == index.range(0)
+    with pytest.raises(ValueError):
+        GCodeLayerIndex.fromDict({"size": 10})
+
+
+##  Tests getting layers from a plain G-code file, without caching the index
+#   unless asked to.
+def test_gcodeFileLayers(tmpdir):
+    file_name = os.path.join(str(tmpdir), "layers.gcode")
+    with open(file_name, "wb") as gcode_file:
+        gcode_file.write(layered_gcode)
+
+    gcode = GCodeFile()
+    gcode.openStream(open(file_name, "rb"), "text/x-gcode")
+    assert gcode.getData("/toolpath/default/layer/1") == {"/toolpath/default/layer/1": b";LAYER:1\nG1 X3\n"}
+    assert gcode.getStream("/toolpath/layer/0").read() == b";LAYER:0\nG1 X1 ;LAYER:5\nG1 X2\n"
+    assert gcode.getStream("/toolpath").read() == layered_gcode #Getting layers doesn't disturb the toolpath stream.
+    gcode.close()
+    assert os.listdir(str(tmpdir)) == ["layers.gcode"] #Nothing is written next to the file.
+
+
+##  Tests that the index is written to the cache directory and used the next
+#   time, as long as the file is the same.
+def test_gcodeFileLayerCache(tmpdir, monkeypatch):
+    file_name = os.path.join(str(tmpdir), "layers.gcode.gz")
+    with gzip.open(file_name, "wb") as gcode_file:
+        gcode_file.write(layered_gcode)
+    cache_directory = os.path.join(str(tmpdir), "cache")
+
+    for attempt in range(2):
+        gcode = GCodeGzFile()
+        gcode.openStream(gzip.open(file_name, "rb"), gcode.mime_type, layer_cache = cache_directory)
+        assert gcode.getData("/toolpath/default/layer/1") == {"/toolpath/default/layer/1": b";LAYER:1\nG1 X3\n"}
+        gcode.close()
+        cache_names = os.listdir(cache_directory)
+        assert len(cache_names) == 1 and cache_names[0].startswith("layers.gcode.gz.")
+        monkeypatch.setattr(GCodeLayerIndex, "feed", None) #The second time, the cached index must be used.
+    monkeypatch.undo()
+
+    cache_name = os.path.join(cache_directory, cache_names[0])
+    with open(cache_name) as cache_file:
+        cached = json.load(cache_file)
+    assert cached["size"] == len(layered_gcode) #The size of the G-code, not of the compressed file.
+    cached["size"] += 1 #Pretend that the G-code changed but the file's time didn't.
+    with open(cache_name, "w") as cache_file:
+        json.dump(cached, cache_file)
+    gcode = GCodeGzFile()
+    gcode.openStream(gzip.open(file_name, "rb"), gcode.mime_type, layer_cache = cache_directory)
+    assert gcode.getData("/toolpath/default/layer/2") == {"/toolpath/default/layer/2": b";LAYER:2\nG1 X4\nM104 S0"} #Built again.
+    gcode.close()
+    with open(cache_name) as cache_file:
+        assert json.load(cache_file)["size"] == len(layered_gcode)
@@ -0,0 +1,37 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import pytest #This module contains unit tests.
+
+from Charon.filetypes.MetadataIndex import MetadataIndex #The class we're testing.
+
+
+##  Tests finding the keys in a subtree, without matching on siblings that
+#   merely share the same beginning.
+@pytest.mark.parametrize("prefix, expected", [
+    ("/foo/", ["/foo/a", "/foo/b/c"]),
+    ("/foo/b/", ["/foo/b/c"]),
+    ("/foobar/", ["/foobar/x"]),
+    ("/nothing/", []),
+    ("", ["/foo", "/foo/a", "/foo/b/c", "/foobar/x", "/zoo"])
+])
+def test_keysWithPrefix(prefix: str, expected):
+    index = MetadataIndex({"/foo": 1, "/foo/a": 2, "/foo/b/c": 3, "/foobar/x": 4, "/zoo": 5})
+    assert index.keysWithPrefix(prefix) == expected
+
+
+##  Tests that the index stays in sync when the dictionary is modified.
+def test_keysWithPrefixAfterChanges():
+    index = MetadataIndex()
+    index["/foo/b"] = 1
+    assert index.keysWithPrefix("/foo/") == ["/foo/b"]
+
+    index["/foo/a"] = 2 #Inserted while the sorted keys are already known.
+    index.update({"/foo/c": 3, "/bar/a": 4})
+    assert index.keysWithPrefix("/foo/") == ["/foo/a", "/foo/b", "/foo/c"]
+
+    del index["/foo/b"]
+    index.pop("/foo/c")
+    assert index.keysWithPrefix("/foo/") == ["/foo/a"]
+
+    index.clear()
+    assert index.keysWithPrefix("/foo/") == []
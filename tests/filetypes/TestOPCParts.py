@@ -0,0 +1,66 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import pytest #This module contains unit tests.
+import sys #To check the version of ElementTree.
+import xml.etree.ElementTree as ET #To check that the parts can be read as XML.
+
+from Charon.filetypes.OPCParts import ContentType, Relationship, parseContentTypes, parseRelationships, serializeContentTypes, serializeRelationships #The functions we're testing.
+
+##  Relationships with characters that need escaping and an optional attribute.
+relationships = [
+    Relationship("/a&b.txt", "Quotes \" and <brackets>\tand\nlines", "rel0", ""),
+    Relationship("http://example.com/", "Some relation.", "rel1", "External")
+]
+
+##  Content types of both kinds.
+content_types = [
+    ContentType("Default", "rels", "application/vnd.openxmlformats-package.relationships+xml"),
+    ContentType("Override", "/Metadata/thumbnail.png", "image/png")
+]
+
+
+#### Now follow the actual tests. ####
+
+##  Tests that the streaming parser and templates give the same results as
+#   ElementTree.
+#
+#   Before Python 3.8, ElementTree sorts the attributes, so then only the
+#   contents of the written documents are the same, not their bytes.
+@pytest.mark.parametrize("write_with_element_tree", [False, True])
+@pytest.mark.parametrize("read_with_element_tree", [False, True])
+def test_roundTrip(write_with_element_tree: bool, read_with_element_tree: bool):
+    same_bytes = sys.version_info >= (3, 8)
+    data = serializeRelationships(relationships, write_with_element_tree)
+    other_data = serializeRelationships(relationships, not write_with_element_tree)
+    assert data == other_data or not same_bytes
+    assert parseRelationships(data, read_with_element_tree) == parseRelationships(other_data, read_with_element_tree) == relationships
+
+    data = serializeContentTypes(content_types, write_with_element_tree)
+    other_data = serializeContentTypes(content_types, not write_with_element_tree)
+    assert data == other_data or not same_bytes
+    assert parseContentTypes(data, read_with_element_tree) == parseContentTypes(other_data, read_with_element_tree) == content_types
+
+    assert serializeRelationships([], write_with_element_tree) == serializeRelationships([], not write_with_element_tree)
+    ET.fromstring(serializeRelationships([], write_with_element_tree)) #Must be valid XML.
+
+
+##  Tests reading documents written by others, with namespace prefixes, single
+#   quotes, character references, comments and relations without a type.
+@pytest.mark.parametrize("use_element_tree", [False, True])
+def test_parseForeign(use_element_tree: bool):
+    data = b"""<?xml version="1.0" encoding="UTF-8"?>
+<r:Relationships xmlns:r="http://schemas.openxmlformats.org/package/2006/relationships">
+  <r:Relationship Id='rId1' Type="a&#x41;&#65;&gt;" Target='/3D/model.gcode'/>
+  <r:Relationship Id="rId2" Target="/no_type.txt"></r:Relationship>
+</r:Relationships>"""
+    assert parseRelationships(data, use_element_tree) == [Relationship("/3D/model.gcode", "aAA>", "rId1", "")]
+
+    commented = data.replace(b"<r:Relationship Id='rId1'", b"<!-- <r:Relationship Id='rId0' Type='x' Target='y'/> --><r:Relationship Id='rId1'")
+    assert parseRelationships(commented, use_element_tree) == [Relationship("/3D/model.gcode", "aAA>", "rId1", "")]
+
+
+##  Tests that both ways of reading give the same error for invalid XML.
+@pytest.mark.parametrize("use_element_tree", [False, True])
+def test_parseInvalid(use_element_tree: bool):
+    with pytest.raises(ET.ParseError):
+        parseContentTypes(b"<Types><Default Extension=\"rels\"></Types>", use_element_tree)
@@ -1,8 +1,10 @@
 # Copyright (c) 2018 Ultimaker B.V.
 # Charon is released under the terms of the LGPLv3 or higher.
+from concurrent.futures import ThreadPoolExecutor #To read from multiple threads at once.
 import io #To create fake streams to write to and read from.
 import os #To find the resources with test packages.
 import pytest #This module contains unit tests.
+import random #To read at random positions.
 import zipfile #To inspect the contents of the zip archives.
 import xml.etree.ElementTree as ET #To inspect the contents of the OPC-spec files in the archives.
 from collections import OrderedDict
@@ -10,6 +12,11 @@ from typing import List, Generator
 
 from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention, OPCError  # The class we're testing.
 from Charon.OpenMode import OpenMode #To open archives.
+from Charon.filetypes.BlobCache import BlobCache #To write through a blob cache.
+from Charon.filetypes.DeflateSeekIndex import DeflateSeekIndex #To seek in compressed resources.
+from Charon.filetypes.PngImage import PngImage #To check resized images.
+from Charon.filetypes.WriteOptions import WriteOptions #To write packages in different ways.
+from Charon.filetypes.ZipInternals import ZipInternals #To test writing without the private attributes of the zipfile module.
 
 ##  Returns an empty package that you can read from.
 #
@@ -183,6 +190,15 @@ def test_toByteArray(single_resource_read_opc):
     assert len(result) == original_length #Should be limited to the actual file length.
 
 
+##  Tests getting the data of resources in chunks.
+def test_iterData(single_resource_read_opc):
+    assert list(single_resource_read_opc.iterData("/hello.txt", chunk_size = 5)) == [b"Hello", b" worl", b"d!\n"]
+    assert list(single_resource_read_opc.iterData("/hello.txt", chunk_size = 3, offset = 2, count = 4)) == [b"llo", b" "]
+    assert list(single_resource_read_opc.iterData("/hello.txt", offset = 20)) == []
+    assert list(single_resource_read_opc.iterData("/nonexistent.txt")) == []
+    assert list(single_resource_read_opc.iterData("/metadata")) == [] #Only resources.
+
+
 ##  Tests toByteArray when loading from a stream.
 def test_toByteArrayStream():
     stream = io.BytesIO()
@@ -259,6 +275,40 @@ def test_addRelation():
     assert both_relations[0].attrib["Id"] != both_relations[1].attrib["Id"] #Id must be unique.
 
 
+##  Tests that relations added to an existing package get IDs that weren't used
+#   yet, and that duplicate relations and content types are refused.
+def test_addRelationExisting():
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/a.txt": b"A", "/b.txt": b"B", "/c.txt": b"C"})
+    package.addRelation("/a.txt", "Some relation.")
+    package.addRelation("/b.txt", "Some relation.")
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.ReadWrite)
+    with pytest.raises(OPCError):
+        package.addRelation("/a.txt", "Some relation.") #Already exists in the file.
+    package.addRelation("/c.txt", "Some relation.")
+    with pytest.raises(OPCError):
+        package.addRelation("/c.txt", "Some relation.") #Was just added.
+    with pytest.raises(OPCError):
+        package.addContentType("rels", "text/plain") #Exists in every package.
+    package.addContentType("lol", "audio/x-laughing")
+    with pytest.raises(OPCError):
+        package.addContentType("lol", "audio/x-laughing")
+    package.close()
+
+    stream.seek(0)
+    archive = zipfile.ZipFile(stream)
+    relations_element = ET.fromstring(archive.open("/_rels/.rels").read())
+    ids = [relation.attrib["Id"] for relation in relations_element]
+    assert len(ids) == 3
+    assert len(set(ids)) == 3 #Ids must be unique.
+
+
 ##  Tests getting the size of a file.
 #
 #   This is implemented knowing the contents of single_resource_read_opc.
@@ -266,3 +316,244 @@ def test_getMetadataSize(single_resource_read_opc):
     metadata = single_resource_read_opc.getMetadata("/hello.txt/size")
     assert "/metadata/hello.txt/size" in metadata
     assert metadata["/metadata/hello.txt/size"] == len("Hello world!\n".encode("UTF-8")) #Compare with the length of the file's contents as encoded in UTF-8.
+
+
+##  Tests getting the size of a file that was written by this library.
+#
+#   The resources written by this library have an initial slash in their names
+#   in the archive, unlike the resources in the test packages.
+def test_getMetadataSizeWritten():
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/dir/hello.txt": b"Hello world!"})
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream)
+    metadata = package.getMetadata("/dir/hello.txt/size")
+    assert metadata["/metadata/dir/hello.txt/size"] == len(b"Hello world!")
+    assert package.getMetadata("/dir/nonexistent.txt/size") == {}
+
+
+##  Tests finding resources in the archive, including resized PNG images.
+@pytest.mark.parametrize("virtual_path, exists", [
+    ("/hello.txt", True),
+    ("/goodbye.txt", False),
+    ("/image.png", True),
+    ("/image.png/10x20", True),
+    ("/image.png/ 10 x 20 ", True),
+    ("/image.png/large", False),
+    ("/hello.txt/10x20", False),
+    ("/other.png/10x20", False)
+])
+def test_resourceExists(virtual_path: str, exists: bool):
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/hello.txt": b"Hello world!", "/image.png": b"Not really a PNG."})
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream)
+    assert package._resourceExists(virtual_path) == exists
+
+
+##  Tests that the compiled aliases follow when the aliases of an instance are
+#   replaced.
+def test_aliasesReassigned():
+    package = OpenPackagingConvention()
+    assert package._processAliases("materials") == "/materials" #No aliases by default. Just the slash is added.
+
+    package._aliases = OrderedDict([(r"/materials", "/files/materials")])
+    assert package._processAliases("/materials") == "/files/materials"
+
+    package._aliases = OrderedDict([(r"/materials", "/other/materials")])
+    assert package._processAliases("/materials") == "/other/materials"
+    assert OpenPackagingConvention()._processAliases("/materials") == "/materials" #Other instances are not affected.
+
+
+##  Tests getting ranges of the file as memory views, for a file on disk and
+#   for a stream in memory.
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_toMemoryView(in_memory: bool):
+    file_name = os.path.join(os.path.dirname(__file__), "resources", "hello.opc")
+    with open(file_name, "rb") as original_file:
+        original = original_file.read()
+    package = OpenPackagingConvention()
+    package.openStream(io.BytesIO(original) if in_memory else open(file_name, "rb"))
+
+    assert package.toMemoryView().tobytes() == original
+    assert package.toMemoryView(offset = 10, count = 8).tobytes() == original[10:18]
+    assert len(package.toMemoryView(offset = len(original) + 10)) == 0 #Reading beyond the end gives nothing.
+    assert package.getData("/hello.txt")["/hello.txt"] == b"Hello world!\n" #Reading ranges doesn't disturb reading resources.
+    package.close()
+
+
+##  Tests getting a resized version of an image in the package, which must be
+#   cached for the next request.
+def test_resizeImage():
+    with open(os.path.join(os.path.dirname(__file__), "resources", "gradient.png"), "rb") as image_file:
+        image = image_file.read()
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.getStream("/image.png").write(image)
+    package.close()
+
+    OpenPackagingConvention.resized_image_cache.clear()
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream)
+    resized = package.getStream("/image.png/10x12").read()
+    assert PngImage.decode(resized)[:2] == (10, 12)
+    assert len(OpenPackagingConvention.resized_image_cache) == 1
+    assert package.getStream("/image.png/10x12").read() == resized
+    assert len(OpenPackagingConvention.resized_image_cache) == 1 #Served from the cache.
+    package.close()
+
+
+##  Tests seeking in a big compressed resource, with a seek index that was
+#   stored when writing the package or one that is built while reading.
+@pytest.mark.parametrize("seek_index_interval", [0, 64 * 1024])
+def test_seekCompressed(seek_index_interval: int, monkeypatch):
+    monkeypatch.setattr(DeflateSeekIndex, "DefaultInterval", 100 * 1024) #Make building an index worthwhile for smaller resources.
+    data = b"".join("G1 X{x} Y{y} E{e}\n".format(x = i % 200, y = i % 170, e = i).encode("UTF-8") for i in range(50000))
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(seek_index_interval = seek_index_interval))
+    package.getStream("/toolpath.gcode").write(data)
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream)
+    assert ("/toolpath.gcode.seekindex" in package.listPaths()) == (seek_index_interval > 0)
+    resource = package.getStream("/toolpath.gcode")
+    for offset in [len(data) - 10, 400000, 10, 700000, 699990, 0]:
+        resource.seek(offset)
+        assert resource.read(100) == data[offset:offset + 100]
+    assert len(package._seek_indices["/toolpath.gcode"]) > 1
+    resource.seek(0)
+    assert resource.read() == data
+    package.close()
+
+
+##  Tests reading resources on many threads at once from the same package, from
+#   a file on disk and from a stream in memory.
+@pytest.mark.parametrize("on_disk", [True, False])
+def test_concurrentRead(on_disk: bool, tmpdir, monkeypatch):
+    monkeypatch.setattr(DeflateSeekIndex, "DefaultInterval", 100 * 1024) #Share a seek index between the threads.
+    compressed = b"".join("G1 X{x} Y{y} E{e}\n".format(x = i % 200, y = i % 170, e = i).encode("UTF-8") for i in range(50000))
+    stored = random.Random(42).getrandbits(8 * 200000).to_bytes(200000, "little")
+    stream = open(str(tmpdir.join("package.opc")), "w+b") if on_disk else io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setCompression(zipfile.ZIP_STORED, path = r"\.bin$")
+    package.setData({"/toolpath.gcode": compressed, "/noise.bin": stored, "/small.txt": b"Hello world!"})
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention()
+    package.openStream(stream, concurrent = True)
+    def readRandomly(seed: int) -> None:
+        generator = random.Random(seed)
+        streams = {virtual_path: package.getStream(virtual_path) for virtual_path in ["/toolpath.gcode", "/noise.bin", "/small.txt"]}
+        for _ in range(20):
+            for virtual_path, data in [("/toolpath.gcode", compressed), ("/noise.bin", stored), ("/small.txt", b"Hello world!")]:
+                offset = generator.randrange(len(data))
+                streams[virtual_path].seek(offset)
+                assert streams[virtual_path].read(1000) == data[offset:offset + 1000]
+        assert package.getData("/noise.bin") == {"/noise.bin": stored}
+        for resource in streams.values():
+            resource.close()
+    with ThreadPoolExecutor(max_workers = 8) as pool:
+        for result in [pool.submit(readRandomly, seed) for seed in range(8)]:
+            result.result() #Raises any failed assertion.
+    package.close()
+    stream.close()
+
+
+##  Tests writing many resources at once on different threads, with and without
+#   compressing in parallel.
+@pytest.mark.parametrize("compression_threads", [0, 2])
+def test_spooledWrite(compression_threads: int):
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(spool_threshold = 1000, compression_threads = compression_threads))
+    virtual_paths = ["/resource{index}.txt".format(index = index) for index in range(8)]
+    resources = [package.getStream(virtual_path) for virtual_path in virtual_paths] #All open at the same time.
+    def writeResource(index: int) -> None:
+        for line in range(1000):
+            resources[index].write("Line {line} of resource {index}.\n".format(line = line, index = index).encode("UTF-8"))
+        if index % 2 == 0: #The rest is closed by flushing.
+            resources[index].close()
+    with ThreadPoolExecutor(max_workers = 4) as pool:
+        for result in [pool.submit(writeResource, index) for index in reversed(range(len(resources)))]: #Closed in the opposite order.
+            result.result()
+    package.close()
+
+    stream.seek(0)
+    archive = zipfile.ZipFile(stream)
+    assert [name for name in archive.namelist() if name.startswith("/resource")] == virtual_paths #In the order in which they were opened.
+    for index, virtual_path in enumerate(virtual_paths):
+        assert archive.read(virtual_path) == b"".join("Line {line} of resource {index}.\n".format(line = line, index = index).encode("UTF-8") for line in range(1000))
+
+
+##  Tests writing packages with the options that write compressed data
+#   directly to the archive, when the zipfile module lacks the private
+#   attributes for that. Then the public interface of the zipfile module must be
+#   used instead.
+def test_writeWithoutZipInternals(monkeypatch):
+    source_stream = io.BytesIO()
+    source = OpenPackagingConvention()
+    source.openStream(source_stream, mode = OpenMode.WriteOnly)
+    source.setData({"/copied.txt": b"Copied " * 1000})
+    source.close()
+    source_stream.seek(0)
+    source = OpenPackagingConvention()
+    source.openStream(source_stream)
+
+    monkeypatch.setattr(ZipInternals, "supportsRawEntries", staticmethod(lambda zip_file: False))
+    def fail(*args, **kwargs):
+        raise AssertionError("The private attributes of the zipfile module may not be used.")
+    monkeypatch.setattr(ZipInternals, "beginRawEntry", staticmethod(fail))
+
+    big_resource = bytes(random.Random(1).getrandbits(8) for _ in range(200 * 1024))
+    stream = io.BytesIO()
+    package = OpenPackagingConvention()
+    package.openStream(stream, mode = OpenMode.WriteOnly, blob_cache = BlobCache(), write_options = WriteOptions(compression_threads = 2, seek_index_interval = 64 * 1024, spool_threshold = 1000))
+    package.setData({"/big.bin": big_resource, "/small.txt": b"Small"})
+    package.copyEntriesFrom(source, ["/copied.txt"])
+    package.close()
+    source.close()
+
+    stream.seek(0)
+    archive = zipfile.ZipFile(stream)
+    assert archive.testzip() is None
+    assert archive.read("/big.bin") == big_resource
+    assert archive.read("/small.txt") == b"Small"
+    assert archive.read("/copied.txt") == b"Copied " * 1000
+    assert "/big.bin.seekindex" not in archive.namelist() #Can't be made without compressing it in blocks.
+
+
+##  Tests finding where the data of resources starts in an archive from their
+#   local headers.
+def test_dataOffset():
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, "w") as archive:
+        archive.writestr("/first.txt", b"First")
+        archive.writestr(zipfile.ZipInfo("/second/with/a/longer/name.txt"), b"Second")
+    data = stream.getvalue()
+    read_range = lambda offset, count: data[offset:offset + count]
+
+    archive = zipfile.ZipFile(stream)
+    for zip_info, expected in zip(archive.infolist(), [b"First", b"Second"]):
+        offset = ZipInternals.dataOffset(zip_info, read_range)
+        assert data[offset:offset + zip_info.compress_size] == expected
+    with pytest.raises(zipfile.BadZipFile):
+        ZipInternals.dataOffset(archive.infolist()[1], lambda offset, count: b"\0" * count)
+    with pytest.raises(zipfile.BadZipFile):
+        ZipInternals.dataOffset(archive.infolist()[1], lambda offset, count: b"")
@@ -0,0 +1,60 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import os #To find the test image.
+import pytest #This module contains unit tests.
+
+import Charon.filetypes.PngImage #To disable NumPy in there.
+from Charon.filetypes.PngImage import PngImage #The class we're testing.
+
+##  The colour of each pixel in the gradient.png test resource.
+def gradientPixel(x: int, y: int) -> bytes:
+    return bytes((x * 6, y * 8, (x + y) * 3, 255 - x))
+
+##  Returns the data of gradient.png, a 40x30 RGBA image.
+@pytest.fixture()
+def gradient() -> bytes:
+    with open(os.path.join(os.path.dirname(__file__), "resources", "gradient.png"), "rb") as image_file:
+        return image_file.read()
+
+
+#### Now follow the actual tests. ####
+
+##  Tests decoding a PNG image that uses various filters.
+def test_decode(gradient: bytes):
+    width, height, pixels = PngImage.decode(gradient)
+    assert (width, height) == (40, 30)
+    for y in range(height):
+        for x in range(width):
+            assert pixels[(y * width + x) * 4:(y * width + x + 1) * 4] == gradientPixel(x, y)
+
+
+##  Tests that encoding and decoding an image gives the same image back.
+def test_encodeDecode():
+    pixels = bytes(range(256)) * 3
+    width, height, decoded = PngImage.decode(PngImage.encode(pixels, 16, 12))
+    assert (width, height) == (16, 12)
+    assert decoded == pixels
+
+
+##  Tests resizing an image, with and without NumPy.
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("width, height", [(20, 15), (40, 30), (100, 10), (1, 1)])
+def test_resize(gradient: bytes, use_numpy: bool, width: int, height: int, monkeypatch):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(Charon.filetypes.PngImage, "numpy", None)
+
+    resized_width, resized_height, pixels = PngImage.decode(PngImage.resize(gradient, width, height))
+    assert (resized_width, resized_height) == (width, height)
+    if (width, height) == (40, 30): #Same size, so it must be the same image.
+        assert pixels == PngImage.decode(gradient)[2]
+    if (width, height) == (20, 15): #Exactly half. Each pixel is the average of 2x2 pixels.
+        expected = (3, 4, 3, 254.5) #Average of (0, 0, 0, 255), (6, 0, 3, 254), (0, 8, 3, 255) and (6, 8, 6, 254).
+        assert all(abs(actual - wanted) <= 1 for actual, wanted in zip(pixels[:4], expected))
+
+
+##  Tests that invalid images are rejected.
+def test_decodeInvalid():
+    with pytest.raises(ValueError):
+        PngImage.decode(b"This is not a PNG image.")
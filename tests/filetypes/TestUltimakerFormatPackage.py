@@ -0,0 +1,392 @@
+# Copyright (c) 2018 Ultimaker B.V.
+# Charon is released under the terms of the LGPLv3 or higher.
+import io #To create fake streams to write to and read from.
+import json #To read the layer index.
+import os #To find the resources with test packages.
+import pytest #This module contains unit tests.
+import zipfile #To inspect the contents of the zip archives.
+
+from Charon.filetypes.GCodeFile import GCodeFile #To count how often the header gets parsed.
+from Charon.filetypes.GCodeLayerIndex import GCodeLayerIndex #To check that the stored layer index is used.
+from Charon.filetypes.OpenPackagingConvention import OpenPackagingConvention #To read packages without knowing that they are UFP files.
+from Charon.filetypes.UltimakerFormatPackage import UltimakerFormatPackage #The class we're testing.
+from Charon.OpenMode import OpenMode #To open archives.
+from Charon.filetypes.PngImage import PngImage #To check the sizes of previews.
+from Charon.filetypes.WriteOptions import WriteOptions #To write packages in different ways.
+
+##  Returns a stream containing a UFP file with a toolpath and a thumbnail.
+#
+#   The toolpath is the um3.gcode test resource. The thumbnail is not a valid
+#   PNG image, but that doesn't matter as long as it doesn't get resized.
+@pytest.fixture()
+def ufp_stream() -> io.BytesIO:
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read()
+
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath": gcode, "/preview": b"Pretend to be a PNG image."})
+    package.setMetadata({"/global/setting": 42})
+    package.close()
+    stream.seek(0)
+    return stream
+
+
+#### Now follow the actual tests. ####
+
+##  Tests reading back the toolpath, the preview and the metadata of a UFP file.
+def test_readUFP(ufp_stream: io.BytesIO):
+    package = UltimakerFormatPackage()
+    package.openStream(ufp_stream)
+
+    assert package.getData("/preview")["/preview"] == b"Pretend to be a PNG image."
+    assert package.getStream("/toolpath").read().startswith(b";START_OF_HEADER")
+    assert package.getMetadata("/global/setting") == {"/metadata/global/setting": 42}
+    assert package.getMetadata("/3D/model.gcode/flavor") == {"/metadata/3D/model.gcode/flavor": "Griffin"}
+    package.close()
+
+
+##  Tests that the header of the toolpath is parsed at most once when reading,
+#   and not at all if it was stored when writing.
+@pytest.mark.parametrize("store_toolpath_header", [True, False])
+def test_toolpathHeader(store_toolpath_header: bool, monkeypatch):
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read()
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, store_toolpath_header = store_toolpath_header)
+    toolpath = package.getStream("/toolpath")
+    for start in range(0, len(gcode), 10): #Write in pieces, so that the header gets split up.
+        toolpath.write(gcode[start:start + 10])
+    package.setMetadata({"/toolpath/default/generator/name": "Overridden"})
+    package.close()
+
+    parse_header = GCodeFile.parseHeader
+    calls = []
+    monkeypatch.setattr(GCodeFile, "parseHeader", staticmethod(lambda *args, **kwargs: calls.append(args) or parse_header(*args, **kwargs)))
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    if store_toolpath_header:
+        assert package.getMetadata("/toolpath/default/flavor") == {"/metadata/toolpath/default/flavor": "Griffin"}
+        assert package.getMetadata("/toolpath/default/print/time") == {"/metadata/toolpath/default/print/time": 342521}
+    else:
+        assert package.getMetadata("/toolpath/default/flavor") == {} #The toolpath has metadata, so the header isn't looked at.
+    assert package.getMetadata("/toolpath/default/generator/name") == {"/metadata/toolpath/default/generator/name": "Overridden"} #Explicit metadata wins.
+    package.close()
+    assert len(calls) == 0
+
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, store_toolpath_header = store_toolpath_header)
+    package.setData({"/toolpath": gcode})
+    package.close()
+    calls.clear()
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream, lazy = True)
+    assert package.getMetadata("/toolpath/default/flavor") == {"/metadata/toolpath/default/flavor": "Griffin"}
+    if store_toolpath_header: #Stored as keys in the metadata file, like other metadata.
+        assert package.getMetadata("/toolpath/default/generator/version") == {"/metadata/toolpath/default/generator/version": "2.7.0"}
+    else: #Parsed from the header, as nested dictionaries.
+        assert package.getMetadata("/toolpath/default/generator")["/metadata/toolpath/default/generator"]["version"] == "2.7.0"
+    package.close()
+    assert len(calls) == (0 if store_toolpath_header else 1)
+
+
+##  Tests that the metadata parsed from the header of the toolpath has the same
+#   shape as the header parsed by the G-code file type.
+def test_toolpathHeaderShape():
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read()
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath": gcode})
+    package.close()
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    metadata = package.getMetadata("/3D/model.gcode")
+    package.close()
+    expected = GCodeFile.parseHeader(io.BytesIO(gcode), prefix = "/metadata/3D/model.gcode/")
+    assert metadata == expected
+    assert metadata["/metadata/3D/model.gcode/extruders"][0]["nozzle"]["diameter"] == 0.4
+
+##  Tests that in lazy mode, the parts of the package are only read once they
+#   are needed.
+def test_lazyOpen(ufp_stream: io.BytesIO):
+    package = UltimakerFormatPackage()
+    package.openStream(ufp_stream, lazy = True)
+
+    assert package.getData("/preview")["/preview"] == b"Pretend to be a PNG image."
+    assert package._relations == {} #Getting a resource doesn't need to read the relations.
+    assert len(package._metadata) == 0
+
+    assert package.getMetadata("/global/setting") == {"/metadata/global/setting": 42}
+    assert package.getMetadata("/3D/model.gcode/flavor") == {"/metadata/3D/model.gcode/flavor": "Griffin"}
+    assert "" in package._relations
+    package.close()
+
+
+##  A stream that can only be written to, like a pipe or a socket.
+class WriteOnlyPipe:
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.data += data
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+##  Tests writing a package to streams that can't seek, or in streaming mode to
+#   a stream that could seek but mustn't.
+@pytest.mark.parametrize("output, streaming", [(WriteOnlyPipe(), False), (io.BytesIO(), True)])
+def test_writeStreaming(output, streaming: bool):
+    package = UltimakerFormatPackage()
+    package.openStream(output, mode = OpenMode.WriteOnly, write_options = WriteOptions(streaming = streaming))
+    package.getStream("/toolpath").write(b";FLAVOR:Griffin\nG1 X10 Y10\n" * 1000)
+    package.setData({"/preview": b"Pretend to be a PNG image."})
+    package.setMetadata({"/global/setting": 42})
+    package.close()
+
+    data = bytes(output.data) if isinstance(output, WriteOnlyPipe) else output.getvalue()
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    for info in archive.infolist():
+        assert info.flag_bits & 0x08 #All sizes and CRCs are in a data descriptor after the data.
+    assert archive.read("/3D/model.gcode") == b";FLAVOR:Griffin\nG1 X10 Y10\n" * 1000
+    assert archive.read("/Metadata/thumbnail.png") == b"Pretend to be a PNG image."
+
+
+##  Tests writing a package while compressing on multiple threads, with a
+#   toolpath that is split into many blocks.
+def test_writeParallelCompression():
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        toolpath = gcode_file.read() #Need a valid header to be able to read the package back.
+    toolpath += b"".join("G1 X{x} Y{y} E{e}\n".format(x = i % 200, y = i % 170, e = i).encode("utf-8") for i in range(200000))
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(compression_threads = 3))
+    package._parallel_writer._block_size = 64 * 1024 #Smaller blocks to test with many of them.
+    package.getStream("/toolpath").write(toolpath)
+    package.setData({"/preview": b"Pretend to be a PNG image.", "/empty.txt": b""})
+    package.setMetadata({"/global/setting": 42})
+    package.close()
+
+    archive = zipfile.ZipFile(io.BytesIO(stream.getvalue()))
+    assert archive.testzip() is None
+    assert archive.getinfo("/3D/model.gcode").compress_size < len(toolpath) / 2 #It's actually compressed.
+    assert archive.read("/3D/model.gcode") == toolpath
+    assert archive.read("/empty.txt") == b""
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    assert package.getMetadata("/global/setting") == {"/metadata/global/setting": 42}
+    assert package.getData("/preview")["/preview"] == b"Pretend to be a PNG image."
+
+
+##  Tests the compression of the resources in a UFP file, by default and when
+#   set explicitly.
+@pytest.mark.parametrize("compression_threads", [0, 2])
+def test_compression(compression_threads: int):
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(compression_threads = compression_threads))
+    package.addContentType("stl", "model/stl")
+    package.setCompression(zipfile.ZIP_BZIP2, path = r"\.txt$")
+    package.setCompression(zipfile.ZIP_STORED, content_type = "model/stl")
+    package.setData({
+        "/toolpath": b";FLAVOR:Griffin\n" * 100,
+        "/preview": b"Pretend to be a PNG image." * 100,
+        "/notes.txt": b"Some notes." * 100,
+        "/model.stl": b"solid model" * 100,
+        "/other.dat": b"Other data." * 100
+    })
+    package.close()
+
+    archive = zipfile.ZipFile(io.BytesIO(stream.getvalue()))
+    assert archive.testzip() is None
+    assert archive.getinfo("/Metadata/thumbnail.png").compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("/3D/model.gcode").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo("/notes.txt").compress_type == zipfile.ZIP_BZIP2
+    assert archive.getinfo("/model.stl").compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("/other.dat").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.read("/notes.txt") == b"Some notes." * 100
+
+
+##  Tests pre-rendering previews when writing, and reading them back.
+def test_previewSizes():
+    with open(os.path.join(os.path.dirname(__file__), "resources", "gradient.png"), "rb") as image_file:
+        image = image_file.read()
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(preview_sizes = [(16, 16), (8, 6)]))
+    package.getStream("/preview").write(image)
+    package.close()
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    assert "/Metadata/thumbnail_16x16.png" in package.listPaths()
+    stored = package.getStream("/Metadata/thumbnail_8x6.png").read()
+    assert package.getStream("/preview/8x6").read() == stored #Served as it is.
+
+    UltimakerFormatPackage.resized_image_cache.clear()
+    assert PngImage.decode(package.getStream("/preview/12x12").read())[:2] == (12, 12)
+    assert [key[1] for key in UltimakerFormatPackage.resized_image_cache._entries] == ["/Metadata/thumbnail_16x16.png"] #Resized from the nearest bigger preview.
+    assert PngImage.decode(package.getStream("/preview/20x20").read())[:2] == (20, 20) #Resized from the original.
+    package.close()
+
+
+##  Tests getting layers of the toolpath, with the layer index stored in the
+#   package or built when reading.
+@pytest.mark.parametrize("store_index", [True, False])
+def test_layers(store_index: bool, monkeypatch):
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read()
+    gcode += b"".join(";LAYER:{layer}\nG1 Z{layer}\nG1 X{layer} E{layer}\n".format(layer = layer).encode("UTF-8") for layer in range(10))
+
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    if not store_index:
+        monkeypatch.setattr(package, "_storeLayerIndex", lambda layer_index: None)
+    toolpath = package.getStream("/toolpath")
+    for start in range(0, len(gcode), 100): #Write in pieces to index the toolpath on the go.
+        toolpath.write(gcode[start:start + 100])
+    package.close()
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    assert ("/3D/model.gcode.layerindex" in package.listPaths()) == store_index
+    assert package.getMetadata("/toolpath/default/flavor") == {"/metadata/toolpath/default/flavor": "Griffin"} #Header is still parsed.
+    assert package.getData("/toolpath/default/layer/3") == {"/toolpath/default/layer/3": b";LAYER:3\nG1 Z3\nG1 X3 E3\n"}
+    assert package.getStream("/toolpath/layer/9").read() == b";LAYER:9\nG1 Z9\nG1 X9 E9\n"
+    assert json.loads(package.getStream("/toolpath/default/layers").read().decode("UTF-8"))["numbers"] == list(range(10))
+    assert package.getData("/toolpath/default/layer/10") == {}
+    with pytest.raises(FileNotFoundError):
+        package.getStream("/toolpath/default/layer/10")
+    package.close()
+
+
+##  Tests that the layer index is stored outside of the metadata, so that
+#   readers that parse the header only if the toolpath has no metadata still
+#   see the header of a toolpath with layers.
+def test_layerIndexNotInMetadata(monkeypatch):
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read()
+    gcode += b"".join(";LAYER:{layer}\nG1 Z{layer}\n".format(layer = layer).encode("UTF-8") for layer in range(3))
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath": gcode})
+    package.close()
+
+    archive = zipfile.ZipFile(stream)
+    assert "/3D/model.gcode.json" not in archive.namelist() #No metadata about the toolpath, so its header is parsed when reading.
+    assert json.loads(archive.read("/3D/model.gcode.layerindex").decode("UTF-8"))["numbers"] == [0, 1, 2]
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    metadata = package.getMetadata("/toolpath")
+    assert metadata["/metadata/toolpath/flavor"] == "Griffin"
+    assert not any("layer_index" in key for key in metadata)
+    monkeypatch.setattr(GCodeLayerIndex, "build", None) #The stored index must be used.
+    assert package.getStream("/toolpath/default/layer/1").read() == b";LAYER:1\nG1 Z1\n"
+    package.close()
+
+    stream.seek(0)
+    package = OpenPackagingConvention() #Readers that don't know about UFP files still get the header, and no layer index.
+    package.openStream(stream)
+    metadata = package.getMetadata("/3D/model.gcode")
+    assert metadata["/metadata/3D/model.gcode/flavor"] == "Griffin"
+    assert not any("layer_index" in key for key in metadata)
+    package.close()
+
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.setData({"/toolpath": b"G1 X1\n"}) #No layers.
+    package.close()
+    assert "/3D/model.gcode.layerindex" not in zipfile.ZipFile(stream).namelist()
+
+
+##  Tests changing the metadata and a resource of a package in place, without
+#   rewriting the toolpath.
+def test_readWrite(ufp_stream: io.BytesIO):
+    original_size = len(ufp_stream.getvalue())
+    toolpath_offset = zipfile.ZipFile(ufp_stream).getinfo("/3D/model.gcode").header_offset
+
+    package = UltimakerFormatPackage()
+    package.openStream(ufp_stream, mode = OpenMode.ReadWrite)
+    assert package.getMetadata("/global/setting") == {"/metadata/global/setting": 42}
+    assert package.getData("/preview")["/preview"] == b"Pretend to be a PNG image."
+    package.setMetadata({"/global/setting": 43, "/global/other_setting": "yes"})
+    package.setData({"/preview": b"Another fake image."})
+    package.close()
+
+    archive = zipfile.ZipFile(ufp_stream)
+    assert archive.testzip() is None
+    assert sorted(archive.namelist()) == sorted(set(archive.namelist())) #No duplicate entries.
+    assert archive.getinfo("/3D/model.gcode").header_offset == toolpath_offset #Toolpath is untouched.
+    assert "/3D/model.gcode.json" not in archive.namelist() #Metadata from the G-code header is not stored.
+    assert len(ufp_stream.getvalue()) < original_size + 1000 #Only the changes were added.
+
+    ufp_stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(ufp_stream)
+    assert package.getMetadata("/global") == {"/metadata/global/setting": 43, "/metadata/global/other_setting": "yes"}
+    assert package.getData("/preview")["/preview"] == b"Another fake image."
+    assert package.getStream("/toolpath").read().startswith(b";START_OF_HEADER")
+    package.close()
+
+
+##  Tests copying resources from one package to another without recompressing
+#   them.
+@pytest.mark.parametrize("paths", [None, ["/toolpath", "/3D/model.gcode.seekindex"]])
+def test_copyEntriesFrom(paths):
+    with open(os.path.join(os.path.dirname(__file__), "resources", "um3.gcode"), "rb") as gcode_file:
+        gcode = gcode_file.read() + b"G1 X10 Y10\n" * 10000
+    source_stream = io.BytesIO()
+    source = UltimakerFormatPackage()
+    source.openStream(source_stream, mode = OpenMode.WriteOnly, write_options = WriteOptions(seek_index_interval = 32 * 1024))
+    source.setData({"/toolpath": gcode, "/preview": b"Pretend to be a PNG image."})
+    source.setMetadata({"/toolpath/default/custom": 5, "/global/setting": 42})
+    source.close()
+
+    source_stream.seek(0)
+    source = UltimakerFormatPackage()
+    source.openStream(source_stream)
+    stream = io.BytesIO()
+    package = UltimakerFormatPackage()
+    package.openStream(stream, mode = OpenMode.WriteOnly)
+    package.copyEntriesFrom(source, paths)
+    package.setMetadata({"/global/setting": 43})
+    package.close()
+
+    source_archive = zipfile.ZipFile(source_stream)
+    archive = zipfile.ZipFile(stream)
+    assert archive.testzip() is None
+    for name in ["/3D/model.gcode", "/3D/model.gcode.seekindex"]:
+        assert archive.getinfo(name).compress_size == source_archive.getinfo(name).compress_size
+        assert archive.getinfo(name).CRC == source_archive.getinfo(name).CRC
+    assert ("/Metadata/thumbnail.png" in archive.namelist()) == (paths is None)
+
+    stream.seek(0)
+    package = UltimakerFormatPackage()
+    package.openStream(stream)
+    assert package.getStream("/toolpath").read() == gcode
+    assert package.getMetadata("/toolpath/default/custom") == {"/metadata/toolpath/default/custom": 5}
+    assert package.getMetadata("/global/setting") == {"/metadata/global/setting": 43}
+    assert len(package._seek_indices["/3D/model.gcode"]) > 1 #The relation to the seek index was copied along.
+    package.close()
+    source.close()